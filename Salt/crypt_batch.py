@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+from collections import deque
+
+from encrypt import encrypt_two_way
+from decrypt import decrypt_password
+
+MODES = ('encrypt', 'decrypt', 'rotate')
+USAGE = ('python crypt_batch.py {encrypt|decrypt|rotate} [--input FILE] [--output FILE] '
+         '[--workers N] [--chunk-size N] [--skip-errors]')
+
+# Set once per worker process by _init_worker so every line reuses the same cipher
+_cipher = None
+
+
+def load_keys():
+    """ENCRYPTION_KEY first, then the comma-separated ENCRYPTION_OLD_KEYS still accepted for decrypting."""
+    from dotenv import load_dotenv
+    load_dotenv()
+    primary = os.getenv('ENCRYPTION_KEY')
+    if not primary:
+        raise Exception('ERROR: ENCRYPTION_KEY is not set.')
+    old = [key.strip() for key in os.getenv('ENCRYPTION_OLD_KEYS', '').split(',') if key.strip()]
+    return [key.encode('utf-8') for key in [primary] + old]
+
+
+def make_cipher(keys):
+    """MultiFernet over keys: encrypts with the first, decrypts with any of them."""
+    from cryptography.fernet import Fernet, MultiFernet
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def _init_worker(keys):
+    global _cipher
+    _cipher = make_cipher(keys)
+
+
+def _run_chunk(mode, first_line, lines, skip_errors):
+    # Returns the output lines in input order plus (line number, error) for every line that failed
+    from cryptography.fernet import InvalidToken
+    out = []
+    errors = []
+    for number, line in enumerate(lines, first_line):
+        try:
+            if mode == 'encrypt':
+                out.append(encrypt_two_way(line, _cipher))
+            elif mode == 'decrypt':
+                out.append(decrypt_password(line, _cipher))
+            else:
+                out.append(_cipher.rotate(line))
+        except (InvalidToken, ValueError) as e:
+            if not skip_errors:
+                raise Exception('ERROR: Line {} could not be {}ed: {}'.format(number, mode.rstrip('e'), type(e).__name__))
+            # An empty line keeps the output aligned with the input
+            out.append(b'')
+            errors.append((number, type(e).__name__))
+    return out, errors
+
+
+def read_chunks(lines, chunk_size):
+    """Yield (first line number, lines without line endings) in chunks of chunk_size."""
+    chunk = []
+    first = 1
+    for number, line in enumerate(lines, 1):
+        chunk.append(line.rstrip(b'\r\n'))
+        if len(chunk) == chunk_size:
+            yield first, chunk
+            chunk = []
+            first = number + 1
+    if chunk:
+        yield first, chunk
+
+
+def ordered_map(task, calls, workers=None, initializer=None, initargs=()):
+    """Yield task(*args) for every args tuple in calls, in order, spread over a process pool.
+
+    workers defaults to one per core; at most workers x 4 calls are in flight, so memory stays flat
+    however long calls is. initializer(*initargs) runs once in each worker (or here, with one worker).
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        # Not worth a process pool: run in this process with the same per-chunk code
+        if initializer is not None:
+            initializer(*initargs)
+        for args in calls:
+            yield task(*args)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        try:
+            for args in calls:
+                pending.append(executor.submit(task, *args))
+                if len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def run_batch(mode, lines, keys, workers=None, chunk_size=1000, skip_errors=False):
+    """Yield (output lines, errors) per chunk of the byte lines in input order, one cipher per worker."""
+    if mode not in MODES:
+        raise Exception('ERROR: Unknown mode {!r}; expected one of {}.'.format(mode, ', '.join(MODES)))
+    calls = ((mode, first, chunk, skip_errors) for first, chunk in read_chunks(lines, chunk_size))
+    return ordered_map(_run_chunk, calls, workers, _init_worker, (keys,))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='crypt_batch.py', usage=USAGE,
+                                     description='Encrypt, decrypt or re-key (rotate) one value per line with Fernet.')
+    parser.add_argument('mode', choices=MODES)
+    parser.add_argument('--input', default='-', help="file of one value per line ('-' for stdin)")
+    parser.add_argument('--output', default='-', help="where to write the results ('-' for stdout)")
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='lines per task sent to a worker')
+    parser.add_argument('--skip-errors', action='store_true', help='write an empty line for values that fail instead of stopping')
+    args = parser.parse_args(argv)
+
+    keys = load_keys()
+    if args.mode == 'rotate' and len(keys) == 1:
+        print('Warning: ENCRYPTION_OLD_KEYS is not set; rotate only re-encrypts with ENCRYPTION_KEY.', file=sys.stderr)
+    return stream_batch(lambda source: run_batch(args.mode, source, keys, args.workers, args.chunk_size, args.skip_errors),
+                        args.input, args.output, args.mode.rstrip('e').capitalize() + 'ed')
+
+
+def stream_batch(batch, input_path, output_path, verb):
+    """Write every chunk batch(source) yields to output_path, report failed lines and a summary on stderr.
+
+    batch yields (output lines, [(line number, error)]); '-' means stdin/stdout. Returns the exit code.
+    """
+    source = sys.stdin.buffer if input_path == '-' else open(input_path, 'rb')
+    sink = sys.stdout.buffer if output_path == '-' else open(output_path, 'wb')
+    start_time = time.time()
+    count = 0
+    failed = 0
+    try:
+        for out, errors in batch(source):
+            sink.write(b'\n'.join(out) + b'\n')
+            count += len(out)
+            failed += len(errors)
+            for number, error in errors:
+                print('Line {}: {}'.format(number, error), file=sys.stderr)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+        if sink is not sys.stdout.buffer:
+            sink.close()
+        else:
+            sink.flush()
+    elapsed = time.time() - start_time
+    print('{} {} lines in {:.2f} seconds ({:.0f}/s), {} failed'.format(
+        verb, count, elapsed, count / elapsed if elapsed else 0, failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,31 @@
-import bcrypt
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
-from cryptography.fernet import Fernet
 import time
 import os
-import sys
-from dotenv import load_dotenv
-import importlib.util
-from aam_python import *
-load_dotenv()
-ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
 
 
-def decrypt_password(encrypted_password: bytes, key: bytes) -> bytes:
-    """Decrypt a password using Fernet."""
+def decrypt_password(encrypted_password: bytes, key) -> bytes:
+    """Decrypt a password using Fernet; key may also be a ready Fernet/MultiFernet to reuse."""
+    if hasattr(key, 'decrypt'):
+        return key.decrypt(encrypted_password)
+    # cryptography is only imported when something is actually decrypted
+    from cryptography.fernet import Fernet
     cipher = Fernet(key)
     return cipher.decrypt(encrypted_password)
 
-start_time = time.time()
-# Test the functions
 
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        # Batch mode: decrypt one token per line, e.g. python decrypt.py --input tokens.txt --workers 8
+        from crypt_batch import main
+        sys.exit(main(['decrypt'] + sys.argv[1:]))
+
+    start_time = time.time()
+    from dotenv import load_dotenv
+    from aam_python import CCPPasswordREST
+
     # Load environment variables from .env file
-    
+    load_dotenv()
+    ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
 
     # Establish new session  
     base_uri = os.getenv('AAM_BASE_URI')
@@ -78,7 +81,6 @@ if __name__ == '__main__':
     print('Username: {}'.format(response['UserName']))  
     print('Password: {}'.format(response['Content']))
 
-
-#print("Decrypted password:", decrypt_password(response['Content'].encode(), ENCRYPTION_KEY.encode()).decode())
-stop_time = time.time()
-print(f"Execution time: {stop_time - start_time} seconds")
+    #print("Decrypted password:", decrypt_password(response['Content'].encode(), ENCRYPTION_KEY.encode()).decode())
+    stop_time = time.time()
+    print(f"Execution time: {stop_time - start_time} seconds")
@@ -1,20 +1,30 @@
-import base64
-from cryptography.fernet import Fernet
 import os
-from dotenv import load_dotenv
 import sys
 
-password_to_encrypt = sys.argv[1].encode('utf-8')
 
-load_dotenv()
-ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
-
-
-def encrypt_two_way(password: bytes, key: bytes) -> bytes:
-    """Encrypt a password using Fernet (two-way)."""
+def encrypt_two_way(password: bytes, key) -> bytes:
+    """Encrypt a password using Fernet (two-way); key may also be a ready Fernet/MultiFernet to reuse."""
+    if hasattr(key, 'encrypt'):
+        return key.encrypt(password)
+    from cryptography.fernet import Fernet
     cipher = Fernet(key)
     return cipher.encrypt(password)
 
 
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python encrypt.py <password>')
+        print('       python encrypt.py --input FILE [--rotate] [--output FILE] [--workers N] [--chunk-size N] [--skip-errors]')
+        sys.exit(1)
+
+    if sys.argv[1].startswith('--'):
+        # Batch mode: one value per line; --rotate re-encrypts existing tokens under ENCRYPTION_KEY
+        from crypt_batch import main
+        argv = sys.argv[1:]
+        mode = 'rotate' if '--rotate' in argv else 'encrypt'
+        sys.exit(main([mode] + [arg for arg in argv if arg != '--rotate']))
 
-print(encrypt_two_way(password_to_encrypt, ENCRYPTION_KEY.encode('utf-8')).decode('utf-8'))
+    from dotenv import load_dotenv
+    load_dotenv()
+    ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
+    print(encrypt_two_way(sys.argv[1].encode('utf-8'), ENCRYPTION_KEY.encode('utf-8')).decode('utf-8'))
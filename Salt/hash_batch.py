@@ -0,0 +1,147 @@
+import os
+import statistics
+import sys
+import time
+
+import bcrypt
+
+from crypt_batch import ordered_map, read_chunks, stream_batch
+from salt_one_way import salt_one_way
+
+MODES = ('hash', 'verify', 'calibrate')
+USAGE = ('python hash_batch.py {hash|verify} [--input FILE] [--output FILE] [--rounds N] [--workers N] '
+         '[--chunk-size N] [--skip-errors]\n'
+         '       python hash_batch.py calibrate [--target-ms MS] [--samples N] [--workers N]')
+# Below this cost bcrypt is considered too cheap to slow down offline guessing
+MIN_RECOMMENDED_ROUNDS = 10
+MAX_ROUNDS = 31
+# bcrypt only uses the first 72 bytes of a password
+MAX_PASSWORD_BYTES = 72
+
+
+def _hash_chunk(first_line, lines, rounds, skip_errors):
+    out = []
+    errors = []
+    for number, line in enumerate(lines, first_line):
+        try:
+            # Checked here because bcrypt < 5 silently truncates longer passwords instead of refusing them
+            if len(line) > MAX_PASSWORD_BYTES:
+                raise ValueError('password is {} bytes; bcrypt only uses the first {}'.format(len(line), MAX_PASSWORD_BYTES))
+            out.append(salt_one_way(line, rounds))
+        except ValueError as e:
+            if not skip_errors:
+                raise Exception('ERROR: Line {} could not be hashed: {}'.format(number, e))
+            out.append(b'')
+            errors.append((number, str(e)))
+    return out, errors
+
+
+def _verify_chunk(first_line, lines):
+    # One 'match', 'mismatch' or 'invalid' per password<TAB>hash line; anything but a match is reported
+    out = []
+    errors = []
+    for number, line in enumerate(lines, first_line):
+        password, tab, hashed = line.rpartition(b'\t')
+        try:
+            result = b'match' if tab and bcrypt.checkpw(password, hashed) else b'mismatch'
+        except ValueError:
+            result = b'invalid'
+        out.append(result)
+        if result != b'match':
+            errors.append((number, result.decode()))
+    return out, errors
+
+
+def hash_batch(lines, rounds=None, workers=None, chunk_size=4, skip_errors=False):
+    """Yield (hashes, errors) per chunk of the byte lines in input order, hashed across a process pool."""
+    calls = ((first, chunk, rounds, skip_errors) for first, chunk in read_chunks(lines, chunk_size))
+    return ordered_map(_hash_chunk, calls, workers)
+
+
+def verify_batch(lines, workers=None, chunk_size=4):
+    """Yield (results, non-matching lines) per chunk of password<TAB>hash byte lines in input order."""
+    return ordered_map(_verify_chunk, read_chunks(lines, chunk_size), workers)
+
+
+def _time_hash(rounds, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        salt_one_way(b'calibration-password', rounds)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def calibrate(target_ms=250, samples=3, min_rounds=4):
+    """Time one hash per cost factor from min_rounds upwards; return [(rounds, ms)] and the highest cost within target_ms.
+
+    Each extra round doubles the work, so timing stops at the first cost over the target.
+    """
+    timings = []
+    recommended = None
+    for rounds in range(min_rounds, MAX_ROUNDS + 1):
+        ms = _time_hash(rounds, samples) * 1000
+        timings.append((rounds, ms))
+        if ms > target_ms:
+            break
+        recommended = rounds
+    return timings, recommended
+
+
+def _measure_throughput(rounds, workers):
+    # All workers hashing at once, so shared cores, SMT and thermal limits show up in the figure
+    count = workers * 2
+    start = time.perf_counter()
+    for _ in hash_batch((b'calibration-password' for _ in range(count)), rounds, workers, chunk_size=1):
+        pass
+    return count / (time.perf_counter() - start)
+
+
+def _run_calibrate(args):
+    workers = args.workers or os.cpu_count() or 1
+    timings, recommended = calibrate(args.target_ms, args.samples)
+    print('Cost  Per hash')
+    for rounds, ms in timings:
+        print('{:>4}  {:>8.1f} ms'.format(rounds, ms))
+    if recommended is None:
+        raise Exception('ERROR: Even cost 4 takes over {} ms per hash on this host.'.format(args.target_ms))
+    per_hash = dict(timings)[recommended]
+    print('Recommended BCRYPT_ROUNDS={} ({:.1f} ms per hash, target {} ms)'.format(recommended, per_hash, args.target_ms))
+    print('Parallel throughput at cost {}: {:.1f} hashes/s with {} workers'.format(
+        recommended, _measure_throughput(recommended, workers), workers))
+    if recommended < MIN_RECOMMENDED_ROUNDS:
+        print('Warning: cost {} is below {}; consider a higher target latency.'.format(recommended, MIN_RECOMMENDED_ROUNDS),
+              file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='hash_batch.py', usage=USAGE,
+                                     description='Hash or verify one password per line with bcrypt, or calibrate the cost factor.')
+    parser.add_argument('mode', choices=MODES)
+    parser.add_argument('--input', default='-', help="passwords, or password<TAB>hash lines to verify ('-' for stdin)")
+    parser.add_argument('--output', default='-', help="where to write the results ('-' for stdout)")
+    parser.add_argument('--rounds', type=int, default=None, help='bcrypt cost factor (default: BCRYPT_ROUNDS or 12)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=4, help='lines per task sent to a worker')
+    parser.add_argument('--skip-errors', action='store_true', help='write an empty line for passwords bcrypt rejects instead of stopping')
+    parser.add_argument('--target-ms', type=float, default=250, help='calibrate: per-hash latency budget in milliseconds')
+    parser.add_argument('--samples', type=int, default=3, help='calibrate: hashes timed per cost factor')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'calibrate':
+        return _run_calibrate(args)
+    if args.mode == 'verify':
+        return stream_batch(lambda source: verify_batch(source, args.workers, args.chunk_size),
+                            args.input, args.output, 'Verified')
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    rounds = args.rounds or int(os.getenv('BCRYPT_ROUNDS', '0')) or None
+    return stream_batch(lambda source: hash_batch(source, rounds, args.workers, args.chunk_size, args.skip_errors),
+                        args.input, args.output, 'Hashed')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,26 @@
 import bcrypt
+import os
 import sys
 
-password_to_salt = sys.argv[1].encode('utf-8')
 
+def salt_one_way(password: bytes, rounds: int = None) -> bytes:
+    """Hash a password using bcrypt (one-way) at cost rounds (bcrypt's default, 12, when None)."""
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds) if rounds else bcrypt.gensalt())
 
-def salt_one_way(password: bytes) -> bytes:
-    """Hash a password using bcrypt (one-way)."""
-    return bcrypt.hashpw(password, bcrypt.gensalt())
 
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python salt_one_way.py <password>')
+        print('       python salt_one_way.py --input FILE [--verify] [--rounds N] [--output FILE] [--workers N]')
+        print('       python hash_batch.py calibrate [--target-ms MS]')
+        sys.exit(1)
 
-print(salt_one_way(password_to_salt).decode('utf-8'))
-
+    if sys.argv[1].startswith('--'):
+        # Batch mode: one password per line, or password<TAB>hash per line with --verify
+        from hash_batch import main
+        argv = sys.argv[1:]
+        mode = 'verify' if '--verify' in argv else 'hash'
+        sys.exit(main([mode] + [arg for arg in argv if arg != '--verify']))
 
+    rounds = int(os.getenv('BCRYPT_ROUNDS', '0')) or None
+    print(salt_one_way(sys.argv[1].encode('utf-8'), rounds).decode('utf-8'))
@@ -0,0 +1,195 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from crypt_batch import load_keys, make_cipher
+from encrypt import encrypt_two_way
+
+USAGE = ('python vault_sync.py --manifest FILE [--batch-size N] [--max-concurrency N] [--dry-run]\n'
+         '       Mongo target from AAM_MONGO_URI, AAM_MONGO_DB and AAM_MONGO_COLLECTION')
+# get_password keyword arguments a manifest record may carry
+QUERY_FIELDS = ('appid', 'safe', 'folder', 'objectName', 'username', 'address', 'database', 'policyid', 'reason',
+                'query_format', 'dual_accounts')
+# Account properties copied from the CCP response next to the encrypted password
+STORED_FIELDS = ('Safe', 'Folder', 'Name', 'UserName', 'Address', 'Database', 'PolicyID')
+# Context for deriving the digest key from the Fernet key, so one key never serves two purposes
+DIGEST_KEY_CONTEXT = b'vault_sync-digest'
+
+
+def parse_manifest(lines, appid=None, safe=None):
+    """Yield (document id or None, get_password keyword dict) per non-blank manifest line.
+
+    A line is either a bare object name (looked up in safe with appid) or a JSON object of get_password
+    keyword arguments, with 'object' accepted for objectName and an optional 'id' for the Mongo _id.
+    Records are checked against get_password's rules here, so a bad line fails before any lookup.
+    """
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if not line.startswith('{'):
+            yield None, _check_query(line_no, {'appid': appid, 'safe': safe, 'objectName': line})
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise Exception('ERROR: Manifest line {} is not valid JSON: {}'.format(line_no, e))
+        if 'object' in record:
+            record.setdefault('objectName', record['object'])
+        query = {'appid': appid, 'safe': safe}
+        query.update((name, record[name]) for name in QUERY_FIELDS if record.get(name) is not None)
+        yield record.get('id'), _check_query(line_no, query)
+
+
+def _check_query(line_no, query):
+    # The rules of CCPPasswordREST._build_params: appid and safe, plus an object or a username
+    if not query.get('appid'):
+        raise Exception('ERROR: Manifest line {} has no appid (set AAM_APP_ID or "appid").'.format(line_no))
+    if not query.get('safe'):
+        raise Exception('ERROR: Manifest line {} has no safe (set AAM_SAFE or "safe").'.format(line_no))
+    if not query.get('objectName') and not query.get('username'):
+        raise Exception('ERROR: Manifest line {} has no object or username.'.format(line_no))
+    return query
+
+
+def digest_key(key):
+    """Derive the HMAC key for content_digest from a Fernet key (the Fernet key itself only encrypts)."""
+    key = key.encode('utf-8') if isinstance(key, str) else key
+    return hmac.new(key, DIGEST_KEY_CONTEXT, hashlib.sha256).digest()
+
+
+def content_digest(key, response):
+    """Keyed SHA-256 over the password and stored account properties, so unchanged accounts can be skipped.
+
+    Fernet tokens differ on every encryption and a plain hash of a password can be brute-forced, hence the HMAC.
+    """
+    material = {name: response.get(name) for name in ('Content',) + STORED_FIELDS}
+    return hmac.new(key, json.dumps(material, sort_keys=True).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _document_id(doc_id, response):
+    return doc_id or '{}/{}'.format(response.get('Safe'), response.get('Name'))
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sync(aimccp, collection, manifest, keys, batch_size=1000, max_concurrency=None, dry_run=False):
+    """Fetch every manifest entry through aimccp and upsert the ones whose digest changed into collection.
+
+    manifest yields (document id or None, get_password keyword dict), e.g. from parse_manifest; keys are
+    Fernet keys, the first encrypting the passwords and, through digest_key, keying the digests. Each batch costs one
+    get_passwords call, one find for the stored digests and one unordered bulk_write of the changed
+    documents. Returns a dict of counters.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+
+    cipher = make_cipher(keys)
+    mac_key = digest_key(keys[0])
+    stats = {'accounts': 0, 'unchanged': 0, 'changed': 0, 'inserted': 0, 'updated': 0, 'failed': 0}
+    for batch in _batches(manifest, batch_size):
+        stats['accounts'] += len(batch)
+        results = aimccp.get_passwords([query for _, query in batch], max_concurrency)
+        fetched = {}
+        for index, (doc_id, query) in enumerate(batch):
+            outcome = results[index]
+            if outcome['error'] is not None:
+                stats['failed'] += 1
+                print('Failed {}: {}'.format(doc_id or query.get('objectName'), outcome['error']), file=sys.stderr)
+                continue
+            response = outcome['result']
+            fetched[_document_id(doc_id, response)] = response
+
+        digests = {name: content_digest(mac_key, response) for name, response in fetched.items()}
+        stored = {doc['_id']: doc.get('digest') for doc in collection.find({'_id': {'$in': list(digests)}}, {'digest': 1})}
+        now = datetime.now(timezone.utc)
+        writes = []
+        written = []
+        for name, response in fetched.items():
+            if stored.get(name) == digests[name]:
+                stats['unchanged'] += 1
+                continue
+            document = {field: response.get(field) for field in STORED_FIELDS}
+            document.update(password=encrypt_two_way(response['Content'].encode('utf-8'), cipher).decode('utf-8'),
+                            digest=digests[name], updated_at=now)
+            writes.append(UpdateOne({'_id': name}, {'$set': document}, upsert=True))
+            written.append(name)
+        stats['changed'] += len(writes)
+        if writes and not dry_run:
+            # Unordered: one bad document does not stop the rest of the batch
+            try:
+                result = collection.bulk_write(writes, ordered=False)
+            except BulkWriteError as e:
+                # The other writes were still applied; count them and report the rejected ones
+                stats['inserted'] += e.details.get('nUpserted', 0)
+                stats['updated'] += e.details.get('nModified', 0)
+                for error in e.details.get('writeErrors', []):
+                    stats['failed'] += 1
+                    print('Failed {}: {}'.format(written[error['index']], error.get('errmsg')), file=sys.stderr)
+                continue
+            stats['inserted'] += result.upserted_count
+            stats['updated'] += result.modified_count
+    return stats
+
+
+def _client_from_env():
+    from aam_python import CCPPasswordREST
+
+    aimccp = CCPPasswordREST(base_uri=os.getenv('AAM_BASE_URI'))
+    # Same priority as decrypt.py: file paths, then certificate content
+    if os.getenv('AAM_DEMO_PATH') and os.getenv('AAM_PASSPHRASE'):
+        aimccp.load_cert_from_env_path('AAM_DEMO_PATH', 'AAM_PASSPHRASE', 'AAM_DEMO_KEY_PATH' if os.getenv('AAM_DEMO_KEY_PATH') else None)
+    elif os.getenv('AAM_CERT') and os.getenv('AAM_PASSPHRASE'):
+        aimccp.load_cert_from_env('AAM_CERT', 'AAM_PASSPHRASE', 'AAM_KEY' if os.getenv('AAM_KEY') else None)
+    else:
+        raise Exception('ERROR: Certificate configuration not found in .env file. Please configure AAM_DEMO_PATH or AAM_CERT variables.')
+    return aimccp
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='vault_sync.py', usage=USAGE,
+                                     description='Copy vault accounts into MongoDB, Fernet-encrypted, writing only the ones that changed.')
+    parser.add_argument('--manifest', required=True, help="one object name or JSON get_password record per line ('-' for stdin)")
+    parser.add_argument('--batch-size', type=int, default=1000, help='accounts per lookup batch and bulk_write')
+    parser.add_argument('--max-concurrency', type=int, default=None, help='parallel CCP lookups (default: the pool size)')
+    parser.add_argument('--dry-run', action='store_true', help='count the changes without writing them')
+    args = parser.parse_args(argv)
+
+    keys = load_keys()
+    from pymongo import MongoClient
+    mongo = MongoClient(os.getenv('AAM_MONGO_URI', 'mongodb://localhost:27017'))
+    collection = mongo[os.getenv('AAM_MONGO_DB', 'vault')][os.getenv('AAM_MONGO_COLLECTION', 'credentials')]
+    aimccp = _client_from_env()
+
+    start_time = time.time()
+    source = sys.stdin if args.manifest == '-' else open(args.manifest)
+    try:
+        manifest = parse_manifest(source, os.getenv('AAM_APP_ID'), os.getenv('AAM_SAFE'))
+        stats = sync(aimccp, collection, manifest, keys, args.batch_size, args.max_concurrency, args.dry_run)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        aimccp.close()
+        mongo.close()
+    print('Synced {accounts} accounts: {changed} changed ({inserted} inserted, {updated} updated), '
+          '{unchanged} unchanged, {failed} failed{}'.format(' (dry run)' if args.dry_run else '', **stats), file=sys.stderr)
+    print('Execution time: {:.2f} seconds'.format(time.time() - start_time), file=sys.stderr)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
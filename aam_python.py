@@ -1,24 +1,169 @@
-import http.client  
 import json  
-import mimetypes  
 import ssl  
 import urllib.parse
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+import threading
+import time
+from ccp_env import load_env
+from ccp_endpoints import FailoverPool, split_endpoints
+from ccp_account import project
+from ccp_cache import SecretCache
+from ccp_disk_cache import DiskSecretCache
+import ccp_fork
+from ccp_metrics import outcome_for, resolve_metrics
+from ccp_shared_cache import SharedSecretCache
+from ccp_singleflight import SingleFlight
+from ccp_ssl import get_ssl_context_from_pem
+from ccp_transport import alpn_protocols, resolve_transport
 
 
 class CCPPasswordREST(object):  
   
     # Runs on Initialization  
-    def __init__(self, verifyService = True, base_uri = os.getenv('AAM_BASE_URI')):
+    def __init__(self, verifyService = True, base_uri = None, pool_size = 10, pool_idle_timeout = 60, service_check_ttl = 60, service_failure_ttl = 5, service_probe_interval = None, cache_ttl = None, cache_max_entries = 1024, refresh_ahead = None, refresh_jitter = 0.1, refresh_idle = None, stale_ttl = 0, disk_cache = None, disk_cache_ttl = None, connect_timeout = 5, read_timeout = None, hedge = False, hedge_delay = 0.25, endpoint_failure_ttl = 5, balance = None, metrics = None, shared_cache = None, shared_cache_ttl = None, transport = None):
+        # .env is read on first use rather than at import
+        load_env()
+        base_uri = base_uri or os.getenv('AAM_BASE_URI')
         # Declare Init Variables  
-        self._base_uri = base_uri.rstrip('/').replace('https://','')  
+        # One or more CCP nodes: a list, or a comma-separated AAM_BASE_URI
+        self._base_uri = ','.join(split_endpoints(base_uri))
         self._context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        # 'http1' keep-alive pool (default) or 'h2' multiplexing over one connection per node (or AAM_TRANSPORT)
+        self._transport = resolve_transport(transport)
+        self._alpn = alpn_protocols(self._transport)
+        if self._alpn:
+            self._context.set_alpn_protocols(list(self._alpn))
         self._headers = {'Content-Type': 'application/json'}  
         self._verify = verifyService
         self._certificatesLoaded = False
+        # Keep-alive connections per node, shared by every lookup; failover (and optional hedging) across nodes
+        read_timeout = read_timeout or float(os.getenv('AAM_TIMEOUT', 30))
+        self._pool = FailoverPool(self._base_uri, self._context, maxsize=pool_size, idle_timeout=pool_idle_timeout,
+                                  connect_timeout=connect_timeout, read_timeout=read_timeout, failure_ttl=endpoint_failure_ttl,
+                                  hedge=hedge, hedge_delay=hedge_delay, balance=balance or os.getenv('AAM_BALANCE', 'ordered'),
+                                  transport=self._transport)
+        # Cached AIMWebService health (circuit state): None = unknown, True = up, Exception = down
+        self._service_check_ttl = service_check_ttl
+        self._service_failure_ttl = service_failure_ttl
+        self._service_state = None
+        self._service_checked_at = 0.0
+        self._service_lock = threading.Lock()
+        self._service_probe_interval = service_probe_interval
+        self._service_probe_stop = threading.Event()
+        self._service_probe_thread = None
+        # Opt-in secret cache keyed on the filtered CCP parameters (disabled when cache_ttl is None)
+        self._cache_ttl = cache_ttl
+        self._cache = SecretCache(ttl=cache_ttl, max_entries=cache_max_entries, refresh_ahead=refresh_ahead, refresh_jitter=refresh_jitter, stale_ttl=stale_ttl) if cache_ttl else None
+        # Refresh-ahead: renew entries read within refresh_idle seconds at refresh_ahead * cache_ttl
+        self._refresh_ahead = refresh_ahead if cache_ttl else None
+        self._refresh_idle = refresh_idle or cache_ttl
+        self._refresh_interval = min(1.0, cache_ttl * refresh_ahead / 4) if self._refresh_ahead else None
+        self._refresh_stop = threading.Event()
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
+        # Opt-in encrypted cache file (path or AAM_DISK_CACHE) shared with other processes (ENCRYPTION_KEY, per-entry expiry)
+        disk_cache = disk_cache or os.getenv('AAM_DISK_CACHE')
+        disk_cache_ttl = disk_cache_ttl or float(os.getenv('AAM_DISK_CACHE_TTL', 0)) or cache_ttl or 300
+        self._disk_cache = DiskSecretCache(disk_cache, ttl=disk_cache_ttl) if disk_cache else None
+        # Opt-in memory-mapped cache (path or AAM_SHARED_CACHE, e.g. on /dev/shm) shared by every worker on the host
+        shared_cache = shared_cache or os.getenv('AAM_SHARED_CACHE')
+        self._shared_cache = SharedSecretCache(shared_cache, ttl=shared_cache_ttl or cache_ttl or 300) if shared_cache else None
+        # Caches other processes fill, checked in this order before going to CCP
+        self._shared_tiers = [cache for cache in (self._shared_cache, self._disk_cache) if cache is not None]
+        # Concurrent identical lookups share one in-flight request
+        self._flight = SingleFlight()
+        # Per-phase latency histograms (a ccp_metrics.PhaseMetrics, True for the shared one); off unless set or AAM_METRICS=true
+        self._metrics = resolve_metrics(metrics)
+        # Pre-fork servers: the child gets fresh locks and threads, and drops the parent's connections
+        ccp_fork.register(self)
+
+    # Runs in a forked child; the pool, caches and single-flight reset themselves
+    def _after_fork(self):
+        self._service_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._service_probe_stop = threading.Event()
+        self._refresh_stop = threading.Event()
+        # Daemon threads do not survive a fork; both are restarted on demand
+        self._service_probe_thread = None
+        self._refresh_thread = None
+
+    # Connection pool counters (created, reused, ..., failovers, hedged, hedge_wins) with per-node detail under 'endpoints'
+    def pool_stats(self):
+        return self._pool.stats()
+
+    # Secret cache counters (hits, misses, expired, evicted, invalidated, entries); None when caching is off
+    def cache_stats(self):
+        return self._cache.stats() if self._cache is not None else None
+
+    # On-disk cache counters (hits, misses, expired, undecryptable, writes, entries); None when not configured
+    def disk_cache_stats(self):
+        return self._disk_cache.stats() if self._disk_cache is not None else None
+
+    # Shared-memory cache counters for this process (hits, misses, torn, writes, evicted, lease_waits) plus live entries
+    def shared_cache_stats(self):
+        return self._shared_cache.stats() if self._shared_cache is not None else None
+
+    # Per-node requests, failures, times chosen first, in-flight count, EWMA and p95 latency
+    def endpoint_stats(self):
+        return self._pool.endpoint_stats()
+
+    # Request coalescing counters (calls, executed, coalesced, in_flight)
+    def singleflight_stats(self):
+        return self._flight.stats()
+
+    # Per-phase latency histograms (openmetrics(), send_to_zabbix()); None when the hooks are off
+    def phase_metrics(self):
+        return self._metrics
+
+    # Drop and wipe every cached secret (in memory, shared memory and on disk)
+    def clear_cache(self):
+        if self._cache is not None:
+            self._cache.clear()
+        for cache in self._shared_tiers:
+            cache.clear()
+
+    # Drop and wipe the cached secret for one lookup; takes the same arguments as get_password
+    def invalidate_password(self, **kwargs):
+        key = SecretCache.make_key(self._build_params(**kwargs))
+        dropped = False
+        if self._cache is not None:
+            dropped = self._cache.invalidate(key)
+        for cache in self._shared_tiers:
+            dropped = cache.invalidate(self._disk_key(key)) or dropped
+        return dropped
+
+    # Entries in a shared cache (file or memory) must not collide across CCP hosts
+    def _disk_key(self, key):
+        return [self._base_uri, key]
+
+    # Start the refresh-ahead daemon thread once (no-op unless refresh_ahead was configured)
+    def _start_refresher(self):
+        with self._refresh_lock:
+            if self._refresh_thread is not None:
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name='ccp-refresh-ahead', daemon=True)
+            self._refresh_thread.start()
+
+    # Re-fetch hot cache entries before they expire; failures keep the old value and retry later
+    def _refresh_loop(self):
+        while not self._refresh_stop.wait(self._refresh_interval):
+            for key in self._cache.due_for_refresh(self._refresh_idle):
+                if self._refresh_stop.is_set():
+                    return
+                try:
+                    status_code, _ = self._flight.do(key, lambda: self._fetch(dict(key), key))
+                    if status_code != 200:
+                        raise Exception('ERROR: refresh returned {}'.format(status_code))
+                except Exception:
+                    self._cache.postpone_refresh(key, self._refresh_interval * 4)
+
+    # Stop the background service probe and refresher, and close pooled connections
+    def close(self):
+        self._service_probe_stop.set()
+        self._refresh_stop.set()
+        self._pool.close()
+        if self._shared_cache is not None:
+            self._shared_cache.close()
   
     def load_cert_from_local_path(self, pubKeyPath, keyringService, keyringUser, privKeyPath = None):
         # See instructions for installation of keyring module https://pypi.org/project/keyring/#installation-instructions
@@ -61,6 +206,11 @@ class CCPPasswordREST(object):
             self._context.load_cert_chain(certfile=certificatePath, password=passphrase)
         self._certificatesLoaded = True
     
+    # Load a cert (and optional separate key) straight from disk; the key may be unencrypted
+    def load_cert_from_path(self, pubKeyPath, privKeyPath = None, passphrase = None):
+        self._context.load_cert_chain(certfile=pubKeyPath, keyfile=privKeyPath, password=passphrase)
+        self._certificatesLoaded = True
+
     def load_cert_from_env(self, certEnvVarName, passphraseEnvVarName, privKeyEnvVarName = None):
         passphrase = os.getenv(passphraseEnvVarName)
         certificate = os.getenv(certEnvVarName)
@@ -74,31 +224,19 @@ class CCPPasswordREST(object):
             raise Exception('ERROR: Unable to retrieve passphrase from environment variable {}'.format(passphraseEnvVarName)) 
 
         if certificate is None:
-            raise Exception('ERROR: Unable to retrieve public key from environment variable {}'.format(certificate)) 
+            raise Exception('ERROR: Unable to retrieve public key from environment variable {}'.format(certEnvVarName)) 
         
-        # SSLContext requires a path to a file, so we can't just simply feed the string itself into load_cert_chain
-        with open('pubkey.pem', 'w') as file:
-            file.write(certificate)
-
-        if privKey is not None:
-            with open('privkey.pem', 'w') as file:
-                file.write(privKey)
-            self._context.load_cert_chain(certfile='pubkey.pem', keyfile='privkey.pem', password=passphrase)
-            os.remove('privkey.pem')
-        else:
-            self._context.load_cert_chain(certfile='pubkey.pem', password=passphrase)
-        os.remove('pubkey.pem')
+        # SSLContext requires a path to a file; ccp_ssl hands it memory-backed files instead of writing to the cwd,
+        # and shares the resulting context with every other client loading the same material
+        self._context = get_ssl_context_from_pem(certificate, privKey, passphrase, alpn=self._alpn)
+        self._pool.set_context(self._context)
         self._certificatesLoaded = True
 
     # Checks that the AAM Web Service is available  
     def _check_service(self):  
         try:  
             url = '/AIMWebService/v1.1/aim.asmx'  
-            conn = http.client.HTTPSConnection(self._base_uri, context=self._context)  
-            conn.request("GET", url, headers=self._headers)  
-            res = conn.getresponse()  
-            status_code = res.status  
-            conn.close()  
+            status_code, _ = self._pool.request("GET", url, headers=self._headers)  
   
             if status_code != 200:  
                 raise Exception('ERROR: AIMWebService Not Found.')  
@@ -107,15 +245,53 @@ class CCPPasswordREST(object):
             raise Exception(e)
   
         return status_code  
-  
-    # Retrieve Account Object Properties using AAM Web Service  
-    def get_password(self, appid=None, safe=None, folder=None, objectName=None, username=None, address=None, database=None, policyid=None, reason=None, query_format=None, dual_accounts=False):
 
-        if not self._certificatesLoaded:
-            raise Exception('ERROR: Certificates have not been loaded into the SSL context. Please call one of load_cert_from_local_path, load_cert_from_env_path, or load_cert_from_env')
+    # Run _check_service and record the result as the cached circuit state
+    def _refresh_service_state(self):
+        try:
+            self._check_service()
+            state = True
+        except Exception as e:
+            state = e
+        with self._service_lock:
+            self._service_state = state
+            self._service_checked_at = time.monotonic()
+        return state
 
-        if self._verify:
-            service_status = self._check_service()
+    # Probe the service only when the cached state has expired; raise while it is known to be down
+    def _ensure_service(self):
+        with self._service_lock:
+            state = self._service_state
+            age = time.monotonic() - self._service_checked_at
+        ttl = self._service_check_ttl if state is True else self._service_failure_ttl
+        if state is None or age >= ttl:
+            state = self._refresh_service_state()
+        if state is not True:
+            raise Exception(state)
+
+    # Forget the cached service state so the next lookup probes again
+    def reset_service_state(self):
+        with self._service_lock:
+            self._service_state = None
+            self._service_checked_at = 0.0
+
+    # Keep the cached service state fresh from a daemon thread instead of on the lookup path
+    def start_service_probe(self, interval = None):
+        interval = interval or self._service_probe_interval or self._service_check_ttl
+        if self._service_probe_thread is not None and self._service_probe_thread.is_alive():
+            return
+        self._service_probe_stop.clear()
+
+        def probe():
+            while not self._service_probe_stop.is_set():
+                self._refresh_service_state()
+                self._service_probe_stop.wait(interval)
+
+        self._service_probe_thread = threading.Thread(target=probe, name='ccp-service-probe', daemon=True)
+        self._service_probe_thread.start()
+  
+    # Build and validate the filtered CCP parameter dict for a lookup  
+    def _build_params(self, appid=None, safe=None, folder=None, objectName=None, username=None, address=None, database=None, policyid=None, reason=None, query_format=None, dual_accounts=False):
 
         # Check for username or virtual username (dual accounts)  
         if dual_accounts:  
@@ -145,6 +321,95 @@ class CCPPasswordREST(object):
             raise Exception('ERROR: safe is a required parameter.')  
         elif 'username' not in var_filtered and 'query' not in var_filtered and 'object' not in var_filtered:  
             raise Exception('ERROR: either username or object requires a value or dual accounts should be true.')  
+
+        return var_filtered
+
+    # Retrieve Account Object Properties using AAM Web Service  
+    # With fields (CCP property names) returns a compact ccp_account.AccountResult holding only those
+    def get_password(self, appid=None, safe=None, folder=None, objectName=None, username=None, address=None, database=None, policyid=None, reason=None, query_format=None, dual_accounts=False, fields=None):
+
+        if not self._certificatesLoaded:
+            raise Exception('ERROR: Certificates have not been loaded into the SSL context. Please call one of load_cert_from_local_path, load_cert_from_env_path, load_cert_from_path, or load_cert_from_env')
+
+        var_filtered = self._build_params(appid=appid, safe=safe, folder=folder, objectName=objectName, username=username, address=address, database=database, policyid=policyid, reason=reason, query_format=query_format, dual_accounts=dual_accounts)
+
+        _, ret_response = self._lookup(var_filtered)
+        # Return Proper Response  
+        return project(ret_response, fields)
+
+    def lookup(self, params):
+        """Look up raw Accounts query parameters (e.g. AppID/Query as sent by Zabbix) through the caches; returns (status code, response dict)."""
+        if not self._certificatesLoaded:
+            raise Exception('ERROR: Certificates have not been loaded into the SSL context. Please call one of load_cert_from_local_path, load_cert_from_env_path, load_cert_from_path, or load_cert_from_env')
+        return self._lookup(params)
+
+    # Fetch one validated parameter set; returns (status code, response dict)
+    def _lookup(self, var_filtered):
+
+        key = SecretCache.make_key(var_filtered)
+
+        # Serve repeat lookups from the secret cache when enabled
+        if self._cache is not None:
+            data = self._cache.get(key)
+            if data is not None:
+                return 200, json.loads(data.decode('UTF-8'))
+
+        # Then from the caches other processes may have filled (shared memory, then the file), without touching the network
+        for cache in self._shared_tiers:
+            data, remaining = cache.get_with_ttl(self._disk_key(key))
+            if data is not None:
+                if self._cache is not None:
+                    self._cache.put(key, data, ttl=min(remaining, self._cache_ttl))
+                return 200, json.loads(data.decode('UTF-8'))
+
+        # Network lookups are timed per phase when metrics are on; cache hits are not
+        timer = self._metrics.timer(var_filtered.get('appid') or var_filtered.get('AppID'), self._base_uri) if self._metrics is not None else None
+
+        # Callers asking for the same parameters at the same moment wait on one fetch
+        try:
+            status_code, data = self._flight.do(key, lambda: self._fetch_leased(var_filtered, key, timer))
+        except Exception:
+            # CCP unavailable: fall back to the last good value while it is inside the stale window
+            stale = self._cache.get_stale(key) if self._cache is not None else None
+            if timer is not None:
+                timer.finish('error' if stale is None else 'stale')
+            if stale is None:
+                raise
+            return 200, json.loads(stale.decode('UTF-8'))
+        if status_code >= 500 and self._cache is not None:
+            stale = self._cache.get_stale(key)
+            if stale is not None:
+                if timer is not None:
+                    timer.finish('stale')
+                return 200, json.loads(stale.decode('UTF-8'))
+        if timer is None:
+            # Deal with Python dict for return variable  
+            return status_code, json.loads(data.decode('UTF-8'))
+        timer.skip()
+        response = json.loads(data.decode('UTF-8'))
+        timer.mark('decode')
+        timer.finish(outcome_for(status_code))
+        return status_code, response
+
+    # With a shared cache one process per host fetches a missing secret; siblings wait on its lease and read the result
+    def _fetch_leased(self, var_filtered, key, timer=None):
+        if self._shared_cache is None:
+            return self._fetch(var_filtered, key, timer)
+        with self._shared_cache.lease(self._disk_key(key)):
+            data, remaining = self._shared_cache.get_with_ttl(self._disk_key(key))
+            if data is not None:
+                if self._cache is not None:
+                    self._cache.put(key, data, ttl=min(remaining, self._cache_ttl))
+                return 200, data
+            return self._fetch(var_filtered, key, timer)
+
+    # Perform the HTTPS request for one parameter set; returns (status code, raw body)
+    def _fetch(self, var_filtered, key, timer=None):
+
+        if self._verify:
+            self._ensure_service()
+            if self._service_probe_interval and self._service_probe_thread is None:
+                self.start_service_probe()
          
   
         # Urlify parameters for GET Request  
@@ -153,20 +418,81 @@ class CCPPasswordREST(object):
         url = '/AIMWebService/api/Accounts?{}'.format(params)  
   
         try:  
-            conn = http.client.HTTPSConnection(self._base_uri, context=self._context)  
-            conn.request("GET", url, headers=self._headers)  
-            res = conn.getresponse()  
-            data = res.read()  
-            conn.close()  
+            status_code, data = self._pool.request("GET", url, headers=self._headers, timer=timer)  
   
         # Capture Any Exceptions that Occur  
         except Exception as e:  
+            # A failed lookup invalidates the cached service state
+            self.reset_service_state()
             # Print Exception Details and Exit  
             raise Exception(e)
-         
-        # Deal with Python dict for return variable  
-        ret_response = json.loads(data.decode('UTF-8'))  
-        # Return Proper Response  
-        return ret_response  
+
+        if status_code >= 500:
+            self.reset_service_state()
+        elif status_code == 200:
+            if self._cache is not None:
+                self._cache.put(key, data)
+                if self._refresh_ahead:
+                    self._start_refresher()
+            for cache in self._shared_tiers:
+                cache.put(self._disk_key(key), data)
+        return status_code, data
+
+    # Retrieve many Account Objects in parallel over the shared connection pool
+    def get_passwords(self, queries, max_concurrency = None, fields = None):
+        """Look up many parameter sets at once.
+
+        queries is a list of get_password keyword dicts, or a dict of label -> keyword dict.
+        Returns a dict of index/label -> {'result': response or None, 'error': Exception or None} in the
+        order of queries, so it can be zipped against them; one invalid or failing query does not affect
+        the others. Identical queries are fetched once.
+        With fields each result is an AccountResult holding only those CCP properties.
+        """
+        if not self._certificatesLoaded:
+            raise Exception('ERROR: Certificates have not been loaded into the SSL context. Please call one of load_cert_from_local_path, load_cert_from_env_path, load_cert_from_path, or load_cert_from_env')
+
+        labelled = list(queries.items() if isinstance(queries, dict) else enumerate(queries))
+        results = {}
+        # Validate with the same rules as get_password and collapse identical queries
+        unique = {}
+        for label, query in labelled:
+            try:
+                var_filtered = self._build_params(**query)
+            except Exception as e:
+                results[label] = {'result': None, 'error': e}
+                continue
+            unique.setdefault(SecretCache.make_key(var_filtered), (var_filtered, []))[1].append(label)
+
+        def fetch(var_filtered):
+            try:
+                status_code, response = self._lookup(var_filtered)
+            except Exception as e:
+                return {'result': None, 'error': e}
+            if status_code != 200:
+                error = Exception('ERROR: CCP returned {} {}: {}'.format(status_code, response.get('ErrorCode'), response.get('ErrorMsg')))
+                return {'result': None, 'error': error}
+            return {'result': project(response, fields), 'error': None}
+
+        # Probe the service once for the whole batch rather than from every worker
+        if self._verify and unique:
+            try:
+                self._ensure_service()
+            except Exception as e:
+                for _, labels in unique.values():
+                    for label in labels:
+                        results[label] = {'result': None, 'error': e}
+                return {label: results[label] for label, _ in labelled}
+
+        from concurrent.futures import ThreadPoolExecutor
+        workers = max_concurrency or self._pool.stats()['maxsize']
+        entries = list(unique.values())
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(entries) or 1))) as executor:
+            outcomes = executor.map(lambda entry: fetch(entry[0]), entries)
+            for (_, labels), outcome in zip(entries, outcomes):
+                for label in labels:
+                    # Labels sharing a query share the result (and wipe() clears it for all of them)
+                    results[label] = outcome
+        # Failed validations and shared queries were filled in out of turn; hand back the caller's order
+        return {label: results[label] for label, _ in labelled}
 ##############################################################################################################  
 
@@ -0,0 +1,258 @@
+"""Benchmark the CCP clients against the local mutual-TLS stand-in.
+
+Drives CCPPasswordREST.get_password (threads), cyberark_cert_auth.get_passwords_async and
+cyberark_cert_auth_v2.get_password (threads) at several concurrency levels. rest-h2 and async-h2 run
+the first two over the HTTP/2 transport (needs the h2 package; the stand-in then offers h2 too). Reports throughput,
+p50/p95/p99 latency, TLS handshakes and resumptions per request, and process memory. Results are
+saved as JSON and can be compared against an earlier run:
+
+    python benchmarks/bench_clients.py --requests 200 --concurrency 1,8,32 --latency-ms 10
+    python benchmarks/bench_clients.py --clients rest,rest-h2,async,async-h2 --concurrency 32,128
+    python benchmarks/bench_clients.py --compare benchmarks/results/bench-<earlier>.json
+
+Every lookup asks for a different object, so request coalescing never hides work. Caches are off.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import functools
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from ccp_env import load_env  # noqa: E402
+from standin import StandInCCP  # noqa: E402
+
+CLIENTS = ('rest', 'async', 'v2')
+H2_CLIENTS = ('rest-h2', 'async-h2')
+# Settings from .env that would change what is being measured
+_NEUTRALISED_ENV = ('AAM_DISK_CACHE', 'AAM_SHARED_CACHE', 'AAM_HEDGE', 'AAM_BALANCE', 'AAM_METRICS', 'AAM_TRANSPORT')
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(0, int(round(pct / 100.0 * len(samples))) - 1))]
+
+
+def memory_kb():
+    """Return (current RSS, peak RSS) of this process in KiB where the platform exposes them."""
+    current = peak = None
+    try:
+        with open('/proc/self/statm') as file:
+            current = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return current, peak
+
+
+def _objects(client, concurrency, count):
+    return ['bench-{}-{}-{}'.format(client, concurrency, i) for i in range(count)]
+
+
+def run_rest(standin, objects, concurrency, transport=None):
+    from aam_python import CCPPasswordREST
+    ccp = CCPPasswordREST(base_uri=standin.host, pool_size=concurrency, transport=transport)
+    ccp.load_cert_from_path(standin.client_cert)
+
+    def one(name):
+        started = time.perf_counter()
+        try:
+            ok = 'ErrorCode' not in ccp.get_password(appid='bench', safe='Bench', objectName=name)
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(one, objects))
+    finally:
+        ccp.close()
+
+
+def run_async(standin, objects, concurrency, transport=None):
+    import cyberark_cert_auth
+    outcomes = []
+    original = cyberark_cert_auth._make_pool
+
+    # Time each request on the batch's pool, after the semaphore, so queueing behind the concurrency
+    # limit is not counted (the threaded runners only start their clock once a worker picks a lookup up)
+    def make_pool(*args, **kwargs):
+        pool = original(*args, **kwargs)
+        request = pool.request
+
+        async def timed(method, path, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = await request(method, path, **kwargs)
+            except Exception:
+                outcomes.append((time.perf_counter() - started, False))
+                raise
+            outcomes.append((time.perf_counter() - started, response.status == 200))
+            return response
+
+        pool.request = timed
+        return pool
+
+    cyberark_cert_auth._make_pool = make_pool
+    try:
+        asyncio.run(cyberark_cert_auth.get_passwords_async(objects, max_concurrent=concurrency, host=standin.host,
+                                                           app_id='bench', safe_name='Bench', cert_path=standin.client_cert,
+                                                           transport=transport))
+    except Exception:
+        pass
+    finally:
+        cyberark_cert_auth._make_pool = original
+    return outcomes
+
+
+def run_v2(standin, objects, concurrency):
+    import cyberark_cert_auth_v2
+
+    def one(name):
+        started = time.perf_counter()
+        try:
+            ok = cyberark_cert_auth_v2.get_password(name, host=standin.host, app_id='bench', safe_name='Bench',
+                                                    cert_path=standin.client_cert) is not None
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, objects))
+
+
+RUNNERS = {'rest': run_rest, 'async': run_async, 'v2': run_v2,
+           'rest-h2': functools.partial(run_rest, transport='h2'), 'async-h2': functools.partial(run_async, transport='h2')}
+
+
+def run_scenario(standin, client, concurrency, count):
+    standin.reset_stats()
+    objects = _objects(client, concurrency, count)
+    started = time.perf_counter()
+    outcomes = RUNNERS[client](standin, objects, concurrency)
+    elapsed = time.perf_counter() - started
+    server = standin.stats()
+    latencies = sorted(latency for latency, _ in outcomes)
+    errors = sum(1 for _, ok in outcomes if not ok) + (count - len(outcomes))
+    rss, peak = memory_kb()
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'client': client,
+        'concurrency': concurrency,
+        'requests': count,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput_rps': round(count / elapsed, 2) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'handshakes_per_request': round(server['handshakes'] / count, 4),
+        'h2_connections': server['h2_connections'],
+        'resumed_per_request': round(server['resumed'] / count, 4),
+        'server_requests': server['requests'],
+        'rss_kb': rss,
+        'max_rss_kb': peak,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, previous_path):
+    with open(previous_path) as file:
+        previous = {(r['client'], r['concurrency']): r for r in json.load(file)['results']}
+    print('\nvs {}'.format(previous_path))
+    for result in current:
+        old = previous.get((result['client'], result['concurrency']))
+        if old is None:
+            continue
+
+        def delta(name):
+            if not old.get(name) or result.get(name) is None:
+                return '   n/a'
+            return '{:+6.1f}%'.format((result[name] - old[name]) / old[name] * 100)
+
+        print('{:<6} c={:<4} throughput {}  p95 {}  p99 {}'.format(
+            result['client'], result['concurrency'], delta('throughput_rps'), delta('p95_ms'), delta('p99_ms')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', default=','.join(CLIENTS), help='comma-separated subset of {}'.format(','.join(CLIENTS + H2_CLIENTS)))
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='lookups per scenario')
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='result file (default: benchmarks/results/bench-<UTC time>.json)')
+    parser.add_argument('--compare', help='earlier result file to print deltas against')
+    parser.add_argument('--metrics', action='store_true', help='run with the per-phase latency hooks on (AAM_METRICS=true)')
+    args = parser.parse_args(argv)
+
+    load_env()
+    for name in _NEUTRALISED_ENV:
+        os.environ.pop(name, None)
+    if args.metrics:
+        os.environ['AAM_METRICS'] = 'true'
+
+    clients = [c for c in args.clients.split(',') if c]
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    unknown = [c for c in clients if c not in RUNNERS]
+    if unknown:
+        parser.error('unknown client(s): {}'.format(', '.join(unknown)))
+    standin = StandInCCP(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                         http2=any(c in H2_CLIENTS for c in clients)).start()
+    results = []
+    try:
+        for client in clients:
+            for concurrency in levels:
+                result = run_scenario(standin, client, concurrency, args.requests)
+                results.append(result)
+                print('{client:<6} c={concurrency:<4} {throughput_rps:>9.1f} req/s  p50 {p50_ms:>8.2f} ms  p95 {p95_ms:>8.2f} ms  '
+                      'p99 {p99_ms:>8.2f} ms  handshakes/req {handshakes_per_request:.3f}  errors {errors}'.format(**result))
+    finally:
+        standin.stop()
+
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'settings': {'requests': args.requests, 'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+                     'error_rate': args.error_rate, 'concurrency': levels, 'clients': clients, 'metrics': args.metrics},
+        'results': results,
+    }
+    output = args.output or os.path.join(BENCH_DIR, 'results', 'bench-{}.json'.format(
+        datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Saved {}'.format(output))
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
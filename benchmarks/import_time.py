@@ -0,0 +1,84 @@
+"""Import-time guard built on `python -X importtime`.
+
+Each module is imported in a fresh interpreter several times; the best cumulative time must stay
+under its budget, and none of the heavy optional dependencies may be loaded just by importing it.
+
+    python benchmarks/import_time.py [--runs N] [--scale X]
+
+Exits non-zero when a budget is exceeded or a forbidden module shows up. --scale multiplies every
+budget for slower machines.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (module, directory it is imported from, budget in ms)
+BUDGETS = [
+    ('ccp_cli', ROOT, 20),
+    ('ccp_env', ROOT, 20),
+    ('aam_python', ROOT, 100),
+    ('cyberark_cert_auth_v2', ROOT, 100),
+    ('cyberark_cert_auth', ROOT, 150),
+    ('ccp_proxy', ROOT, 150),
+    ('decrypt', os.path.join(ROOT, 'Salt'), 20),
+]
+
+# Loaded only by the code paths that need them, never by a plain import
+FORBIDDEN = {'keyring', 'pymongo', 'bcrypt', 'cryptography', 'dotenv', 'h2'}
+# The thread-based client has no business pulling in asyncio
+FORBIDDEN_SYNC = {'asyncio', 'concurrent.futures'}
+SYNC_MODULES = {'ccp_cli', 'ccp_env', 'aam_python', 'cyberark_cert_auth_v2', 'decrypt'}
+
+
+def measure(module, cwd):
+    """Return (cumulative import time in microseconds, set of every module imported)."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          cwd=cwd, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception('ERROR: importing {} failed:\n{}'.format(module, proc.stderr))
+    total = None
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            total = int(cumulative)
+    return total, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=float(os.getenv('IMPORT_BUDGET_SCALE', 1)))
+    args = parser.parse_args(argv)
+
+    failures = []
+    for module, cwd, budget_ms in BUDGETS:
+        best = None
+        for _ in range(args.runs):
+            total, imported = measure(module, cwd)
+            best = total if best is None else min(best, total)
+        budget_us = budget_ms * args.scale * 1000
+        forbidden = FORBIDDEN | (FORBIDDEN_SYNC if module in SYNC_MODULES else set())
+        leaked = sorted(forbidden & imported)
+        ok = best <= budget_us and not leaked
+        print('{:<24} {:>8.1f} ms  (budget {:>6.1f} ms){}{}'.format(
+            module, best / 1000, budget_us / 1000, '  imports ' + ', '.join(leaked) if leaked else '', '' if ok else '  FAIL'))
+        if not ok:
+            failures.append(module)
+
+    if failures:
+        print('Import-time guard failed for: {}'.format(', '.join(failures)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
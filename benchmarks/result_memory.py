@@ -0,0 +1,68 @@
+"""Per-entry memory of CCP lookup results: full response dicts versus AccountResult projections.
+
+Decodes N realistic Accounts responses (one json.loads each, as the clients do) and measures what
+keeping every result costs with tracemalloc.
+
+    python benchmarks/result_memory.py [--entries N]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ccp_account import ALL_FIELDS, AccountResult  # noqa: E402
+
+SCENARIOS = [
+    ('dict (full response)', None),
+    ('AccountResult, all fields', ALL_FIELDS),
+    ('AccountResult, Content+UserName', ('Content', 'UserName')),
+    ('AccountResult, Content only', ('Content',)),
+]
+
+
+def response_body(i):
+    """An Accounts response shaped like CCP's, with the usual platform properties."""
+    return json.dumps({
+        'Content': 'Pa55w0rd-{:08d}-xYz!'.format(i), 'UserName': 'svc_app_{:06d}'.format(i),
+        'Address': 'db{:03d}.corp.example.com'.format(i % 500), 'Database': 'orders', 'PolicyID': 'MSSQL-Rotate-30d',
+        'Folder': 'Root', 'Name': 'Database-MSSQL-db{:03d}-svc_app_{:06d}'.format(i % 500, i), 'Safe': 'AppSafe01',
+        'DeviceType': 'Database', 'LogonDomain': 'CORP', 'CreationMethod': 'PVWA', 'PasswordChangeInProcess': 'False',
+        'Port': '1433',
+    }).encode('utf-8')
+
+
+def measure(bodies, fields):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    if fields is None:
+        kept = [json.loads(body.decode('utf-8')) for body in bodies]
+    else:
+        kept = [AccountResult.from_response(json.loads(body.decode('utf-8')), fields) for body in bodies]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    bodies = [response_body(i) for i in range(args.entries)]
+    baseline = None
+    for label, fields in SCENARIOS:
+        per_entry = measure(bodies, fields) / args.entries
+        baseline = baseline or per_entry
+        print('{:<34} {:>7.0f} bytes/entry  ({:>5.1f}% of dict)'.format(label, per_entry, per_entry / baseline * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
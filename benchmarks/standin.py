@@ -0,0 +1,306 @@
+"""Local mutual-TLS stand-in for the CyberArk CCP (AIMWebService) used by the benchmarks.
+
+Generates a throwaway CA plus server and client certificates, requires the client certificate, and
+serves /AIMWebService/api/Accounts and /AIMWebService/v1.1/aim.asmx with configurable latency,
+jitter and error rate. With a capacity set, lookups beyond that many in flight are answered 429, as a
+throttling CCP would. With http2 set (needs the h2 package) it also offers HTTP/2 through ALPN and
+answers the streams of one connection concurrently. Counts requests, TLS handshakes, HTTP/2 connections
+and resumed sessions.
+
+    python benchmarks/standin.py --port 9443 --latency-ms 20 --error-rate 0.01 [--http2]
+
+prints the client certificate path to use (e.g. AAM_DEMO_PATH) and serves until interrupted.
+"""
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import random
+import select
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _json(status_code, body):
+    return status_code, json.dumps(body).encode('UTF-8'), 'application/json'
+
+
+def generate_certs(directory):
+    """Write ca.pem, server.pem/server.key and client.pem (key + cert, unencrypted) into directory."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def build(subject, issuer, public_key, signing_key, ca=False, san=None):
+        builder = (x509.CertificateBuilder()
+                   .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)]))
+                   .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer)]))
+                   .public_key(public_key)
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+        if san:
+            builder = builder.add_extension(x509.SubjectAlternativeName(san), critical=False)
+        return builder.sign(signing_key, hashes.SHA256())
+
+    def key_pem(key):
+        return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+    def cert_pem(cert):
+        return cert.public_bytes(serialization.Encoding.PEM)
+
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_cert = build('ccp-standin-ca', 'ccp-standin-ca', ca_key.public_key(), ca_key, ca=True)
+    server_key = ec.generate_private_key(ec.SECP256R1())
+    server_cert = build('localhost', 'ccp-standin-ca', server_key.public_key(), ca_key,
+                        san=[x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))])
+    client_key = ec.generate_private_key(ec.SECP256R1())
+    client_cert = build('ccp-standin-client', 'ccp-standin-ca', client_key.public_key(), ca_key)
+
+    paths = {name: os.path.join(directory, name) for name in ('ca.pem', 'server.pem', 'server.key', 'client.pem')}
+    files = {'ca.pem': cert_pem(ca_cert), 'server.pem': cert_pem(server_cert), 'server.key': key_pem(server_key),
+             'client.pem': key_pem(client_key) + cert_pem(client_cert)}
+    for name, data in files.items():
+        with open(paths[name], 'wb') as file:
+            file.write(data)
+    return paths
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CCPStandIn'
+    # Headers and body leave in one segment (flushed per request); otherwise Nagle + delayed ACK add ~40 ms
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._send(*self.server.standin.respond(self.path))
+
+    def _send(self, status_code, body, content_type):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 drops SYNs under a burst of new connections (1 s retransmits)
+    request_queue_size = 128
+
+    def finish_request(self, request, client_address):
+        # Handshake per connection in the worker thread so handshakes and resumptions can be counted
+        try:
+            tls = self.standin.context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError):
+            self.standin._count('rejected')
+            return
+        self.standin._count('handshakes')
+        if tls.session_reused:
+            self.standin._count('resumed')
+        try:
+            if tls.selected_alpn_protocol() == 'h2':
+                self.standin._count('h2_connections')
+                _serve_h2(self.standin, tls)
+            else:
+                ThreadingHTTPServer.finish_request(self, tls, client_address)
+        finally:
+            tls.close()
+
+
+def _serve_h2(standin, tls):
+    """Answer the streams of one HTTP/2 connection concurrently, one thread per request.
+
+    Only this thread touches the socket: answering threads queue their response and wake it up.
+    """
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+    conn.initiate_connection()
+    lock = threading.Lock()
+    answers = []
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+
+    def answer(stream_id, path):
+        response = standin.respond(path)
+        with lock:
+            answers.append((stream_id, response))
+        try:
+            wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    try:
+        while True:
+            with lock:
+                for stream_id, (status_code, body, content_type) in answers:
+                    try:
+                        conn.send_headers(stream_id, [(':status', str(status_code)), ('content-type', content_type),
+                                                      ('content-length', str(len(body)))])
+                        conn.send_data(stream_id, body, end_stream=True)
+                    except h2.exceptions.StreamClosedError:
+                        # The client reset the stream (timeout or losing hedge)
+                        pass
+                del answers[:]
+                data = conn.data_to_send()
+            if data:
+                tls.sendall(data)
+            if not tls.pending():
+                readable, _, _ = select.select([tls, wake_r], [], [])
+                if wake_r in readable:
+                    try:
+                        while wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                if tls not in readable:
+                    continue
+            data = tls.recv(65536)
+            if not data:
+                break
+            with lock:
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        path = dict(event.headers).get(':path', '/')
+                        threading.Thread(target=answer, args=(event.stream_id, path), daemon=True).start()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+    except (OSError, h2.exceptions.ProtocolError):
+        pass
+    finally:
+        wake_r.close()
+        wake_w.close()
+
+
+class StandInCCP(object):
+    """In-process mutual-TLS CCP stand-in; start() returns once it is listening on 127.0.0.1:port."""
+
+    def __init__(self, port=0, latency_ms=0, jitter_ms=0, error_rate=0.0, cert_dir=None, capacity=None, http2=False):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self._in_flight = 0
+        self._tmp = None if cert_dir else tempfile.TemporaryDirectory(prefix='ccp-standin-')
+        self.certs = generate_certs(cert_dir or self._tmp.name)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(self.certs['server.pem'], self.certs['server.key'])
+        self.context.verify_mode = ssl.CERT_REQUIRED
+        self.context.load_verify_locations(self.certs['ca.pem'])
+        if http2:
+            # Clients that offer no ALPN (or only http/1.1) still get HTTP/1.1
+            self.context.set_alpn_protocols(['h2', 'http/1.1'])
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.standin = self
+        self.port = self._server.server_address[1]
+        self.host = '127.0.0.1:{}'.format(self.port)
+        self.client_cert = self.certs['client.pem']
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset_stats()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _admit(self):
+        with self._lock:
+            if self.capacity is not None and self._in_flight >= self.capacity:
+                return False
+            self._in_flight += 1
+            self._stats['peak_in_flight'] = max(self._stats['peak_in_flight'], self._in_flight)
+            return True
+
+    def _leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def respond(self, target):
+        """Return (status, body, content type) for a GET of target, after the configured latency."""
+        path, _, query = target.partition('?')
+        self._count('requests')
+        if path == '/AIMWebService/api/Accounts' and not self._admit():
+            self._count('throttled')
+            return _json(429, {'ErrorCode': 'APPAP429E', 'ErrorMsg': 'Too many requests'})
+        try:
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                time.sleep(delay)
+            if path == '/AIMWebService/v1.1/aim.asmx':
+                return 200, b'<html>AIMWebService</html>', 'text/html'
+            if path != '/AIMWebService/api/Accounts':
+                return _json(404, {'ErrorCode': 'APPAP404E', 'ErrorMsg': 'Not found'})
+            if random.random() < self.error_rate:
+                self._count('errors')
+                return _json(500, {'ErrorCode': 'APPAP282E', 'ErrorMsg': 'Injected stand-in error'})
+            params = dict(urllib.parse.parse_qsl(query))
+            return _json(200, {'Content': 'standin-secret', 'UserName': 'standin',
+                               'Safe': params.get('safe') or params.get('Query', ''), 'PolicyID': 'standin'})
+        finally:
+            if path == '/AIMWebService/api/Accounts':
+                self._leave()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'handshakes': 0, 'resumed': 0, 'rejected': 0,
+                           'h2_connections': 0, 'peak_in_flight': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='ccp-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=9443)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--cert-dir', help='write the generated certs here instead of a temporary directory')
+    parser.add_argument('--capacity', type=int, help='answer 429 beyond this many lookups in flight')
+    parser.add_argument('--http2', action='store_true', help='also offer HTTP/2 (needs the h2 package)')
+    args = parser.parse_args(argv)
+    standin = StandInCCP(args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.cert_dir, args.capacity, args.http2).start()
+    print('CCP stand-in on https://{}  client cert: {}'.format(standin.host, standin.client_cert), file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(standin.stats()), file=sys.stderr)
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
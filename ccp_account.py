@@ -0,0 +1,121 @@
+# CCP account property -> AccountResult attribute; Content is held separately as a wipeable buffer
+PROPERTIES = {
+    'UserName': 'username',
+    'Address': 'address',
+    'Database': 'database',
+    'PolicyID': 'policy_id',
+    'Folder': 'folder',
+    'Name': 'name',
+    'Safe': 'safe',
+    'DeviceType': 'device_type',
+    'LogonDomain': 'logon_domain',
+    'CreationMethod': 'creation_method',
+    'PasswordChangeInProcess': 'password_change_in_process',
+}
+# Always kept so a projected result still explains a failed lookup
+ERROR_PROPERTIES = {'ErrorCode': 'error_code', 'ErrorMsg': 'error_msg'}
+ALL_FIELDS = ('Content',) + tuple(PROPERTIES)
+
+
+def _wipe(buf):
+    buf[:] = bytes(len(buf))
+
+
+class AccountResult(object):
+    """Compact CCP account: only the projected properties, with the password in a wipeable bytearray.
+
+    Attributes are the snake_case property names (username, address, policy_id, ...) and None when
+    not requested or not returned; other requested properties land in extra. result['UserName'] and
+    result.get('Content') work as on the response dict. wipe() zeroes the password in place.
+    """
+
+    __slots__ = ('_secret',) + tuple(PROPERTIES.values()) + tuple(ERROR_PROPERTIES.values()) + ('extra',)
+
+    def __init__(self, content=None, extra=None, **properties):
+        self._secret = bytearray(content.encode('utf-8')) if content is not None else None
+        for attribute in PROPERTIES.values():
+            setattr(self, attribute, properties.pop(attribute, None))
+        for attribute in ERROR_PROPERTIES.values():
+            setattr(self, attribute, properties.pop(attribute, None))
+        if properties:
+            raise TypeError('ERROR: Unknown account attributes: {}'.format(', '.join(sorted(properties))))
+        self.extra = extra or None
+
+    @classmethod
+    def from_response(cls, response, fields=ALL_FIELDS):
+        """Keep only fields (CCP property names, e.g. ('Content', 'UserName')) of a decoded CCP response."""
+        if isinstance(fields, str):
+            fields = (fields,)
+        properties = {}
+        extra = {}
+        for field in fields:
+            value = response.get(field)
+            if value is None or field == 'Content':
+                continue
+            if field in PROPERTIES:
+                properties[PROPERTIES[field]] = value
+            else:
+                extra[field] = value
+        for field, attribute in ERROR_PROPERTIES.items():
+            if field in response:
+                properties[attribute] = response[field]
+        return cls(content=response.get('Content') if 'Content' in fields else None, extra=extra, **properties)
+
+    @property
+    def content(self):
+        """The password as a new str (which cannot be wiped), or None."""
+        return self._secret.decode('utf-8') if self._secret is not None else None
+
+    @property
+    def content_bytes(self):
+        """A bytes copy of the password, or None."""
+        return bytes(self._secret) if self._secret is not None else None
+
+    def wipe(self):
+        """Zero the password buffer and drop it."""
+        if self._secret is not None:
+            _wipe(self._secret)
+            self._secret = None
+
+    def __del__(self):
+        # Dropped results (cache eviction, end of a batch) zero the password before the buffer is freed
+        if getattr(self, '_secret', None) is not None:
+            _wipe(self._secret)
+
+    def get(self, field, default=None):
+        if field == 'Content':
+            value = self.content
+        elif field in PROPERTIES:
+            value = getattr(self, PROPERTIES[field])
+        elif field in ERROR_PROPERTIES:
+            value = getattr(self, ERROR_PROPERTIES[field])
+        else:
+            value = (self.extra or {}).get(field)
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def to_dict(self):
+        """The kept properties as a CCP-style dict (includes the password)."""
+        fields = ('Content',) + tuple(PROPERTIES) + tuple(ERROR_PROPERTIES) + tuple(self.extra or ())
+        return {field: self.get(field) for field in fields if self.get(field) is not None}
+
+    def __repr__(self):
+        # The password is never part of the repr
+        kept = ', '.join('{}={!r}'.format(field, value) for field, value in self.to_dict().items() if field != 'Content')
+        secret = ', Content=<hidden>' if self._secret is not None else ''
+        return 'AccountResult({}{})'.format(kept, secret) if kept else 'AccountResult({})'.format(secret.lstrip(', '))
+
+
+def project(response, fields):
+    """Return response unchanged when fields is None, else an AccountResult holding only fields."""
+    if fields is None:
+        return response
+    return AccountResult.from_response(response, fields)
@@ -0,0 +1,345 @@
+import asyncio
+import socket
+import time
+import urllib.parse
+from collections import deque
+
+
+def split_host(host, default_port=443):
+    """Split 'host[:port]' (with or without https://) into (hostname, port)."""
+    parts = urllib.parse.urlsplit('//' + host.replace('https://', '').rstrip('/'))
+    return parts.hostname, parts.port or default_port
+
+
+class AsyncResponse(object):
+    """Minimal HTTP/1.1 response: status, lower-cased headers and the full body."""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def will_close(self):
+        return self.headers.get('connection', '').lower() == 'close'
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('ERROR: Connection closed by CCP before a response was received.')
+    version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    if not version.startswith('HTTP/1.'):
+        raise Exception('ERROR: Malformed HTTP status line: {!r}'.format(status_line))
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the terminating blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        # No framing: the body runs until the server closes the connection
+        body = await reader.read()
+        headers['connection'] = 'close'
+    return AsyncResponse(int(status), reason, headers, body)
+
+
+class AsyncHTTPSConnectionPool(object):
+    """Pool of keep-alive asyncio TLS streams to one host; connections cost file descriptors, not threads."""
+
+    def __init__(self, host, context, maxsize=100, idle_timeout=60, timeout=30, connect_timeout=None):
+        # Declare Init Variables
+        self._hostname, self._port = split_host(host)
+        self._host_header = host.replace('https://', '').rstrip('/')
+        self._context = context
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxsize)
+        self._maxsize = maxsize
+        self._stats = {'created': 0, 'reused': 0, 'evicted_idle': 0, 'dropped': 0, 'retried': 0, 'timeouts': 0}
+
+    async def _acquire(self, timer=None):
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if now - last_used > self._idle_timeout:
+                writer.close()
+                self._stats['evicted_idle'] += 1
+                continue
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                self._stats['dropped'] += 1
+                continue
+            self._stats['reused'] += 1
+            return reader, writer, True
+        reader, writer = await self._connect(timer)
+        self._stats['created'] += 1
+        return reader, writer, False
+
+    async def _connect(self, timer=None):
+        # TCP + TLS setup is bounded separately so an unreachable node fails fast
+        if timer is not None:
+            opening = self._open_timed(timer)
+        else:
+            opening = asyncio.open_connection(self._hostname, self._port, ssl=self._context, server_hostname=self._hostname)
+        try:
+            return await asyncio.wait_for(opening, self._connect_timeout)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            raise Exception('ERROR: Connecting to CCP at {} timed out after {} seconds.'.format(self._host_header, self._connect_timeout))
+
+    async def _open_timed(self, timer):
+        # open_connection split into resolve, TCP connect and TLS handshake so each can be marked
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(self._hostname, self._port, type=socket.SOCK_STREAM)
+        timer.mark('dns')
+        error = OSError('ERROR: {} did not resolve to any address.'.format(self._hostname))
+        for family, type_, proto, _, address in infos:
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            timer.mark('connect')
+            try:
+                reader, writer = await asyncio.open_connection(sock=sock, ssl=self._context, server_hostname=self._hostname)
+            except BaseException:
+                sock.close()
+                raise
+            timer.mark('tls')
+            return reader, writer
+        raise error
+
+    async def _exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        return await _read_response(reader)
+
+    async def request(self, method, path, headers=None, timeout=None, timer=None):
+        """Send a request over a pooled connection and return an AsyncResponse.
+
+        timer (a ccp_metrics.PhaseTimer) gets queue, dns/connect/tls (new connections only) and server marks.
+        """
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(self._host_header), 'Connection: keep-alive']
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        timeout = self._timeout if timeout is None else timeout
+
+        async with self._slots:
+            if timer is not None:
+                timer.mark('queue')
+            reader, writer, reused = await self._acquire(timer)
+            try:
+                try:
+                    response = await asyncio.wait_for(self._exchange(reader, writer, request), timeout)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    # A kept-alive stream the server closed while idle; retry once on a fresh one
+                    if not reused:
+                        raise
+                    writer.close()
+                    self._stats['retried'] += 1
+                    reader, writer = await self._connect(timer)
+                    self._stats['created'] += 1
+                    response = await asyncio.wait_for(self._exchange(reader, writer, request), timeout)
+            except asyncio.TimeoutError:
+                writer.close()
+                self._stats['timeouts'] += 1
+                raise Exception('ERROR: CCP request to {} timed out after {} seconds.'.format(self._host_header, timeout))
+            except BaseException:
+                writer.close()
+                raise
+            if timer is not None:
+                timer.mark('server')
+            if response.will_close:
+                writer.close()
+            else:
+                self._idle.append((reader, writer, time.monotonic()))
+            return response
+
+    def stats(self):
+        """Return a snapshot of pool counters."""
+        snapshot = dict(self._stats)
+        snapshot['idle'] = len(self._idle)
+        snapshot['maxsize'] = self._maxsize
+        return snapshot
+
+    async def close(self):
+        """Close every idle stream."""
+        while self._idle:
+            _, writer, _ = self._idle.popleft()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+
+class AsyncH2ConnectionPool(AsyncHTTPSConnectionPool):
+    """AsyncHTTPSConnectionPool look-alike multiplexing up to maxsize requests over one HTTP/2 connection.
+
+    A reader task feeds the connection's ccp_h2.H2Session; a request that times out or is cancelled
+    (e.g. a losing hedge) resets its stream so CCP can stop working on it.
+    """
+
+    ALPN = ('h2',)
+
+    def __init__(self, host, context, maxsize=100, idle_timeout=60, timeout=30, connect_timeout=None):
+        from ccp_h2 import require_h2
+        require_h2()
+        AsyncHTTPSConnectionPool.__init__(self, host, context, maxsize=maxsize, idle_timeout=idle_timeout,
+                                          timeout=timeout, connect_timeout=connect_timeout)
+        self._current = None
+        self._connect_lock = asyncio.Lock()
+        self._freed = asyncio.Event()
+        self._stats.update(discarded=0, peak_streams=0)
+
+    async def _session(self, timer=None):
+        from ccp_h2 import H2Session
+        # One caller connects while the rest wait for it rather than opening connections of their own
+        async with self._connect_lock:
+            if self._current is not None:
+                session, writer = self._current
+                if not session.usable() or writer.is_closing():
+                    self._retire('dropped')
+                elif not session.streams and time.monotonic() - session.last_used > self._idle_timeout:
+                    self._retire('evicted_idle')
+                else:
+                    self._stats['reused'] += 1
+                    return session, writer, True
+            reader, writer = await self._connect(timer)
+            protocol = writer.get_extra_info('ssl_object').selected_alpn_protocol()
+            if protocol != 'h2':
+                writer.close()
+                raise Exception('ERROR: {} did not negotiate HTTP/2 (ALPN: {}); use the http1 transport.'.format(self._host_header, protocol))
+            session = H2Session(self._host_header)
+            writer.write(session.data_to_send())
+            asyncio.ensure_future(self._read_loop(session, reader, writer))
+            self._current = (session, writer)
+            self._stats['created'] += 1
+            return session, writer, False
+
+    def _retire(self, counter):
+        session, writer = self._current
+        self._current = None
+        self._stats[counter] += 1
+        if not session.streams:
+            writer.close()
+
+    async def _read_loop(self, session, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    raise ConnectionResetError('ERROR: CCP closed the HTTP/2 connection.')
+                if session.receive(data):
+                    self._freed.set()
+                out = session.data_to_send()
+                if out:
+                    writer.write(out)
+                # A retired connection closes once its last stream is answered
+                if (self._current is None or self._current[0] is not session) and not session.streams:
+                    break
+        except Exception as e:
+            session.fail(e)
+            self._freed.set()
+        finally:
+            writer.close()
+
+    async def _exchange(self, session, writer, method, path, headers, timeout):
+        while session.usable() and len(session.streams) >= session.max_streams(self._maxsize):
+            # The server allows fewer concurrent streams than maxsize
+            self._freed.clear()
+            await self._freed.wait()
+        if not session.usable():
+            raise ConnectionResetError('ERROR: The HTTP/2 connection to {} was lost.'.format(self._host_header))
+        future = asyncio.get_running_loop().create_future()
+        stream_id, stream = session.open_stream(method, path, headers, lambda: future.done() or future.set_result(None))
+        self._stats['peak_streams'] = max(self._stats['peak_streams'], len(session.streams))
+        writer.write(session.data_to_send())
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            session.cancel(stream_id)
+            if not writer.is_closing():
+                writer.write(session.data_to_send())
+            raise
+        if stream.error is not None:
+            raise stream.error
+        return AsyncResponse(stream.status, '', stream.headers, b''.join(stream.body))
+
+    async def request(self, method, path, headers=None, timeout=None, timer=None):
+        """Send a request as one stream on the shared connection and return an AsyncResponse.
+
+        timer (a ccp_metrics.PhaseTimer) gets queue, dns/connect/tls (new connections only) and server marks.
+        """
+        headers = headers or {}
+        timeout = self._timeout if timeout is None else timeout
+        async with self._slots:
+            if timer is not None:
+                timer.mark('queue')
+            session, writer, reused = await self._session(timer)
+            try:
+                try:
+                    response = await self._exchange(session, writer, method, path, headers, timeout)
+                except ConnectionError:
+                    # The connection died or went away before answering: retry once on a fresh one
+                    if not reused:
+                        raise
+                    self._stats['retried'] += 1
+                    session, writer, _ = await self._session(timer)
+                    response = await self._exchange(session, writer, method, path, headers, timeout)
+            except asyncio.TimeoutError:
+                self._stats['timeouts'] += 1
+                raise Exception('ERROR: CCP request to {} timed out after {} seconds.'.format(self._host_header, timeout))
+            if timer is not None:
+                timer.mark('server')
+            return response
+
+    def stats(self):
+        """Return a snapshot of connection and stream counters."""
+        snapshot = dict(self._stats)
+        snapshot['idle'] = 1 if self._current is not None and not self._current[0].streams else 0
+        snapshot['in_flight'] = len(self._current[0].streams) if self._current is not None else 0
+        snapshot['maxsize'] = self._maxsize
+        return snapshot
+
+    async def close(self):
+        """Close the connection once the streams in flight are answered."""
+        if self._current is not None:
+            session, writer = self._current
+            self._current = None
+            if not session.streams:
+                session.conn.close_connection()
+                writer.write(session.data_to_send())
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+import ccp_fork
+
+
+def _wipe(buf):
+    # Overwrite the cached bytes in place so the secret does not linger in freed memory
+    buf[:] = bytes(len(buf))
+
+
+class _Entry(object):
+    __slots__ = ('buf', 'expires_at', 'refresh_at', 'last_access')
+
+    def __init__(self, buf, expires_at, refresh_at, last_access):
+        self.buf = buf
+        self.expires_at = expires_at
+        self.refresh_at = refresh_at
+        self.last_access = last_access
+
+
+class SecretCache(object):
+    """Thread-safe TTL + LRU cache of raw CCP response bodies, wiped on eviction.
+
+    With refresh_ahead set, entries become due for background renewal at that fraction of
+    their TTL (+/- jitter). With stale_ttl set, an expired entry is kept that many extra
+    seconds so get_stale() can serve it while CCP is unavailable.
+    """
+
+    def __init__(self, ttl=300, max_entries=1024, refresh_ahead=None, refresh_jitter=0.1, stale_ttl=0):
+        # Declare Init Variables
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._refresh_ahead = refresh_ahead
+        self._refresh_jitter = refresh_jitter
+        self._stale_ttl = stale_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0, 'stale_served': 0}
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # Entries stay valid in the child; only the lock may have been held by a vanished parent thread
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(params):
+        """Build a hashable key from the filtered parameter dict get_password sends to CCP."""
+        return tuple(sorted(params.items()))
+
+    def _drop(self, key, entry, counter):
+        del self._entries[key]
+        _wipe(entry.buf)
+        self._stats[counter] += 1
+
+    def get(self, key):
+        """Return a bytes copy of the cached body, or None on a miss or expired entry."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if now >= entry.expires_at:
+                # Expired entries stay (unreadable here) until the stale window closes
+                if now >= entry.expires_at + self._stale_ttl:
+                    self._drop(key, entry, 'expired')
+                self._stats['misses'] += 1
+                return None
+            entry.last_access = now
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return bytes(entry.buf)
+
+    def get_stale(self, key):
+        """Return the last good body for key if it is still inside its stale window, else None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now >= entry.expires_at + self._stale_ttl:
+                self._drop(key, entry, 'expired')
+                return None
+            entry.last_access = now
+            self._stats['stale_served'] += 1
+            return bytes(entry.buf)
+
+    def put(self, key, data, ttl=None):
+        """Store a response body under key for ttl seconds (default: the cache TTL)."""
+        now = time.monotonic()
+        ttl = self._ttl if ttl is None else ttl
+        refresh_at = None
+        if self._refresh_ahead:
+            jitter = 1 + random.uniform(-self._refresh_jitter, self._refresh_jitter)
+            refresh_at = now + ttl * self._refresh_ahead * jitter
+        with self._lock:
+            old = self._entries.pop(key, None)
+            last_access = now
+            if old is not None:
+                # A background refresh must not make an entry look recently read
+                last_access = old.last_access
+                _wipe(old.buf)
+            self._entries[key] = _Entry(bytearray(data), now + ttl, refresh_at, last_access)
+            while len(self._entries) > self._max_entries:
+                _, entry = self._entries.popitem(last=False)
+                _wipe(entry.buf)
+                self._stats['evicted'] += 1
+
+    def due_for_refresh(self, idle_window):
+        """Return keys whose refresh time has passed and that were read within idle_window seconds."""
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, entry in self._entries.items()
+                    if entry.refresh_at is not None and entry.refresh_at <= now
+                    and now - entry.last_access <= idle_window
+                    and now < entry.expires_at + self._stale_ttl]
+
+    def postpone_refresh(self, key, delay):
+        """Push an entry's next refresh attempt back by delay seconds (after a failed refresh)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refresh_at = time.monotonic() + delay
+
+    def invalidate(self, key):
+        """Drop and wipe a single entry; returns True if it was cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            self._drop(key, entry, 'invalidated')
+            return True
+
+    def clear(self):
+        """Drop and wipe every entry."""
+        with self._lock:
+            while self._entries:
+                _, entry = self._entries.popitem()
+                _wipe(entry.buf)
+                self._stats['invalidated'] += 1
+
+    def stats(self):
+        """Return a snapshot of hit/miss/eviction counters."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['entries'] = len(self._entries)
+            snapshot['max_entries'] = self._max_entries
+        return snapshot
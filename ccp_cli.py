@@ -0,0 +1,52 @@
+import sys
+
+USAGE = """usage: ccp <command> [args...]
+
+commands:
+  get                      look up the account described by the AAM_* variables in .env
+  bulk <object> [...]      fetch several objects concurrently (async client)
+  bulk --stream [--input FILE]
+                           stream object names / JSON records in, NDJSON results out
+  proxy [options]          run the local caching CCP proxy (see: ccp proxy --help)
+  watch [options]          poll objects and report password rotations (see: ccp watch --help)
+"""
+
+
+# Each command imports its implementation only when it runs, so `ccp` startup stays cheap
+def _get(argv):
+    from aam_python_v2 import main
+    return main()
+
+
+def _bulk(argv):
+    from cyberark_cert_auth import main
+    return main(argv)
+
+
+def _proxy(argv):
+    from ccp_proxy import main
+    return main(argv)
+
+
+def _watch(argv):
+    from ccp_watch import main
+    return main(argv)
+
+
+COMMANDS = {'get': _get, 'bulk': _bulk, 'proxy': _proxy, 'watch': _watch}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(USAGE, end='')
+        return 0 if argv else 1
+    command = COMMANDS.get(argv[0])
+    if command is None:
+        print('ccp: unknown command {!r}\n'.format(argv[0]) + USAGE, end='', file=sys.stderr)
+        return 2
+    return command(argv[1:]) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+import ccp_fork
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks (Windows): writes are still atomic, concurrent writers may drop each other's entries
+    fcntl = None
+
+
+class DiskSecretCache(object):
+    """Fernet-encrypted, file-backed cache of raw CCP response bodies shared by short-lived processes.
+
+    Every body is encrypted with ENCRYPTION_KEY (the Salt tools' key) and stored with a wall-clock
+    expiry under an HMAC of its lookup key, so object names are not readable from the file either.
+    Writes are merged under an exclusive lock and land via an atomic rename. With autoflush=False,
+    put() only buffers and flush() writes everything in one pass (one rewrite per CLI run).
+    """
+
+    def __init__(self, path, key=None, ttl=300, autoflush=True):
+        # Declare Init Variables
+        key = key or os.getenv('ENCRYPTION_KEY')
+        if not key:
+            raise Exception('ERROR: ENCRYPTION_KEY is required to use the on-disk secret cache.')
+        self._key = key.encode('UTF-8') if isinstance(key, str) else key
+        self._fernet = None
+        self._path = os.path.abspath(path)
+        self._ttl = ttl
+        self._autoflush = autoflush
+        self._entries = {}
+        self._signature = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'undecryptable': 0, 'writes': 0}
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _cipher(self):
+        # cryptography is only imported once the cache is actually used
+        if self._fernet is None:
+            from cryptography.fernet import Fernet
+            self._fernet = Fernet(self._key)
+        return self._fernet
+
+    def _name(self, key):
+        return hmac.new(self._key, json.dumps(key).encode('UTF-8'), hashlib.sha256).hexdigest()
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _read(self):
+        try:
+            with open(self._path, 'r') as file:
+                return json.load(file).get('entries', {})
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # A corrupt file is treated as empty and replaced on the next write
+            return {}
+
+    def _locked(self, exclusive):
+        lock = open(self._path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock
+
+    def _reload(self):
+        # Re-read only when another process (or we) replaced the file since the last read
+        signature = self._file_signature()
+        if signature is not None and signature == self._signature:
+            return
+        if signature is None:
+            self._entries, self._signature = {}, None
+            return
+        lock = self._locked(exclusive=False)
+        try:
+            self._signature = self._file_signature()
+            self._entries = self._read()
+        finally:
+            lock.close()
+
+    def get_with_ttl(self, key):
+        """Return (body bytes, seconds left) for a live entry, or (None, 0) on a miss."""
+        name = self._name(key)
+        with self._lock:
+            pending = self._pending.get(name)
+            if pending is None:
+                self._reload()
+            entry = pending or self._entries.get(name)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None, 0
+            expires_at, token = entry
+            remaining = expires_at - time.time()
+            if remaining <= 0:
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None, 0
+        try:
+            data = self._cipher().decrypt(token.encode('ascii'))
+        except Exception:
+            # Written under a different ENCRYPTION_KEY or tampered with
+            with self._lock:
+                self._stats['undecryptable'] += 1
+                self._stats['misses'] += 1
+            return None, 0
+        with self._lock:
+            self._stats['hits'] += 1
+        return data, remaining
+
+    def get(self, key):
+        """Return the cached body for key, or None on a miss or expired entry."""
+        return self.get_with_ttl(key)[0]
+
+    def put(self, key, data, ttl=None):
+        """Encrypt and store a body under key for ttl seconds (default: the cache TTL)."""
+        expires_at = time.time() + (self._ttl if ttl is None else ttl)
+        token = self._cipher().encrypt(bytes(data)).decode('ascii')
+        with self._lock:
+            self._pending[self._name(key)] = [expires_at, token]
+        if self._autoflush:
+            self.flush()
+
+    def invalidate(self, key):
+        """Drop one entry from the file; returns True if it was there."""
+        name = self._name(key)
+        with self._lock:
+            self._pending.pop(name, None)
+            return self._write(remove=(name,))
+
+    def clear(self):
+        """Remove every entry (and the file)."""
+        with self._lock:
+            self._pending.clear()
+            lock = self._locked(exclusive=True)
+            try:
+                if os.path.exists(self._path):
+                    os.remove(self._path)
+                self._entries, self._signature = {}, None
+            finally:
+                lock.close()
+
+    def flush(self):
+        """Merge buffered puts into the file (dropping expired entries) with one atomic rewrite."""
+        with self._lock:
+            if self._pending:
+                self._write()
+
+    def _write(self, remove=()):
+        lock = self._locked(exclusive=True)
+        try:
+            # Merge with whatever concurrent runs wrote since we last read the file
+            entries = self._read()
+            removed = False
+            for name in remove:
+                removed = entries.pop(name, None) is not None or removed
+            entries.update(self._pending)
+            now = time.time()
+            entries = {name: entry for name, entry in entries.items() if entry[0] > now}
+            directory = os.path.dirname(self._path)
+            # mkstemp creates the file 0600, so the encrypted entries are never world-readable
+            fd, tmp_path = tempfile.mkstemp(prefix='.ccp-cache-', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump({'version': 1, 'entries': entries}, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self._path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._entries = entries
+            self._signature = self._file_signature()
+            self._pending.clear()
+            self._stats['writes'] += 1
+            return removed
+        finally:
+            lock.close()
+
+    def stats(self):
+        """Return a snapshot of hit/miss/write counters."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['entries'] = len(self._entries)
+            snapshot['pending'] = len(self._pending)
+        return snapshot
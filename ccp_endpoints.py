@@ -0,0 +1,341 @@
+import random
+import threading
+import time
+from collections import deque
+import ccp_fork
+from ccp_metrics import outcome_for
+from ccp_transport import pool_class, resolve_transport
+
+
+def split_endpoints(value):
+    """Turn 'a,b' / ['https://a/', 'b'] into a list of bare 'host[:port]' strings."""
+    items = value.split(',') if isinstance(value, str) else list(value)
+    hosts = [item.strip().replace('https://', '').rstrip('/') for item in items if item and item.strip()]
+    if not hosts:
+        raise Exception('ERROR: At least one CCP endpoint (AAM_BASE_URI) is required.')
+    return hosts
+
+
+BALANCE_POLICIES = ('ordered', 'ewma', 'p2c')
+
+
+class _Endpoint(object):
+    """One CCP node: its pool, recent latencies (p95 hedge delay, EWMA for balancing), load and failure backoff."""
+
+    def __init__(self, host, pool, latency_samples):
+        self.host = host
+        self.pool = pool
+        self.latencies = deque(maxlen=latency_samples)
+        self.ewma = None
+        self.in_flight = 0
+        self.down_until = 0.0
+        self.stats = {'requests': 0, 'failures': 0, 'chosen': 0}
+
+    def score(self):
+        # Expected wait if we queue behind what is already in flight; unmeasured nodes score 0 so they get probed
+        return (self.ewma or 0.0) * (self.in_flight + 1)
+
+    def p95(self):
+        samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def snapshot(self, now):
+        p95 = self.p95()
+        return dict(self.stats, host=self.host, healthy=now >= self.down_until, in_flight=self.in_flight,
+                    ewma_ms=None if self.ewma is None else round(self.ewma * 1000, 2),
+                    p95_ms=None if p95 is None else round(p95 * 1000, 2), samples=len(self.latencies))
+
+
+class _EndpointSet(object):
+    """Health, ordering, balancing and hedge-delay bookkeeping shared by the sync and asyncio failover pools.
+
+    balance picks the node each request tries first: 'ordered' (configured order, failover only),
+    'ewma' (lowest EWMA latency x in-flight score) or 'p2c' (the better of two random healthy nodes).
+    The remaining healthy nodes follow as failover targets, then nodes in their failure backoff.
+    """
+
+    def __init__(self, endpoints, failure_ttl, hedge, hedge_delay, min_samples, balance='ordered', ewma_alpha=0.3):
+        if balance not in BALANCE_POLICIES:
+            raise Exception('ERROR: Unknown balance policy {!r}; expected one of {}.'.format(balance, ', '.join(BALANCE_POLICIES)))
+        self._endpoints = endpoints
+        self._failure_ttl = failure_ttl
+        self._hedge = hedge
+        self._hedge_delay = hedge_delay
+        self._min_samples = min_samples
+        self._balance = balance
+        self._ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._stats = {'failovers': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def _order(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [ep for ep in self._endpoints if now >= ep.down_until]
+            down = [ep for ep in self._endpoints if now < ep.down_until]
+            if self._balance != 'ordered' and len(healthy) > 1:
+                if self._balance == 'p2c':
+                    first = min(random.sample(healthy, 2), key=_Endpoint.score)
+                    healthy.remove(first)
+                    healthy = [first] + sorted(healthy, key=_Endpoint.score)
+                else:
+                    healthy.sort(key=_Endpoint.score)
+            order = healthy + down
+            order[0].stats['chosen'] += 1
+            return order
+
+    def _delay(self, endpoint):
+        # Hedge once the first node is slower than its own recent p95
+        with self._lock:
+            if len(endpoint.latencies) < self._min_samples:
+                return self._hedge_delay
+            return max(endpoint.p95(), 0.001)
+
+    def _begin(self, endpoint):
+        with self._lock:
+            endpoint.in_flight += 1
+        return time.monotonic()
+
+    def _abandon(self, endpoint):
+        # A cancelled attempt (lost hedge) says nothing about the node's health or latency
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def _record(self, endpoint, started, ok):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.stats['requests'] += 1
+            if ok:
+                latency = time.monotonic() - started
+                endpoint.latencies.append(latency)
+                endpoint.ewma = latency if endpoint.ewma is None else self._ewma_alpha * latency + (1 - self._ewma_alpha) * endpoint.ewma
+                endpoint.down_until = 0.0
+            else:
+                endpoint.stats['failures'] += 1
+                endpoint.down_until = time.monotonic() + self._failure_ttl
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Pool counters summed over every node, plus transport, failover/hedge counters and per-node detail."""
+        snapshot = {}
+        for endpoint in self._endpoints:
+            for name, value in endpoint.pool.stats().items():
+                snapshot[name] = snapshot.get(name, 0) + value
+        snapshot['maxsize'] = self._maxsize
+        snapshot['transport'] = self._transport
+        with self._lock:
+            snapshot.update(self._stats)
+        snapshot['endpoints'] = self.endpoint_stats()
+        return snapshot
+
+    def endpoint_stats(self):
+        """Per-endpoint request/failure/chosen counts, health, in-flight requests, EWMA and p95 latency."""
+        now = time.monotonic()
+        with self._lock:
+            return [ep.snapshot(now) for ep in self._endpoints]
+
+
+class FailoverPool(_EndpointSet):
+    """HTTPSConnectionPool look-alike over several CCP nodes with failover and optional hedged requests.
+
+    Each node gets a pool of the given transport (ccp_transport: 'http1' keep-alive, 'h2' multiplexed). A request goes to the healthy node the balance policy picks; a connection error, timeout or 5xx
+    marks that node down for failure_ttl seconds and moves on to the next one. With hedge=True a duplicate is sent to the
+    next node when the first has not answered within its p95 latency, and the first good answer wins.
+    """
+
+    def __init__(self, hosts, context, maxsize=10, idle_timeout=60, connect_timeout=None, read_timeout=None,
+                 failure_ttl=5, hedge=False, hedge_delay=0.25, latency_samples=100, min_samples=20, balance='ordered',
+                 transport='http1'):
+        # Resolved first so stats name the transport actually used (h2 falls back to http1 without the h2 package)
+        transport = resolve_transport(transport)
+        pool = pool_class(transport)
+        endpoints = [_Endpoint(host, pool(host, context, maxsize=maxsize, idle_timeout=idle_timeout,
+                                          connect_timeout=connect_timeout, read_timeout=read_timeout),
+                               latency_samples)
+                     for host in split_endpoints(hosts)]
+        _EndpointSet.__init__(self, endpoints, failure_ttl, hedge, hedge_delay, min_samples, balance)
+        self._maxsize = maxsize
+        self._transport = transport
+        self._executor = None
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # Hedging threads and parent requests in flight do not survive the fork; each node's pool resets itself
+        self._lock = threading.Lock()
+        self._executor = None
+        for endpoint in self._endpoints:
+            endpoint.in_flight = 0
+
+    def _attempt(self, endpoint, method, url, headers, timer=None):
+        attempt = timer.attempt(endpoint.host) if timer is not None else None
+        started = self._begin(endpoint)
+        try:
+            status, data = endpoint.pool.request(method, url, headers=headers, timer=attempt)
+        except Exception:
+            self._record(endpoint, started, ok=False)
+            if attempt is not None:
+                attempt.finish('error')
+            raise
+        self._record(endpoint, started, ok=status < 500)
+        if attempt is not None:
+            attempt.finish(outcome_for(status))
+        return status, data
+
+    def request(self, method, url, headers=None, timer=None):
+        """Perform a request against the first node that answers; returns (status, body).
+
+        With a timer, every attempt records its phases under the node it went to.
+        """
+        order = self._order()
+        if self._hedge and len(order) > 1:
+            return self._hedged(order, method, url, headers, timer)
+        last = None
+        for i, endpoint in enumerate(order):
+            if i:
+                self._count('failovers')
+            try:
+                last = self._attempt(endpoint, method, url, headers, timer)
+            except Exception as e:
+                last = e
+                continue
+            if last[0] < 500:
+                return last
+        if isinstance(last, Exception):
+            raise last
+        return last
+
+    def _hedged(self, order, method, url, headers, timer):
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._maxsize * len(order), thread_name_prefix='ccp-hedge')
+        primary, remaining = order[0], list(order[1:])
+        delay = self._delay(primary)
+        pending = {self._executor.submit(self._attempt, primary, method, url, headers, timer): primary}
+        last = None
+        while pending:
+            # Wait for an answer, or for the hedge delay if another node is still available
+            done, _ = wait(pending, timeout=delay if remaining else None, return_when=FIRST_COMPLETED)
+            if not done:
+                endpoint = remaining.pop(0)
+                self._count('hedged')
+                pending[self._executor.submit(self._attempt, endpoint, method, url, headers, timer)] = endpoint
+                continue
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    last = future.result()
+                except Exception as e:
+                    last = e
+                    continue
+                if last[0] < 500:
+                    # Losing duplicates finish in the background and return their connections to the pool
+                    if endpoint is not primary:
+                        self._count('hedge_wins')
+                    return last
+            # A node failed outright: fail over immediately rather than waiting out the delay
+            if remaining and len(pending) < 2:
+                endpoint = remaining.pop(0)
+                self._count('failovers')
+                pending[self._executor.submit(self._attempt, endpoint, method, url, headers, timer)] = endpoint
+        if isinstance(last, Exception):
+            raise last
+        return last
+
+    def set_context(self, context):
+        """Switch every node's pool to a new SSLContext."""
+        for endpoint in self._endpoints:
+            endpoint.pool.set_context(context)
+
+    def close(self):
+        """Close every node's pool and the hedging threads."""
+        for endpoint in self._endpoints:
+            endpoint.pool.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class AsyncFailoverPool(_EndpointSet):
+    """asyncio counterpart of FailoverPool with the AsyncHTTPSConnectionPool request() interface.
+
+    Losing hedged requests are cancelled as soon as one node answers.
+    """
+
+    def __init__(self, hosts, context, maxsize=100, idle_timeout=60, timeout=30, connect_timeout=None,
+                 failure_ttl=5, hedge=False, hedge_delay=0.25, latency_samples=100, min_samples=20, balance='ordered',
+                 transport='http1'):
+        transport = resolve_transport(transport)
+        pool = pool_class(transport, asynchronous=True)
+        endpoints = [_Endpoint(host, pool(host, context, maxsize=maxsize, idle_timeout=idle_timeout,
+                                          timeout=timeout, connect_timeout=connect_timeout),
+                               latency_samples)
+                     for host in split_endpoints(hosts)]
+        _EndpointSet.__init__(self, endpoints, failure_ttl, hedge, hedge_delay, min_samples, balance)
+        self._maxsize = maxsize
+        self._transport = transport
+
+    async def _attempt(self, endpoint, method, path, headers, timeout, timer=None):
+        attempt = timer.attempt(endpoint.host) if timer is not None else None
+        started = self._begin(endpoint)
+        try:
+            response = await endpoint.pool.request(method, path, headers=headers, timeout=timeout, timer=attempt)
+        except Exception:
+            self._record(endpoint, started, ok=False)
+            if attempt is not None:
+                attempt.finish('error')
+            raise
+        except BaseException:
+            self._abandon(endpoint)
+            raise
+        self._record(endpoint, started, ok=response.status < 500)
+        if attempt is not None:
+            attempt.finish(outcome_for(response.status))
+        return response
+
+    async def request(self, method, path, headers=None, timeout=None, timer=None):
+        """Send a request to the first node that answers and return its AsyncResponse."""
+        import asyncio
+        order = self._order()
+        remaining = list(order[1:])
+        tasks = {asyncio.ensure_future(self._attempt(order[0], method, path, headers, timeout, timer)): order[0]}
+        delay = self._delay(order[0]) if self._hedge else None
+        last = None
+        try:
+            while tasks:
+                hedge_now = self._hedge and remaining and len(tasks) < 2
+                done, _ = await asyncio.wait(tasks, timeout=delay if hedge_now else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    endpoint = remaining.pop(0)
+                    self._count('hedged')
+                    tasks[asyncio.ensure_future(self._attempt(endpoint, method, path, headers, timeout, timer))] = endpoint
+                    continue
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    try:
+                        last = task.result()
+                    except Exception as e:
+                        last = e
+                        continue
+                    if last.status < 500:
+                        if self._hedge and endpoint is not order[0]:
+                            self._count('hedge_wins')
+                        return last
+                if remaining and not tasks:
+                    endpoint = remaining.pop(0)
+                    self._count('failovers')
+                    tasks[asyncio.ensure_future(self._attempt(endpoint, method, path, headers, timeout, timer))] = endpoint
+        finally:
+            for task in tasks:
+                task.cancel()
+        if isinstance(last, Exception):
+            raise last
+        return last
+
+    async def close(self):
+        """Close every node's pool."""
+        for endpoint in self._endpoints:
+            await endpoint.pool.close()
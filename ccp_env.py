@@ -0,0 +1,23 @@
+import os
+import threading
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+    """Load .env into os.environ once per process, the first time a setting is needed rather than at import."""
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if not _loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _loaded = True
+
+
+def getenv(name, default=None):
+    """os.getenv after making sure .env has been loaded."""
+    load_env()
+    return os.getenv(name, default)
@@ -0,0 +1,43 @@
+import os
+import sys
+import weakref
+
+# Objects (pools, caches, clients) whose locks, threads and sockets are reset in a forked child
+_OBJECTS = weakref.WeakSet()
+_CALLBACKS = []
+_STATS = {'forks': 0, 'reset': 0, 'failed': 0}
+
+
+def register(obj):
+    """Have obj._after_fork() called in the child after every fork (gunicorn, multiprocessing 'fork'); returns obj."""
+    _OBJECTS.add(obj)
+    return obj
+
+
+def at_fork(callback):
+    """Call callback() in the child after every fork, e.g. to replace module-level locks; returns callback."""
+    _CALLBACKS.append(callback)
+    return callback
+
+
+def _after_fork_in_child():
+    _STATS['forks'] += 1
+    # Module state first, so objects resetting themselves see fresh module locks
+    for reset in _CALLBACKS + [obj._after_fork for obj in list(_OBJECTS)]:
+        try:
+            reset()
+            _STATS['reset'] += 1
+        except Exception as e:
+            # One broken reset must not stop the others; the child carries on either way
+            _STATS['failed'] += 1
+            print('Warning: fork reset failed: {}'.format(e), file=sys.stderr)
+
+
+def fork_stats():
+    """Return how many forks this process has seen as a child and how many resets ran or failed."""
+    return dict(_STATS, registered=len(_OBJECTS))
+
+
+# Not available on Windows, where there is no fork to survive
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
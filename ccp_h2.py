@@ -0,0 +1,401 @@
+import select
+import socket
+import threading
+import time
+import urllib.parse
+import ccp_fork
+
+
+def require_h2():
+    """Import the h2 package, which only the HTTP/2 transport needs."""
+    try:
+        import h2.config
+        import h2.connection
+        import h2.events
+    except ImportError:
+        raise Exception('ERROR: The h2 transport needs the h2 package. Please run pip install h2')
+    return h2
+
+
+def _split_host(host, default_port=443):
+    parts = urllib.parse.urlsplit('//' + host.replace('https://', '').rstrip('/'))
+    return parts.hostname, parts.port or default_port
+
+
+class _Stream(object):
+    __slots__ = ('status', 'headers', 'body', 'error', 'wake')
+
+    def __init__(self, wake):
+        self.status = None
+        self.headers = {}
+        self.body = []
+        self.error = None
+        self.wake = wake
+
+
+class H2Session(object):
+    """Sans-I/O state of one HTTP/2 client connection, shared by the thread and asyncio pools.
+
+    The owner feeds received bytes to receive() and writes out data_to_send(); each stream's wake()
+    is called once it has ended, been reset or been lost with the connection.
+    """
+
+    def __init__(self, authority):
+        h2 = require_h2()
+        self.authority = authority
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.conn.initiate_connection()
+        self.streams = {}
+        # Set once the connection can take no more streams: an exception if it failed, True after GOAWAY
+        self.error = None
+        self.goaway = False
+        self.last_used = time.monotonic()
+
+    def usable(self):
+        return self.error is None and not self.goaway
+
+    def max_streams(self, maxsize):
+        return min(maxsize, self.conn.remote_settings.max_concurrent_streams)
+
+    def data_to_send(self):
+        return self.conn.data_to_send()
+
+    def open_stream(self, method, path, headers, wake):
+        """Queue a bodiless request and return (stream id, stream)."""
+        stream_id = self.conn.get_next_available_stream_id()
+        fields = [(':method', method), (':scheme', 'https'), (':authority', self.authority), (':path', path)]
+        # HTTP/2 field names are lower-case; Host is carried by :authority
+        fields += [(name.lower(), str(value)) for name, value in headers.items() if name.lower() != 'host']
+        self.conn.send_headers(stream_id, fields, end_stream=True)
+        stream = self.streams[stream_id] = _Stream(wake)
+        self.last_used = time.monotonic()
+        return stream_id, stream
+
+    def cancel(self, stream_id):
+        """Forget a stream nobody waits for any more and tell the server to stop working on it."""
+        if self.streams.pop(stream_id, None) is not None and self.error is None:
+            from h2.errors import ErrorCodes
+            try:
+                self.conn.reset_stream(stream_id, ErrorCodes.CANCEL)
+            except Exception:
+                pass
+
+    def receive(self, data):
+        """Process bytes read from the socket; returns how many streams finished."""
+        import h2.events
+        finished = 0
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.ResponseReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    for name, value in event.headers:
+                        if name == ':status':
+                            stream.status = int(value)
+                        else:
+                            stream.headers[name] = value
+            elif isinstance(event, h2.events.DataReceived):
+                # Hand the flow-control window straight back; CCP bodies are small and read in full
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.body.append(event.data)
+            elif isinstance(event, h2.events.StreamEnded):
+                finished += self._finish(event.stream_id, None)
+            elif isinstance(event, h2.events.StreamReset):
+                # Only this request failed; the connection carries on
+                finished += self._finish(event.stream_id, Exception(
+                    'ERROR: CCP reset the HTTP/2 stream (error code {}).'.format(event.error_code)))
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                # GOAWAY: streams above last_stream_id were never processed and can be retried elsewhere
+                self.goaway = True
+                last = event.last_stream_id or 0
+                for stream_id in [stream_id for stream_id in self.streams if stream_id > last]:
+                    finished += self._finish(stream_id, ConnectionResetError(
+                        'ERROR: CCP closed the HTTP/2 connection (GOAWAY) before answering.'))
+        if finished:
+            self.last_used = time.monotonic()
+        return finished
+
+    def fail(self, error):
+        """Mark the connection dead and wake every stream still waiting on it."""
+        if self.error is None:
+            self.error = error
+        for stream_id in list(self.streams):
+            self._finish(stream_id, error)
+
+    def _finish(self, stream_id, error):
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return 0
+        stream.error = error
+        stream.wake()
+        return 1
+
+
+class _Connection(object):
+    """One TLS socket and the I/O thread that owns it: every read and write on the socket happens there."""
+
+    def __init__(self, pool, sock):
+        self.sock = sock
+        self.session = H2Session(pool._authority)
+        self._pool = pool
+        self._closing = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._thread = threading.Thread(target=self._run, name='ccp-h2-{}'.format(pool._host), daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        # A full wake-up buffer already guarantees the I/O thread will look again
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def retire(self):
+        """Stop taking streams; the socket closes once the ones in flight are answered."""
+        self._closing = True
+        self.wake()
+
+    def _run(self):
+        cond = self._pool._cond
+        try:
+            while True:
+                with cond:
+                    done = self._closing and not self.session.streams
+                    if done and self.session.error is None:
+                        # Say goodbye with a GOAWAY rather than just dropping the socket
+                        self.session.conn.close_connection()
+                    data = self.session.data_to_send()
+                if data:
+                    self.sock.sendall(data)
+                if done:
+                    break
+                if not self.sock.pending():
+                    readable, _, _ = select.select([self.sock, self._wake_r], [], [])
+                    if self._wake_r in readable:
+                        try:
+                            while self._wake_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    if self.sock not in readable:
+                        continue
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError('ERROR: CCP closed the HTTP/2 connection.')
+                with cond:
+                    if self.session.receive(data):
+                        cond.notify_all()
+        except Exception as e:
+            with cond:
+                self.session.fail(e)
+                cond.notify_all()
+        finally:
+            self.close()
+
+    def close(self):
+        for sock in (self.sock, self._wake_r, self._wake_w):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class H2ConnectionPool(object):
+    """HTTPSConnectionPool look-alike that multiplexes every request to one host over a single HTTP/2 connection.
+
+    Up to maxsize requests (or the server's SETTINGS_MAX_CONCURRENT_STREAMS, if lower) are in flight at
+    once as streams of one mutual-TLS connection, so a batch costs one handshake instead of one per
+    socket. The context must offer 'h2' through ALPN; the CCP front end must accept the client
+    certificate in the initial handshake (HTTP/2 forbids the renegotiation IIS otherwise uses).
+    """
+
+    ALPN = ('h2',)
+
+    def __init__(self, host, context, maxsize=100, idle_timeout=60, timeout=None, block_timeout=None, connect_timeout=None, read_timeout=None):
+        # Fail on construction, not on the first request, when h2 is missing
+        require_h2()
+        # Declare Init Variables
+        self._host = host
+        self._hostname, self._port = _split_host(host)
+        self._authority = host.replace('https://', '').rstrip('/')
+        self._context = context
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = timeout if connect_timeout is None else connect_timeout
+        self._read_timeout = timeout if read_timeout is None else read_timeout
+        self._block_timeout = block_timeout
+        self._conn = None
+        self._connecting = False
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._stats = {'created': 0, 'reused': 0, 'evicted_idle': 0, 'dropped': 0, 'retried': 0, 'discarded': 0,
+                       'fork_dropped': 0, 'timeouts': 0, 'peak_streams': 0}
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # The I/O thread stayed in the parent: close our copies of its descriptors without a GOAWAY
+        self._cond = threading.Condition(threading.Lock())
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._stats['fork_dropped'] += 1
+        self._connecting = False
+        self._in_use = 0
+
+    def _connect(self, timer=None):
+        create = timer.create_connection if timer is not None else socket.create_connection
+        raw = create((self._hostname, self._port), self._connect_timeout)
+        try:
+            sock = self._context.wrap_socket(raw, server_hostname=self._hostname)
+        except BaseException:
+            raw.close()
+            raise
+        if timer is not None:
+            timer.mark('tls')
+        protocol = sock.selected_alpn_protocol()
+        if protocol != 'h2':
+            sock.close()
+            raise Exception('ERROR: {} did not negotiate HTTP/2 (ALPN: {}); use the http1 transport.'.format(self._authority, protocol))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The I/O thread only reads what select() reported; request deadlines are enforced per stream
+        sock.settimeout(None)
+        return _Connection(self, sock)
+
+    def _retire(self, counter):
+        self._conn.retire()
+        self._conn = None
+        self._stats[counter] += 1
+
+    def acquire(self, timer=None):
+        """Return (connection, reused) with a stream slot reserved; blocks while maxsize streams are in flight."""
+        deadline = None if self._block_timeout is None else time.monotonic() + self._block_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception('ERROR: Connection pool for {} is closed.'.format(self._host))
+                conn = self._conn
+                if conn is not None and not conn.session.usable():
+                    self._retire('dropped')
+                elif conn is not None and not conn.session.streams and time.monotonic() - conn.session.last_used > self._idle_timeout:
+                    self._retire('evicted_idle')
+                elif conn is not None and self._in_use < conn.session.max_streams(self._maxsize):
+                    self._in_use += 1
+                    self._stats['reused'] += 1
+                    self._stats['peak_streams'] = max(self._stats['peak_streams'], self._in_use)
+                    if timer is not None:
+                        timer.mark('queue')
+                    return conn, True
+                if self._conn is None and not self._connecting:
+                    # This caller connects; the others wait for the connection instead of opening their own
+                    self._connecting = True
+                    self._in_use += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception('ERROR: Connection pool for {} exhausted ({} streams in flight).'.format(self._host, self._in_use))
+                self._cond.wait(remaining)
+        if timer is not None:
+            timer.mark('queue')
+        try:
+            conn = self._connect(timer)
+        except BaseException:
+            with self._cond:
+                self._connecting = False
+                self._in_use -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._connecting = False
+            self._conn = conn
+            self._stats['created'] += 1
+            self._stats['peak_streams'] = max(self._stats['peak_streams'], self._in_use)
+            self._cond.notify_all()
+        return conn, False
+
+    def release(self, conn, reusable=True):
+        """Give back a stream slot; reusable=False retires the connection (new streams go to a fresh one)."""
+        with self._cond:
+            self._in_use -= 1
+            if not reusable and conn is self._conn:
+                self._retire('discarded')
+            self._cond.notify()
+
+    def _exchange(self, conn, method, url, headers):
+        done = threading.Event()
+        with self._cond:
+            if not conn.session.usable():
+                raise ConnectionResetError('ERROR: The HTTP/2 connection to {} was lost.'.format(self._authority))
+            stream_id, stream = conn.session.open_stream(method, url, headers, done.set)
+        conn.wake()
+        if not done.wait(self._read_timeout):
+            with self._cond:
+                conn.session.cancel(stream_id)
+                self._stats['timeouts'] += 1
+            conn.wake()
+            raise TimeoutError('ERROR: CCP request to {} timed out after {} seconds.'.format(self._authority, self._read_timeout))
+        if stream.error is not None:
+            raise stream.error
+        return stream.status, b''.join(stream.body)
+
+    def request(self, method, url, headers=None, timer=None):
+        """Perform a request as one stream on the shared connection and return (status, body).
+
+        timer (a ccp_metrics.PhaseTimer) gets queue, dns/connect/tls (new connections only) and server marks.
+        """
+        headers = headers or {}
+        conn, reused = self.acquire(timer)
+        try:
+            status, data = self._exchange(conn, method, url, headers)
+        except ConnectionError:
+            self.release(conn, reusable=False)
+            # The connection died or went away before answering: retry once on a fresh one
+            if not reused:
+                raise
+            self._stats['retried'] += 1
+            conn, _ = self.acquire()
+            try:
+                status, data = self._exchange(conn, method, url, headers)
+            except ConnectionError:
+                self.release(conn, reusable=False)
+                raise
+            except Exception:
+                self.release(conn)
+                raise
+        except Exception:
+            # A timed-out or reset stream leaves the connection usable for the others
+            self.release(conn)
+            raise
+        if timer is not None:
+            timer.mark('server')
+        self.release(conn)
+        return status, data
+
+    def set_context(self, context):
+        """Use a different SSLContext for new connections; the current connection drains and closes."""
+        with self._cond:
+            self._context = context
+            if self._conn is not None:
+                self._conn.retire()
+                self._conn = None
+
+    def stats(self):
+        """Return a snapshot of connection and stream counters."""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['in_use'] = self._in_use
+            snapshot['idle'] = 1 if self._conn is not None and not self._conn.session.streams else 0
+            snapshot['maxsize'] = self._maxsize
+        return snapshot
+
+    def close(self):
+        """Stop taking requests; the connection closes once the streams in flight are answered."""
+        with self._cond:
+            self._closed = True
+            if self._conn is not None:
+                self._conn.retire()
+                self._conn = None
+            self._cond.notify_all()
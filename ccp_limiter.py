@@ -0,0 +1,150 @@
+import math
+import threading
+import time
+from collections import deque
+
+LIMITER_POLICIES = ('aimd', 'gradient')
+# Statuses CCP (or a load balancer in front of it) uses to shed load
+THROTTLE_STATUSES = (429, 503)
+
+
+class AdaptiveLimit(object):
+    """Concurrency limit that follows observed latency, errors and throttling.
+
+    'aimd' adds about one slot per limit's worth of fast answers and multiplies the limit by backoff
+    on a throttle, error or an answer slower than tolerance x the baseline (lowest recent latency).
+    'gradient' moves the limit towards limit x gradient + sqrt(limit), where gradient is
+    tolerance x baseline / latency capped to [0.5, 1], by smoothing x the gap per limit's worth of
+    answers; throttles and errors back off as with aimd. Neither grows a limit that is not in use.
+    The limit stays within [min_limit, max_limit].
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, policy='aimd', backoff=0.7, tolerance=2.0,
+                 smoothing=0.2, baseline_samples=100, history=1000):
+        if policy not in LIMITER_POLICIES:
+            raise Exception('ERROR: Unknown limiter policy {!r}; expected one of {}.'.format(policy, ', '.join(LIMITER_POLICIES)))
+        if not 1 <= min_limit <= max_limit:
+            raise Exception('ERROR: Limiter bounds must satisfy 1 <= min_limit ({}) <= max_limit ({}).'.format(min_limit, max_limit))
+        self._policy = policy
+        self._min = min_limit
+        self._max = max_limit
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._initial = self.limit
+        self._backoff = backoff
+        self._tolerance = tolerance
+        self._smoothing = smoothing
+        self._latencies = deque(maxlen=baseline_samples)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        # Requests started before the last decrease belong to the same overload episode and do not cut again
+        self._last_decrease = 0.0
+        self._history = deque([(0.0, self.limit)], maxlen=history)
+        self._stats = {'samples': 0, 'ok': 0, 'slow': 0, 'throttled': 0, 'errors': 0, 'increases': 0, 'decreases': 0}
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def on_sample(self, started, latency, outcome, in_flight):
+        """Feed one finished request: outcome is 'ok', 'throttled' or 'error'; returns the new limit."""
+        with self._lock:
+            self._stats['samples'] += 1
+            before = self.limit
+            if outcome == 'ok':
+                self._latencies.append(latency)
+                baseline = min(self._latencies)
+                slow = latency > baseline * self._tolerance and len(self._latencies) >= 10
+                self._stats['slow' if slow else 'ok'] += 1
+                # Only grow a limit that is actually being used
+                in_use = in_flight + 1 >= self._limit / 2
+                if self._policy == 'gradient':
+                    self._gradient(baseline, latency, in_use)
+                elif slow:
+                    self._decrease(started)
+                elif in_use:
+                    self._limit = min(self._max, self._limit + 1.0 / self._limit)
+            else:
+                self._stats['throttled' if outcome == 'throttled' else 'errors'] += 1
+                self._decrease(started)
+            after = self.limit
+            if after != before:
+                self._stats['increases' if after > before else 'decreases'] += 1
+                self._history.append((round(time.monotonic() - self._started, 3), after))
+            return after
+
+    def _decrease(self, started):
+        if started < self._last_decrease:
+            return
+        self._limit = max(self._min, self._limit * self._backoff)
+        self._last_decrease = time.monotonic()
+
+    def _gradient(self, baseline, latency, in_use):
+        gradient = max(0.5, min(1.0, baseline * self._tolerance / latency))
+        step = self._smoothing * (self._limit * gradient + math.sqrt(self._limit) - self._limit) / self._limit
+        if step < 0 or in_use:
+            self._limit = min(self._max, max(self._min, self._limit + step))
+
+    def stats(self):
+        """Current limit, bounds, per-outcome counters and the limit history as (seconds since start, limit)."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot.update(policy=self._policy, initial=self._initial, limit=self.limit, min_limit=self._min, max_limit=self._max,
+                            baseline_ms=round(min(self._latencies) * 1000, 3) if self._latencies else None,
+                            history=list(self._history))
+        return snapshot
+
+
+class AsyncLimitedPool(object):
+    """Wraps an asyncio pool so at most limit.limit requests are in flight, feeding every answer back to the limit.
+
+    A throttled answer is retried (up to throttle_retries times) once a slot frees up under the lowered
+    limit, so probing for capacity does not cost the caller its lookup.
+    """
+
+    def __init__(self, pool, limit, throttle_retries=2):
+        import asyncio
+        self._pool = pool
+        self._limit = limit
+        self._throttle_retries = throttle_retries
+        self._in_flight = 0
+        self._retried = 0
+        self._changed = asyncio.Condition()
+
+    async def request(self, method, path, **kwargs):
+        for attempt in range(self._throttle_retries + 1):
+            response = await self._request(method, path, kwargs)
+            if response.status not in THROTTLE_STATUSES or attempt == self._throttle_retries:
+                return response
+            self._retried += 1
+
+    async def _request(self, method, path, kwargs):
+        import asyncio
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._in_flight < self._limit.limit)
+            self._in_flight += 1
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            response = await self._pool.request(method, path, **kwargs)
+            outcome = 'throttled' if response.status in THROTTLE_STATUSES else ('error' if response.status >= 500 else 'ok')
+            return response
+        except asyncio.CancelledError:
+            # Cancelled: says nothing about CCP's capacity (other errors keep the 'error' outcome)
+            outcome = None
+            raise
+        finally:
+            async with self._changed:
+                self._in_flight -= 1
+                if outcome is not None:
+                    self._limit.on_sample(started, time.monotonic() - started, outcome, self._in_flight)
+                # The limit may have grown by more than the slot just freed
+                self._changed.notify_all()
+
+    def stats(self):
+        snapshot = self._pool.stats()
+        snapshot['in_flight'] = self._in_flight
+        snapshot['throttle_retries'] = self._retried
+        return snapshot
+
+    async def close(self):
+        await self._pool.close()
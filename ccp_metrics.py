@@ -0,0 +1,240 @@
+import bisect
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import ccp_fork
+
+# Phases of one CCP lookup, in order; a reused keep-alive connection skips dns/connect/tls
+PHASES = ('queue', 'dns', 'connect', 'tls', 'server', 'decode', 'total')
+# Upper bounds in seconds; the last bucket (+Inf) is implicit
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC = 'ccp_request_phase_seconds'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_DEFAULT = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+@ccp_fork.at_fork
+def _reset_after_fork():
+    global _DEFAULT_LOCK
+    _DEFAULT_LOCK = threading.Lock()
+
+
+def outcome_for(status):
+    """Collapse an HTTP status into a low-cardinality outcome label."""
+    if status == 200:
+        return 'ok'
+    return '5xx' if status >= 500 else '4xx'
+
+
+class PhaseTimer(object):
+    """Times the phases of one lookup (or one attempt on one node).
+
+    Hooks call mark(phase) as each phase ends; finish(outcome) files the durations in the histograms.
+    """
+
+    __slots__ = ('_metrics', '_appid', 'host', '_total', '_started', '_last', '_phases')
+
+    def __init__(self, metrics, appid, host, total=True):
+        self._metrics = metrics
+        self._appid = appid
+        self.host = host
+        self._total = total
+        self._started = self._last = time.perf_counter()
+        self._phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self._phases.append((phase, now - self._last))
+        self._last = now
+
+    def skip(self):
+        """Start the next phase now without recording the one that just ended (attempt timers cover it)."""
+        self._last = time.perf_counter()
+
+    def attempt(self, host):
+        """Child timer for one request to one node; its phases carry that node's host label."""
+        return PhaseTimer(self._metrics, self._appid, host, total=False)
+
+    def create_connection(self, address, timeout, source_address=None):
+        """socket.create_connection replacement (for http.client) that times name resolution and TCP connect."""
+        host, port = address
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self.mark('dns')
+        error = OSError('ERROR: {} did not resolve to any address.'.format(host))
+        for _, _, _, _, sockaddr in infos:
+            try:
+                sock = socket.create_connection(sockaddr[:2], timeout, source_address)
+            except OSError as e:
+                error = e
+                continue
+            self.mark('connect')
+            return sock
+        raise error
+
+    def finish(self, outcome):
+        if self._total:
+            self._phases.append(('total', time.perf_counter() - self._started))
+        self._metrics.observe_many(self._phases, self.host, self._appid, outcome)
+
+
+class PhaseMetrics(object):
+    """In-process latency histograms per (phase, host, appid, outcome), exported as OpenMetrics text or Zabbix trapper items."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # Each worker reports its own lookups; the parent's samples stay with the parent
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def timer(self, appid, host):
+        """Start timing one lookup."""
+        return PhaseTimer(self, appid or '', host)
+
+    def observe(self, phase, seconds, host, appid, outcome):
+        self.observe_many([(phase, seconds)], host, appid, outcome)
+
+    def observe_many(self, phases, host, appid, outcome):
+        with self._lock:
+            for phase, seconds in phases:
+                key = (phase, host, appid, outcome)
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+                series[0][bisect.bisect_left(self._buckets, seconds)] += 1
+                series[1] += seconds
+                series[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self):
+        """Return {(phase, host, appid, outcome): {'buckets': cumulative counts, 'sum', 'count'}}."""
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        snapshot = {}
+        for key, (counts, total, count) in series.items():
+            cumulative, running = [], 0
+            for value in counts:
+                running += value
+                cumulative.append(running)
+            snapshot[key] = {'buckets': cumulative, 'sum': total, 'count': count}
+        return snapshot
+
+    def quantile(self, entry, q):
+        """Estimate a quantile from one snapshot entry by interpolating inside its bucket."""
+        if not entry['count']:
+            return None
+        rank = q * entry['count']
+        lower, below = 0.0, 0
+        for bound, cumulative in zip(self._buckets, entry['buckets']):
+            if cumulative >= rank:
+                inside = cumulative - below
+                return lower + (bound - lower) * ((rank - below) / inside if inside else 1.0)
+            lower, below = bound, cumulative
+        return self._buckets[-1]
+
+    def openmetrics(self):
+        """Render every series in the OpenMetrics text format (ends with # EOF)."""
+        lines = ['# TYPE {} histogram'.format(METRIC), '# UNIT {} seconds'.format(METRIC),
+                 '# HELP {} Time spent in each phase of a CyberArk CCP lookup.'.format(METRIC)]
+        for (phase, host, appid, outcome), entry in sorted(self.snapshot().items(), key=_phase_order):
+            labels = 'phase="{}",host="{}",appid="{}",outcome="{}"'.format(*(_escape(v) for v in (phase, host, appid, outcome)))
+            for bound, cumulative in zip(self._buckets, entry['buckets']):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(METRIC, labels, bound, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(METRIC, labels, entry['count']))
+            lines.append('{}_count{{{}}} {}'.format(METRIC, labels, entry['count']))
+            lines.append('{}_sum{{{}}} {}'.format(METRIC, labels, entry['sum']))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def zabbix_items(self, zabbix_host, clock=None):
+        """Trapper items for the Zabbix host: an LLD list plus count, avg and p95 (seconds) per series."""
+        clock = int(clock or time.time())
+        snapshot = self.snapshot()
+        discovery = [{'{#PHASE}': phase, '{#CCPHOST}': host, '{#APPID}': appid, '{#OUTCOME}': outcome}
+                     for phase, host, appid, outcome in sorted(snapshot, key=lambda key: _phase_order((key, None)))]
+        items = [{'host': zabbix_host, 'key': 'ccp.phase.discovery', 'value': json.dumps(discovery), 'clock': clock}]
+        for key, entry in sorted(snapshot.items(), key=_phase_order):
+            params = ','.join('"{}"'.format(value.replace('"', '')) for value in key)
+            p95 = self.quantile(entry, 0.95)
+            values = {'count': entry['count'], 'avg': round(entry['sum'] / entry['count'], 6),
+                      'p95': None if p95 is None else round(p95, 6)}
+            for name, value in values.items():
+                items.append({'host': zabbix_host, 'key': 'ccp.phase.{}[{}]'.format(name, params), 'value': str(value), 'clock': clock})
+        return items
+
+    def send_to_zabbix(self, server, zabbix_host, port=10051, timeout=5):
+        """Push zabbix_items() to a Zabbix server/proxy with the sender (trapper) protocol; returns its reply."""
+        return zabbix_send(server, self.zabbix_items(zabbix_host), port=port, timeout=timeout)
+
+
+def _phase_order(item):
+    (phase, host, appid, outcome), _ = item
+    return (host, appid, PHASES.index(phase) if phase in PHASES else len(PHASES), phase, outcome)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def zabbix_send(server, items, port=10051, timeout=5):
+    """Send trapper items as `zabbix_sender` would and return the server's JSON reply."""
+    payload = json.dumps({'request': 'sender data', 'data': items, 'clock': int(time.time())}).encode('UTF-8')
+    with socket.create_connection((server, port), timeout=timeout) as sock:
+        sock.sendall(b'ZBXD\x01' + struct.pack('<Q', len(payload)) + payload)
+        reply = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    if reply[:5] != b'ZBXD\x01' or len(reply) < 13:
+        raise Exception('ERROR: Unexpected reply from Zabbix server {}:{}: {!r}'.format(server, port, reply[:64]))
+    length = struct.unpack('<Q', reply[5:13])[0]
+    return json.loads(reply[13:13 + length].decode('UTF-8'))
+
+
+def default_metrics():
+    """The process-wide PhaseMetrics shared by clients created with metrics=True or AAM_METRICS=true."""
+    global _DEFAULT
+    with _DEFAULT_LOCK:
+        if _DEFAULT is None:
+            _DEFAULT = PhaseMetrics()
+        return _DEFAULT
+
+
+def resolve_metrics(metrics=None):
+    """Map a client's metrics argument to a PhaseMetrics or None (hooks off).
+
+    None follows AAM_METRICS, True means the shared default_metrics(), and a PhaseMetrics is used as given.
+    """
+    if metrics is None:
+        metrics = os.getenv('AAM_METRICS', 'false').lower() == 'true'
+    if metrics is True:
+        return default_metrics()
+    return metrics or None
+
+
+def export_from_env(metrics):
+    """End-of-run export for the CLIs: AAM_METRICS_FILE gets the OpenMetrics dump, AAM_ZABBIX_SERVER the trapper items."""
+    if metrics is None:
+        return
+    path = os.getenv('AAM_METRICS_FILE')
+    if path:
+        with open(path, 'w') as file:
+            file.write(metrics.openmetrics())
+    server = os.getenv('AAM_ZABBIX_SERVER')
+    if server:
+        host, _, port = server.partition(':')
+        metrics.send_to_zabbix(host, os.getenv('AAM_ZABBIX_HOST') or socket.gethostname(), port=int(port or 10051))
@@ -0,0 +1,164 @@
+import http.client
+import select
+import threading
+import time
+from collections import deque
+import ccp_fork
+
+
+class HTTPSConnectionPool(object):
+    """Thread-safe, bounded pool of keep-alive HTTPS connections to one host."""
+
+    def __init__(self, host, context, maxsize=10, idle_timeout=60, timeout=None, block_timeout=None, connect_timeout=None, read_timeout=None):
+        # Declare Init Variables
+        self._host = host
+        self._context = context
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        # timeout applies to both phases unless connect_timeout / read_timeout narrow one of them
+        self._connect_timeout = timeout if connect_timeout is None else connect_timeout
+        self._read_timeout = timeout if read_timeout is None else read_timeout
+        self._block_timeout = block_timeout
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._stats = {'created': 0, 'reused': 0, 'evicted_idle': 0, 'dropped': 0, 'retried': 0, 'discarded': 0, 'fork_dropped': 0}
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # The lock may have been held by a parent thread that does not exist here
+        self._cond = threading.Condition(threading.Lock())
+        # Idle sockets are the parent's TLS sessions: close our copies of the descriptors (no TLS shutdown
+        # or FIN reaches the server while the parent holds them) and connect afresh
+        while self._idle:
+            conn, _ = self._idle.popleft()
+            conn.close()
+            self._stats['fork_dropped'] += 1
+        # Connections other parent threads had checked out are never released here
+        self._in_use = 0
+
+    def _new_connection(self):
+        self._stats['created'] += 1
+        return http.client.HTTPSConnection(self._host, context=self._context, timeout=self._connect_timeout)
+
+    @staticmethod
+    def _is_dropped(conn):
+        # An idle keep-alive socket should have nothing to read; readable means EOF or stray data
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _evict_idle(self, now):
+        # Oldest connections sit at the left of the deque
+        while self._idle and now - self._idle[0][1] > self._idle_timeout:
+            conn, _ = self._idle.popleft()
+            conn.close()
+            self._stats['evicted_idle'] += 1
+
+    def acquire(self):
+        """Return (connection, reused) and mark it in use; blocks while the pool is exhausted."""
+        deadline = None if self._block_timeout is None else time.monotonic() + self._block_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception('ERROR: Connection pool for {} is closed.'.format(self._host))
+                self._evict_idle(time.monotonic())
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self._is_dropped(conn):
+                        conn.close()
+                        self._stats['dropped'] += 1
+                        continue
+                    self._in_use += 1
+                    self._stats['reused'] += 1
+                    return conn, True
+                if self._in_use < self._maxsize:
+                    self._in_use += 1
+                    return self._new_connection(), False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception('ERROR: Connection pool for {} exhausted ({} connections in use).'.format(self._host, self._in_use))
+                self._cond.wait(remaining)
+
+    def release(self, conn, reusable=True):
+        """Hand a connection back to the pool, closing it if it cannot be reused."""
+        with self._cond:
+            self._in_use -= 1
+            if reusable and not self._closed and conn.sock is not None:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+                self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def request(self, method, url, headers=None, timer=None):
+        """Perform a request over a pooled connection and return (status, body).
+
+        timer (a ccp_metrics.PhaseTimer) gets queue, dns/connect/tls (new connections only) and server marks.
+        """
+        headers = headers or {}
+        conn, reused = self.acquire()
+        if timer is not None:
+            timer.mark('queue')
+        try:
+            try:
+                res = self._send(conn, method, url, headers, timer)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed a kept-alive connection between our liveness check and the send
+                if not reused:
+                    raise
+                conn.close()
+                self._stats['retried'] += 1
+                res = self._send(conn, method, url, headers, timer)
+            data = res.read()
+        except Exception:
+            self.release(conn, reusable=False)
+            raise
+        if timer is not None:
+            timer.mark('server')
+        self.release(conn, reusable=not res.will_close)
+        return res.status, data
+
+    def _send(self, conn, method, url, headers, timer=None):
+        if conn.sock is None:
+            if timer is not None:
+                # The timer resolves and connects so DNS and TCP connect are timed apart; the rest of connect() is TLS
+                conn._create_connection = timer.create_connection
+            # Connect under the connect timeout, then switch the socket to the read timeout
+            conn.connect()
+            if timer is not None:
+                timer.mark('tls')
+            conn.sock.settimeout(self._read_timeout)
+        conn.request(method, url, headers=headers)
+        return conn.getresponse()
+
+    def set_context(self, context):
+        """Use a different SSLContext for new connections; idle ones made with the old context are closed."""
+        with self._cond:
+            self._context = context
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+
+    def stats(self):
+        """Return a snapshot of pool counters for sizing."""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['in_use'] = self._in_use
+            snapshot['idle'] = len(self._idle)
+            snapshot['maxsize'] = self._maxsize
+        return snapshot
+
+    def close(self):
+        """Close every idle connection; in-use connections are closed on release."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+            self._cond.notify_all()
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import ssl
+import stat
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from aam_python import CCPPasswordREST
+from ccp_env import load_env
+from ccp_metrics import OPENMETRICS_CONTENT_TYPE
+from ccp_transport import transports
+
+ACCOUNTS_PATH = '/AIMWebService/api/Accounts'
+SERVICE_PATH = '/AIMWebService/v1.1/aim.asmx'
+STATS_PATH = '/proxy/stats'
+METRICS_PATH = '/proxy/metrics'
+
+
+class CCPProxyHandler(BaseHTTPRequestHandler):
+    """Serves the AIMWebService Accounts endpoint from the proxy's CCPPasswordREST client."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CCPProxy'
+    # Headers and body leave in one segment (flushed per request); otherwise Nagle + delayed ACK add ~40 ms
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path == ACCOUNTS_PATH:
+            self._accounts(query)
+        elif path == SERVICE_PATH:
+            # Lets clients built with verifyService=True run their health check against the proxy
+            self._send(200, b'AIMWebService proxy', 'text/plain')
+        elif path == STATS_PATH:
+            client = self.server.ccp
+            stats = {'cache': client.cache_stats(), 'pool': client.pool_stats(), 'singleflight': client.singleflight_stats()}
+            self._send_json(200, stats)
+        elif path == METRICS_PATH:
+            metrics = self.server.ccp.phase_metrics()
+            if metrics is None:
+                self._send_json(404, {'ErrorCode': 'PROXY404E', 'ErrorMsg': 'Phase metrics are off (start with --metrics or AAM_METRICS=true)'})
+            else:
+                self._send(200, metrics.openmetrics().encode('UTF-8'), OPENMETRICS_CONTENT_TYPE)
+        else:
+            self._send_json(404, {'ErrorCode': 'PROXY404E', 'ErrorMsg': 'Unknown path {}'.format(path)})
+
+    def _accounts(self, query):
+        # Forward the caller's parameters as-is (AppID/Query as sent by Zabbix, or appid/safe/object)
+        params = dict(urllib.parse.parse_qsl(query))
+        try:
+            status_code, response = self.server.ccp.lookup(params)
+        except Exception as e:
+            self._send_json(502, {'ErrorCode': 'PROXY502E', 'ErrorMsg': 'ERROR: CCP upstream unavailable: {}'.format(e)})
+            return
+        self._send_json(status_code, response)
+
+    def _send_json(self, status_code, body):
+        self._send(status_code, json.dumps(body).encode('UTF-8'), 'application/json')
+
+    def _send(self, status_code, body, content_type):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address tuple
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CCPProxyHTTPSServer(ThreadingHTTPServer):
+    """Threaded HTTPS listener; the TLS handshake runs in the worker thread, not the accept loop."""
+
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 drops SYNs under a burst of new connections (1 s retransmits)
+    request_queue_size = 128
+
+    def __init__(self, address, ccp, ssl_context, handshake_timeout=10, verbose=False):
+        self.ccp = ccp
+        self.ssl_context = ssl_context
+        self.handshake_timeout = handshake_timeout
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, address, CCPProxyHandler)
+
+    def finish_request(self, request, client_address):
+        request.settimeout(self.handshake_timeout)
+        try:
+            tls = self.ssl_context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        try:
+            tls.settimeout(None)
+            ThreadingHTTPServer.finish_request(self, tls, client_address)
+        finally:
+            tls.close()
+
+
+class _UnixSocketHandler(CCPProxyHandler):
+    # TCP_NODELAY does not exist on AF_UNIX sockets
+    disable_nagle_algorithm = False
+
+
+class CCPProxyUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded plain-HTTP listener on a Unix socket (e.g. curl --unix-socket)."""
+
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 drops SYNs under a burst of new connections (1 s retransmits)
+    request_queue_size = 128
+
+    def __init__(self, path, ccp, verbose=False, mode=0o600, group=None):
+        self.ccp = ccp
+        self.verbose = verbose
+        self.mode = mode
+        self.group = group
+        # A socket file left behind by a previous run would make bind fail; anything else at the path is not ours to delete
+        try:
+            existing = os.lstat(path).st_mode
+        except FileNotFoundError:
+            existing = None
+        if existing is not None:
+            if not stat.S_ISSOCK(existing):
+                raise Exception('ERROR: {} exists and is not a socket; refusing to replace it.'.format(path))
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, _UnixSocketHandler)
+
+    def server_bind(self):
+        # Anyone who can connect can read secrets, so the socket is never reachable beyond mode, not even briefly
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        if self.group is not None:
+            os.chown(self.server_address, -1, self.group)
+        os.chmod(self.server_address, self.mode)
+
+
+def server_ssl_context(cert_path, key_path=None, client_ca=None):
+    """Build the proxy's listening SSLContext; with client_ca set, callers must present a cert signed by it."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+    if client_ca:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(cafile=client_ca)
+    return context
+
+
+def make_server(ccp, listen=None, unix_socket=None, ssl_context=None, verbose=False, socket_mode=0o600, socket_group=None):
+    """Create (but do not start) a proxy server in front of a cert-loaded CCPPasswordREST.
+
+    A Unix socket is created with socket_mode (default 0600, owner only), optionally owned by socket_group.
+    """
+    if unix_socket:
+        return CCPProxyUnixServer(unix_socket, ccp, verbose=verbose, mode=socket_mode, group=socket_group)
+    if ssl_context is None:
+        raise Exception('ERROR: an SSL context is required to listen on a TCP port.')
+    host, _, port = listen.rpartition(':')
+    return CCPProxyHTTPSServer((host or '127.0.0.1', int(port)), ccp, ssl_context, verbose=verbose)
+
+
+def start_zabbix_push(metrics, server, zabbix_host, interval=60, verbose=False):
+    """Push the phase histograms to a Zabbix server ('host[:port]') every interval seconds; returns the stop Event."""
+    host, _, port = server.partition(':')
+    stop = threading.Event()
+
+    def push():
+        while not stop.wait(interval):
+            try:
+                reply = metrics.send_to_zabbix(host, zabbix_host, port=int(port or 10051))
+            except Exception as e:
+                print('ERROR: Zabbix push to {} failed: {}'.format(server, e), file=sys.stderr)
+                continue
+            if verbose:
+                print('Zabbix push: {}'.format(reply.get('info')), file=sys.stderr)
+
+    threading.Thread(target=push, name='ccp-zabbix-push', daemon=True).start()
+    return stop
+
+
+def main(argv=None):
+    load_env()
+    parser = argparse.ArgumentParser(description='Local caching proxy for the CyberArk AIMWebService Accounts API.')
+    parser.add_argument('--listen', default='127.0.0.1:8443', help='HOST:PORT for the HTTPS listener')
+    parser.add_argument('--unix-socket', help='serve plain HTTP on this Unix socket instead of HTTPS')
+    parser.add_argument('--socket-mode', type=lambda value: int(value, 8), default=0o600,
+                        help='permissions of the Unix socket, octal (default: 600, owner only)')
+    parser.add_argument('--socket-group', help='group that owns the Unix socket (use with --socket-mode 660)')
+    parser.add_argument('--tls-cert', help='server certificate presented to local clients')
+    parser.add_argument('--tls-key', help='server private key (if not in --tls-cert)')
+    parser.add_argument('--client-ca', help='require local clients to present a cert signed by this CA (required for --listen)')
+    parser.add_argument('--insecure-no-client-auth', action='store_true',
+                        help='listen on TCP without --client-ca; any local process that can connect can read secrets')
+    parser.add_argument('--upstream', default=os.getenv('AAM_BASE_URI'), help='CCP base URI (default: AAM_BASE_URI)')
+    parser.add_argument('--cert', default=os.getenv('AAM_DEMO_PATH'), help='upstream client certificate (default: AAM_DEMO_PATH)')
+    parser.add_argument('--key', default=os.getenv('AAM_DEMO_KEY_PATH'), help='upstream client key (default: AAM_DEMO_KEY_PATH)')
+    parser.add_argument('--cache-ttl', type=float, default=300)
+    parser.add_argument('--stale-ttl', type=float, default=0)
+    parser.add_argument('--refresh-ahead', type=float, default=None)
+    parser.add_argument('--pool-size', type=int, default=1)
+    parser.add_argument('--transport', choices=transports(), help='upstream http1 keep-alive connections or h2 multiplexing (default: AAM_TRANSPORT, else http1)')
+    parser.add_argument('--no-verify-service', action='store_true')
+    parser.add_argument('--metrics', action='store_true', help='time each upstream lookup per phase (served on {})'.format(METRICS_PATH))
+    parser.add_argument('--zabbix-server', default=os.getenv('AAM_ZABBIX_SERVER'), help='push phase metrics to this Zabbix server/proxy HOST[:PORT] (implies --metrics)')
+    parser.add_argument('--zabbix-host', default=os.getenv('AAM_ZABBIX_HOST') or socket.gethostname(), help='Zabbix host name the trapper items belong to')
+    parser.add_argument('--zabbix-interval', type=float, default=60)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not args.upstream or not args.cert:
+        parser.error('an upstream CCP URI and client certificate are required (--upstream/--cert or AAM_BASE_URI/AAM_DEMO_PATH)')
+    if not args.unix_socket and not args.tls_cert:
+        parser.error('--tls-cert is required unless --unix-socket is used')
+    # Every caller that reaches the port gets secrets, so TCP without client certs must be asked for by name
+    if not args.unix_socket and not args.client_ca and not args.insecure_no_client_auth:
+        parser.error('--client-ca is required unless --unix-socket is used (or pass --insecure-no-client-auth)')
+
+    # The upstream passphrase only comes from the environment so it never shows up in ps output
+    ccp = CCPPasswordREST(verifyService=not args.no_verify_service, base_uri=args.upstream, pool_size=args.pool_size,
+                          cache_ttl=args.cache_ttl, stale_ttl=args.stale_ttl, refresh_ahead=args.refresh_ahead,
+                          metrics=True if args.metrics or args.zabbix_server else None, transport=args.transport)
+    ccp.load_cert_from_path(args.cert, args.key, os.getenv('AAM_PASSPHRASE'))
+
+    ssl_context = None if args.unix_socket else server_ssl_context(args.tls_cert, args.tls_key, args.client_ca)
+    socket_group = None
+    if args.socket_group:
+        import grp
+        socket_group = int(args.socket_group) if args.socket_group.isdigit() else grp.getgrnam(args.socket_group).gr_gid
+    server = make_server(ccp, listen=args.listen, unix_socket=args.unix_socket, ssl_context=ssl_context, verbose=args.verbose,
+                         socket_mode=args.socket_mode, socket_group=socket_group)
+    print('CCP proxy for {} listening on {}'.format(args.upstream, args.unix_socket or args.listen), file=sys.stderr)
+    zabbix_stop = None
+    if args.zabbix_server and ccp.phase_metrics() is not None:
+        zabbix_stop = start_zabbix_push(ccp.phase_metrics(), args.zabbix_server, args.zabbix_host, args.zabbix_interval, args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if zabbix_stop is not None:
+            zabbix_stop.set()
+        server.server_close()
+        ccp.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+import base64
+import contextlib
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import ccp_fork
+
+try:
+    import fcntl
+except ImportError:
+    # No record locks (Windows): writers are not serialised across processes and lease() does not wait
+    fcntl = None
+
+_MAGIC = b'CCPSHM01'
+# File header: magic, slot count, slot size; padded so slots start on a cache line
+_HEADER = struct.Struct('<8sII')
+_HEADER_SIZE = 64
+# Slot header: sequence number (odd while a write is in progress), key name (HMAC-SHA256), wall-clock expiry, token length
+_SLOT = struct.Struct('<Q32sdI4x')
+_SEQ = struct.Struct('<Q')
+_EMPTY_NAME = bytes(32)
+# Slots tried per key before the one expiring soonest is overwritten
+PROBES = 4
+# Attempts at reading a slot that keeps changing underneath before it counts as a miss
+READ_RETRIES = 8
+
+
+class SharedSecretCache(object):
+    """Fernet-encrypted cache of raw CCP response bodies in a memory-mapped file shared by every process on a host.
+
+    The file holds a fixed number of fixed-size slots addressed by an HMAC of the lookup key, so pre-fork
+    workers (gunicorn, multiprocessing) answer each other's lookups. Reads take no lock: a per-slot sequence
+    number detects a concurrent write, and Fernet's MAC rejects anything torn that slips through. Writes
+    hold a short exclusive record lock. lease(key) lets one process fetch a missing secret while its
+    siblings wait for the result. Bodies that do not fit a slot are simply not cached.
+    """
+
+    def __init__(self, path, key=None, ttl=300, slots=4096, slot_size=2048):
+        # Declare Init Variables
+        key = key or os.getenv('ENCRYPTION_KEY')
+        if not key:
+            raise Exception('ERROR: ENCRYPTION_KEY is required to use the shared secret cache.')
+        if slot_size < _SLOT.size + 256:
+            raise Exception('ERROR: Shared cache slots must be at least {} bytes.'.format(_SLOT.size + 256))
+        self._key = key.encode('UTF-8') if isinstance(key, str) else key
+        self._fernet = None
+        self._path = os.path.abspath(path)
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'undecryptable': 0, 'torn': 0, 'writes': 0,
+                       'evicted': 0, 'too_large': 0, 'lease_waits': 0}
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._map(slots, slot_size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        ccp_fork.register(self)
+
+    def _map(self, slots, slot_size):
+        # The first process sizes the file; later ones (and other settings) adopt its geometry
+        self._lock_byte(0)
+        try:
+            if os.fstat(self._fd).st_size < _HEADER_SIZE:
+                os.ftruncate(self._fd, _HEADER_SIZE + slots * slot_size)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, slots, slot_size), 0)
+            magic, slots, slot_size = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))
+            if magic != _MAGIC:
+                raise Exception('ERROR: {} is not a CCP shared cache file.'.format(self._path))
+            self._slots = slots
+            self._slot_size = slot_size
+            self._payload = slot_size - _SLOT.size
+            self._size = _HEADER_SIZE + slots * slot_size
+            self._mm = mmap.mmap(self._fd, self._size)
+        finally:
+            self._unlock_byte(0)
+
+    def _after_fork(self):
+        # The mapping stays shared and record locks are per process, so only the thread lock needs replacing
+        self._lock = threading.Lock()
+
+    def _lock_byte(self, offset, blocking=True):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+
+    def _unlock_byte(self, offset):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+    def _cipher(self):
+        # cryptography is only imported once the cache is actually used
+        if self._fernet is None:
+            from cryptography.fernet import Fernet
+            self._fernet = Fernet(self._key)
+        return self._fernet
+
+    def _name(self, key):
+        return hmac.new(self._key, json.dumps(key).encode('UTF-8'), hashlib.sha256).digest()
+
+    def _probe(self, name):
+        first = int.from_bytes(name[:8], 'little') % self._slots
+        return [(first + i) % self._slots for i in range(min(PROBES, self._slots))]
+
+    def _offset(self, index):
+        return _HEADER_SIZE + index * self._slot_size
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                self._stats[name] += 1
+
+    def _read_slot(self, index, name):
+        # Returns (expiry, token) when the slot holds name, None when it holds something else, False when torn
+        offset = self._offset(index)
+        for _ in range(READ_RETRIES):
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            _, slot_name, expires_at, length = _SLOT.unpack_from(self._mm, offset)
+            if slot_name != name:
+                return None
+            if length <= self._payload:
+                token = self._mm[offset + _SLOT.size:offset + _SLOT.size + length]
+                if _SEQ.unpack_from(self._mm, offset)[0] == seq:
+                    return expires_at, token
+        return False
+
+    def _write_slot(self, index, name, expires_at, token):
+        # Caller holds the write lock; readers see an odd sequence number until the slot is consistent again
+        offset = self._offset(index)
+        seq = _SEQ.unpack_from(self._mm, offset)[0]
+        _SEQ.pack_into(self._mm, offset, seq + 1)
+        _SLOT.pack_into(self._mm, offset, seq + 1, name, expires_at, len(token))
+        end = offset + _SLOT.size + len(token)
+        self._mm[offset + _SLOT.size:end] = token
+        # Clear what a longer previous token left behind
+        self._mm[end:offset + self._slot_size] = bytes(offset + self._slot_size - end)
+        _SEQ.pack_into(self._mm, offset, seq + 2)
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            self._lock_byte(0)
+            try:
+                yield
+            finally:
+                self._unlock_byte(0)
+
+    def get_with_ttl(self, key):
+        """Return (body bytes, seconds left) for a live entry, or (None, 0) on a miss."""
+        name = self._name(key)
+        for index in self._probe(name):
+            entry = self._read_slot(index, name)
+            if entry is None:
+                continue
+            if entry is False:
+                self._count('torn', 'misses')
+                return None, 0
+            expires_at, token = entry
+            remaining = expires_at - time.time()
+            if remaining <= 0:
+                self._count('expired', 'misses')
+                return None, 0
+            try:
+                data = self._cipher().decrypt(base64.urlsafe_b64encode(token))
+            except Exception:
+                # Written under a different ENCRYPTION_KEY, or torn in a way the sequence check missed
+                self._count('undecryptable', 'misses')
+                return None, 0
+            self._count('hits')
+            return data, remaining
+        self._count('misses')
+        return None, 0
+
+    def get(self, key):
+        """Return the cached body for key, or None on a miss or expired entry."""
+        return self.get_with_ttl(key)[0]
+
+    def put(self, key, data, ttl=None):
+        """Encrypt and store a body under key for ttl seconds (default: the cache TTL); False if it does not fit a slot."""
+        expires_at = time.time() + (self._ttl if ttl is None else ttl)
+        # Stored as raw bytes rather than base64 so more fits in a slot
+        token = base64.urlsafe_b64decode(self._cipher().encrypt(bytes(data)))
+        if len(token) > self._payload:
+            self._count('too_large')
+            return False
+        name = self._name(key)
+        with self._writing():
+            now = time.time()
+            chosen = None
+            oldest = None
+            for index in self._probe(name):
+                _, slot_name, slot_expires, _ = _SLOT.unpack_from(self._mm, self._offset(index))
+                if slot_name == name:
+                    chosen = index
+                    break
+                if chosen is None and (slot_name == _EMPTY_NAME or slot_expires <= now):
+                    chosen = index
+                if oldest is None or slot_expires < oldest[1]:
+                    oldest = (index, slot_expires)
+            if chosen is None:
+                chosen = oldest[0]
+                self._stats['evicted'] += 1
+            self._write_slot(chosen, name, expires_at, token)
+            self._stats['writes'] += 1
+        return True
+
+    @contextlib.contextmanager
+    def lease(self, key):
+        """Hold the fetch lease for key: other processes entering lease() for it wait until this one is done.
+
+        Leases are POSIX record locks past the end of the file, released if the holder dies. They are per
+        process, so threads of one process share them (SingleFlight already collapses those).
+        """
+        if fcntl is None:
+            yield
+            return
+        offset = self._size + self._probe(self._name(key))[0]
+        try:
+            self._lock_byte(offset, blocking=False)
+        except OSError:
+            self._count('lease_waits')
+            try:
+                self._lock_byte(offset)
+            except OSError:
+                # EDEADLK between two processes' leases: fetch without one rather than fail the lookup
+                yield
+                return
+        try:
+            yield
+        finally:
+            self._unlock_byte(offset)
+
+    def invalidate(self, key):
+        """Drop one entry; returns True if it was there."""
+        name = self._name(key)
+        with self._writing():
+            for index in self._probe(name):
+                if _SLOT.unpack_from(self._mm, self._offset(index))[1] == name:
+                    self._write_slot(index, _EMPTY_NAME, 0.0, b'')
+                    return True
+        return False
+
+    def clear(self):
+        """Zero every slot."""
+        with self._writing():
+            for index in range(self._slots):
+                if _SLOT.unpack_from(self._mm, self._offset(index))[1] != _EMPTY_NAME:
+                    self._write_slot(index, _EMPTY_NAME, 0.0, b'')
+
+    def stats(self):
+        """Return this process's hit/miss/write counters plus live entries and slot geometry of the shared file."""
+        now = time.time()
+        entries = 0
+        for index in range(self._slots):
+            _, name, expires_at, _ = _SLOT.unpack_from(self._mm, self._offset(index))
+            if name != _EMPTY_NAME and expires_at > now:
+                entries += 1
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot.update(entries=entries, slots=self._slots, slot_size=self._slot_size)
+        return snapshot
+
+    def close(self):
+        """Unmap the file; entries stay for the other processes."""
+        self._mm.close()
+        os.close(self._fd)
@@ -0,0 +1,115 @@
+import threading
+import ccp_fork
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls with the same key into one execution shared by every caller (threads)."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0}
+        ccp_fork.register(self)
+
+    def _after_fork(self):
+        # Leaders of calls in flight at fork time are parent threads; waiting on them would hang forever
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Run fn() once per in-flight key; concurrent callers get the same result or exception."""
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._stats['executed'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Return calls/executed/coalesced counters and the number of keys currently in flight."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['in_flight'] = len(self._calls)
+        return snapshot
+
+
+class AsyncSingleFlight(object):
+    """asyncio counterpart of SingleFlight; in-flight calls are tracked per event loop."""
+
+    def __init__(self):
+        self._calls = {}
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0}
+
+    async def do(self, key, coro_fn):
+        """Await coro_fn() once per in-flight key; concurrent callers share its result or exception.
+
+        The fetch runs in its own task, so a caller that is cancelled (e.g. by its own timeout) only stops
+        waiting; the others still get the result. The fetch is cancelled once no caller is waiting for it.
+        """
+        # Imported here so the thread-only SingleFlight does not pull in asyncio
+        import asyncio
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        self._stats['calls'] += 1
+        call = self._calls.get(key)
+        if call is not None:
+            self._stats['coalesced'] += 1
+        else:
+            self._stats['executed'] += 1
+            call = self._calls[key] = [loop.create_task(coro_fn()), 0]
+            call[0].add_done_callback(lambda task: self._finished(key, call))
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if not call[0].done() and call[1] == 1:
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def _finished(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        task = call[0]
+        if not task.cancelled():
+            # Mark retrieved so an exception nobody was left to await is not logged as unhandled
+            task.exception()
+
+    def stats(self):
+        """Return calls/executed/coalesced counters and the number of keys currently in flight."""
+        snapshot = dict(self._stats)
+        snapshot['in_flight'] = len(self._calls)
+        return snapshot
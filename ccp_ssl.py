@@ -0,0 +1,184 @@
+import contextlib
+import hashlib
+import http.client
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import weakref
+import ccp_fork
+
+
+# Loaded contexts keyed by (cert path, key path); each entry remembers the file mtimes it was built from
+_CONTEXTS = {}
+_CONTEXTS_LOCK = threading.Lock()
+# Last TLS session per host, kept per context because sessions only resume under the context that created them
+_SESSIONS = weakref.WeakKeyDictionary()
+_SESSIONS_LOCK = threading.Lock()
+# Contexts built from in-memory PEM material, keyed by a digest of cert/key/passphrase
+_PEM_CONTEXTS = {}
+_STATS = {'context_loads': 0, 'context_hits': 0, 'handshakes': 0, 'resumed': 0, 'memfd_loads': 0, 'tmpfs_loads': 0}
+
+
+@ccp_fork.at_fork
+def _reset_after_fork():
+    # Contexts are immutable once loaded (and OpenSSL reseeds its RNG in the child), so they are kept;
+    # the locks and the per-host TLS sessions the parent negotiated are not shared with the child
+    global _CONTEXTS_LOCK, _SESSIONS_LOCK
+    _CONTEXTS_LOCK = threading.Lock()
+    _SESSIONS_LOCK = threading.Lock()
+    _SESSIONS.clear()
+
+
+def _secret_digest(secret):
+    # Keys the context caches by passphrase without keeping the passphrase itself around
+    secret = b'' if secret is None else (secret.encode('UTF-8') if isinstance(secret, str) else secret)
+    return hashlib.sha256(secret).digest()
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns if path else None
+
+
+def _offer_alpn(context, alpn):
+    if alpn:
+        context.set_alpn_protocols(list(alpn))
+
+
+def get_ssl_context(cert_path, password=None, key_path=None, alpn=None):
+    """Return a shared client SSLContext for the cert/key pair, decrypting the key only once.
+
+    The context is rebuilt automatically when either file changes on disk, and a different password
+    gets its own context (so a wrong one is reported, not masked by a cached load). alpn (e.g. ('h2',)) gives
+    a separate context offering those protocols, so HTTP/1.1 connections never negotiate HTTP/2.
+    """
+    key = (os.path.abspath(cert_path), os.path.abspath(key_path) if key_path else None, tuple(alpn or ()), _secret_digest(password))
+    mtimes = (_mtime(key[0]), _mtime(key[1]))
+    with _CONTEXTS_LOCK:
+        entry = _CONTEXTS.get(key)
+        if entry is not None and entry[0] == mtimes:
+            _STATS['context_hits'] += 1
+            return entry[1]
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        context.load_cert_chain(certfile=cert_path, keyfile=key_path, password=password)
+        _offer_alpn(context, alpn)
+        _CONTEXTS[key] = (mtimes, context)
+        _STATS['context_loads'] += 1
+    return context
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+@contextlib.contextmanager
+def _pem_paths(*pems):
+    """Expose PEM strings as file paths for load_cert_chain without writing them to a real disk.
+
+    Uses anonymous memory-backed files (memfd, Linux) reached through /proc/self/fd; otherwise a
+    private 0700 directory on tmpfs (/dev/shm or XDG_RUNTIME_DIR when available) removed on exit.
+    """
+    pems = [pem.encode('UTF-8') if isinstance(pem, str) else pem for pem in pems]
+    if hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd'):
+        fds = []
+        try:
+            for pem in pems:
+                fd = os.memfd_create('ccp-pem', os.MFD_CLOEXEC)
+                fds.append(fd)
+                _write_all(fd, pem)
+            _STATS['memfd_loads'] += 1
+            yield ['/proc/self/fd/{}'.format(fd) for fd in fds]
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return
+
+    base = None
+    for candidate in ('/dev/shm', os.getenv('XDG_RUNTIME_DIR')):
+        if candidate and os.path.isdir(candidate) and os.access(candidate, os.W_OK):
+            base = candidate
+            break
+    # mkdtemp gives a fresh 0700 directory, so concurrent workers never collide on file names
+    directory = tempfile.mkdtemp(prefix='ccp-pem-', dir=base)
+    try:
+        paths = []
+        for i, pem in enumerate(pems):
+            path = os.path.join(directory, '{}.pem'.format(i))
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                _write_all(fd, pem)
+            finally:
+                os.close(fd)
+            paths.append(path)
+        _STATS['tmpfs_loads'] += 1
+        yield paths
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def get_ssl_context_from_pem(cert_pem, key_pem=None, password=None, alpn=None):
+    """Return a shared client SSLContext built from PEM strings held in memory (e.g. environment variables).
+
+    The material never touches the working directory, and the context is built once per process
+    for each distinct cert/key/passphrase.
+    """
+    digest = hashlib.sha256()
+    for part in (cert_pem, key_pem, password):
+        part = b'' if part is None else (part.encode('UTF-8') if isinstance(part, str) else part)
+        digest.update(len(part).to_bytes(8, 'big') + part)
+    key = (digest.digest(), tuple(alpn or ()))
+    with _CONTEXTS_LOCK:
+        context = _PEM_CONTEXTS.get(key)
+        if context is not None:
+            _STATS['context_hits'] += 1
+            return context
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        pems = [cert_pem] if key_pem is None else [cert_pem, key_pem]
+        with _pem_paths(*pems) as paths:
+            context.load_cert_chain(certfile=paths[0], keyfile=paths[1] if key_pem is not None else None, password=password)
+        _offer_alpn(context, alpn)
+        _PEM_CONTEXTS[key] = context
+        _STATS['context_loads'] += 1
+    return context
+
+
+def _get_session(context, host):
+    with _SESSIONS_LOCK:
+        return _SESSIONS.get(context, {}).get(host)
+
+
+def _store_session(context, host, session):
+    with _SESSIONS_LOCK:
+        _SESSIONS.setdefault(context, {})[host] = session
+
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that offers the last TLS session for its host so repeat handshakes are abbreviated."""
+
+    def connect(self):
+        # Plain TCP connect first, then wrap with the cached session (http.client does not expose session=)
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        session = _get_session(self._context, self.host)
+        try:
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+        except ssl.SSLError:
+            if session is None:
+                raise
+            # A stale session can be rejected outright; retry once with a full handshake
+            _store_session(self._context, self.host, None)
+            http.client.HTTPConnection.connect(self)
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+        _STATS['handshakes'] += 1
+        if self.sock.session_reused:
+            _STATS['resumed'] += 1
+        elif self.sock.session is not None:
+            _store_session(self._context, self.host, self.sock.session)
+
+
+def tls_stats():
+    """Return counters for context loads/hits, memfd/tmpfs PEM loads and full vs resumed handshakes."""
+    return dict(_STATS)
@@ -0,0 +1,75 @@
+import importlib
+import importlib.util
+import os
+import sys
+
+# Transport name -> (thread pool, asyncio pool). Entries may be 'module:Class' strings so a backend is only
+# imported once something asks for it. Every pool takes (host, context, maxsize=..., idle_timeout=...) plus
+# the HTTPSConnectionPool or AsyncHTTPSConnectionPool timeouts, and serves request()/stats()/close().
+_TRANSPORTS = {
+    # Pooled HTTP/1.1 keep-alive connections over http.client (or asyncio streams): one request per socket at a time
+    'http1': ('ccp_pool:HTTPSConnectionPool', 'ccp_async:AsyncHTTPSConnectionPool'),
+    # Many concurrent requests as streams of one HTTP/2 connection per node (needs the h2 package)
+    'h2': ('ccp_h2:H2ConnectionPool', 'ccp_async:AsyncH2ConnectionPool'),
+}
+DEFAULT_TRANSPORT = 'http1'
+# Transport name -> package it needs; without that package the transport falls back to DEFAULT_TRANSPORT
+_REQUIRES = {'h2': 'h2'}
+# Transport name -> whether its package is importable (looked up once, without importing it)
+_AVAILABLE = {}
+
+
+def register_transport(name, pool=None, async_pool=None, requires=None):
+    """Add or replace a transport; pool / async_pool are classes or 'module:Class' strings (None if unsupported).
+
+    requires names a package the transport needs; while it is not installed the default transport is used.
+    """
+    _TRANSPORTS[name] = (pool, async_pool)
+    _AVAILABLE.pop(name, None)
+    if requires:
+        _REQUIRES[name] = requires
+    else:
+        _REQUIRES.pop(name, None)
+
+
+def available(name):
+    """Return whether the package a transport needs (if any) is installed."""
+    if name not in _AVAILABLE:
+        package = _REQUIRES.get(name)
+        _AVAILABLE[name] = package is None or importlib.util.find_spec(package) is not None
+        if not _AVAILABLE[name]:
+            print('WARNING: The {} transport needs the {} package (pip install {}); using {} instead.'.format(
+                name, package, package, DEFAULT_TRANSPORT), file=sys.stderr)
+    return _AVAILABLE[name]
+
+
+def transports():
+    """Return the registered transport names."""
+    return sorted(_TRANSPORTS)
+
+
+def resolve_transport(name=None):
+    """Return name, else AAM_TRANSPORT, else 'http1', after checking it is registered.
+
+    A transport whose package is missing (h2 without the h2 package) falls back to 'http1' with a warning.
+    """
+    name = name or os.getenv('AAM_TRANSPORT') or DEFAULT_TRANSPORT
+    if name not in _TRANSPORTS:
+        raise Exception('ERROR: Unknown transport {!r}; expected one of {}.'.format(name, ', '.join(transports())))
+    return name if available(name) else DEFAULT_TRANSPORT
+
+
+def pool_class(name, asynchronous=False):
+    """Return the thread (or asyncio) connection pool class behind a transport."""
+    entry = _TRANSPORTS[resolve_transport(name)][1 if asynchronous else 0]
+    if entry is None:
+        raise Exception('ERROR: The {} transport has no {} pool.'.format(name, 'asyncio' if asynchronous else 'thread'))
+    if isinstance(entry, str):
+        module, _, attr = entry.partition(':')
+        entry = getattr(importlib.import_module(module), attr)
+    return entry
+
+
+def alpn_protocols(name, asynchronous=False):
+    """ALPN protocols an SSLContext must offer for the transport (None when it needs none)."""
+    return getattr(pool_class(name, asynchronous), 'ALPN', None)
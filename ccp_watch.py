@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+from ccp_env import getenv, load_env
+from ccp_metrics import zabbix_send
+from cyberark_cert_auth import CCPBatch, read_record, record_query
+from ccp_transport import transports
+
+DEFAULT_INTERVAL = 300
+# Events a sink failed to take are kept for its next delivery, up to this many
+MAX_BACKLOG = 10000
+
+
+class TimerHeap(object):
+    """Deadlines of every watched object in one binary heap.
+
+    Scheduling is O(log n) and finding the next deadline O(1), so tens of thousands of objects
+    need neither a task nor a thread each; the watcher only wakes when something is due.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+
+    def push(self, due, item):
+        heapq.heappush(self._heap, (due, next(self._order), item))
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now, limit):
+        """Remove and return up to limit items whose deadline has passed, earliest first."""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class Watch(object):
+    """One watched object: where to poll it, how often, and a keyed digest of what was seen last."""
+
+    __slots__ = ('object_name', 'safe', 'app_id', 'record_id', 'api_path', 'interval', 'digest', 'in_change', 'failing')
+
+    def __init__(self, object_name, safe, app_id, api_path, interval, record_id=None):
+        self.object_name = object_name
+        self.safe = safe
+        self.app_id = app_id
+        self.record_id = record_id
+        self.api_path = api_path
+        self.interval = interval
+        # HMAC-SHA256 of Content and the last PasswordChangeInProcess flag; None until the first poll
+        self.digest = None
+        self.in_change = None
+        self.failing = False
+
+
+class NDJSONSink(object):
+    """Write each event as one JSON line."""
+
+    def __init__(self, out):
+        self._out = out
+
+    def emit(self, events):
+        for event in events:
+            self._out.write(json.dumps(event) + '\n')
+        self._out.flush()
+
+
+class WebhookSink(object):
+    """POST each event as a JSON body to a local receiver, over one keep-alive connection per delivery."""
+
+    def __init__(self, url, timeout=5):
+        self._url = url
+        self._parts = urllib.parse.urlsplit(url)
+        if self._parts.scheme not in ('http', 'https'):
+            raise Exception('ERROR: Webhook URL must be http:// or https://, got {!r}.'.format(url))
+        self._timeout = timeout
+
+    def emit(self, events):
+        import http.client
+        connection = http.client.HTTPSConnection if self._parts.scheme == 'https' else http.client.HTTPConnection
+        conn = connection(self._parts.hostname, self._parts.port, timeout=self._timeout)
+        path = self._parts.path or '/'
+        if self._parts.query:
+            path += '?' + self._parts.query
+        try:
+            for event in events:
+                conn.request('POST', path, body=json.dumps(event).encode('UTF-8'), headers={'Content-Type': 'application/json'})
+                res = conn.getresponse()
+                res.read()
+                if res.status >= 300:
+                    raise Exception('ERROR: Webhook {} answered {} {}.'.format(self._url, res.status, res.reason))
+        finally:
+            conn.close()
+
+
+class ZabbixSink(object):
+    """Send changes as trapper items: ccp.secret.changed[safe,object] (unix time of the rotation) and
+    ccp.secret.change_in_process[safe,object] (0/1)."""
+
+    def __init__(self, server, zabbix_host, port=10051, timeout=5):
+        self._server = server
+        self._zabbix_host = zabbix_host
+        self._port = port
+        self._timeout = timeout
+
+    def emit(self, events):
+        items = []
+        for event in events:
+            params = ','.join('"{}"'.format(str(value).replace('"', '')) for value in (event['safe'], event['object']))
+            clock = int(event['time'])
+            if 'Content' in event['changed']:
+                items.append({'host': self._zabbix_host, 'key': 'ccp.secret.changed[{}]'.format(params), 'value': str(clock), 'clock': clock})
+            items.append({'host': self._zabbix_host, 'key': 'ccp.secret.change_in_process[{}]'.format(params),
+                          'value': '1' if event['PasswordChangeInProcess'] else '0', 'clock': clock})
+        reply = zabbix_send(self._server, items, port=self._port, timeout=self._timeout)
+        if reply.get('response') != 'success':
+            raise Exception('ERROR: Zabbix server {} rejected the items: {}'.format(self._server, reply.get('info')))
+
+
+class SecretWatcher(object):
+    """Poll CCP for many objects on their own intervals and report rotations to sinks.
+
+    Only an HMAC-SHA256 of each password (keyed with ENCRYPTION_KEY, else a per-run random key) and its
+    PasswordChangeInProcess flag are kept. An event is emitted when either changes; the first poll of
+    an object only records a baseline (unless emit_initial). With state_path the digests survive a
+    restart (this needs ENCRYPTION_KEY), so rotations while the watcher was down are still reported.
+    Connection settings are the get_passwords_async keyword arguments; the watcher polls through its
+    own CCPBatch, so it shares no pool, limit or cache with other lookups in the process.
+    """
+
+    def __init__(self, sinks, interval=DEFAULT_INTERVAL, max_concurrent=10, jitter=0.1, emit_initial=False, state_path=None, key=None, **kwargs):
+        # Declare Init Variables
+        key = key or getenv('ENCRYPTION_KEY')
+        if state_path and not key:
+            raise Exception('ERROR: ENCRYPTION_KEY is required to keep watch state in {}.'.format(state_path))
+        self._key = key.encode('UTF-8') if isinstance(key, str) else (key or os.urandom(32))
+        self._batch = CCPBatch(max_concurrent, **kwargs)
+        self._watches = []
+        self._sinks = [(sink, []) for sink in sinks]
+        self._interval = interval
+        self._jitter = jitter
+        self._emit_initial = emit_initial
+        self._state_path = state_path
+        self._dirty = False
+        self._timers = TimerHeap()
+        self._stop = None
+        self._stats = {'watched': 0, 'polls': 0, 'baselined': 0, 'changes': 0, 'errors': 0,
+                       'events': 0, 'sink_errors': 0, 'dropped_events': 0}
+
+    def add(self, line):
+        """Watch the object on one input line: a name, or a JSON record as accepted by --stream plus "interval"."""
+        record = read_record(line)
+        object_name, overrides, record_id = record_query(record)
+        config = dict(self._batch.config, **overrides)
+        watch = Watch(object_name, config['safe_name'], config['app_id'], self._batch.api_path(object_name, **overrides),
+                      float(record.get('interval') or self._interval), record_id)
+        self._watches.append(watch)
+        self._stats['watched'] += 1
+        return watch
+
+    def _load_state(self):
+        try:
+            with open(self._state_path) as file:
+                seen = json.load(file).get('watches', {})
+        except FileNotFoundError:
+            return
+        for watch in self._watches:
+            entry = seen.get(watch.api_path)
+            if entry is not None:
+                watch.digest, watch.in_change = bytes.fromhex(entry[0]), entry[1]
+
+    def save_state(self):
+        """Write the digests atomically to state_path (no-op without one or when nothing changed)."""
+        if not self._state_path or not self._dirty:
+            return
+        seen = {watch.api_path: [watch.digest.hex(), watch.in_change] for watch in self._watches if watch.digest is not None}
+        directory = os.path.dirname(os.path.abspath(self._state_path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.ccp-watch-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'version': 1, 'watches': seen}, file)
+            os.replace(tmp_path, self._state_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._dirty = False
+
+    def _digest(self, content):
+        return hmac.new(self._key, content.encode('UTF-8'), hashlib.sha256).digest()
+
+    async def _poll(self, watch):
+        try:
+            status, data = await self._batch.fetch(watch.api_path)
+        except Exception as e:
+            return watch, None, str(e)
+        if status != 200 or data.get('Content') is None:
+            return watch, None, 'CCP returned {} {}: {}'.format(status, data.get('ErrorCode'), data.get('ErrorMsg'))
+        in_change = str(data.get('PasswordChangeInProcess', '')).lower() == 'true'
+        return watch, (self._digest(data['Content']), in_change), None
+
+    def _observe(self, watch, seen, error):
+        # Reschedule first so a failing object keeps its place; jitter keeps objects from moving in lockstep
+        self._timers.push(time.monotonic() + watch.interval * (1 + random.uniform(-self._jitter, self._jitter)), watch)
+        self._stats['polls'] += 1
+        if error is not None:
+            self._stats['errors'] += 1
+            if not watch.failing:
+                watch.failing = True
+                print('WARNING: {}/{}: {}'.format(watch.safe, watch.object_name, error), file=sys.stderr)
+            return None
+        watch.failing = False
+        digest, in_change = seen
+        changed = []
+        if watch.digest is None:
+            self._stats['baselined'] += 1
+            if self._emit_initial:
+                changed = ['initial']
+        else:
+            if not hmac.compare_digest(digest, watch.digest):
+                changed.append('Content')
+            if in_change != watch.in_change:
+                changed.append('PasswordChangeInProcess')
+        if watch.digest != digest or watch.in_change != in_change:
+            watch.digest, watch.in_change = digest, in_change
+            self._dirty = True
+        if not changed:
+            return None
+        if changed != ['initial']:
+            self._stats['changes'] += 1
+        event = {'event': 'changed', 'object': watch.object_name, 'safe': watch.safe, 'app_id': watch.app_id,
+                 'changed': changed, 'PasswordChangeInProcess': in_change, 'time': round(time.time(), 3)}
+        if watch.record_id is not None:
+            event['id'] = watch.record_id
+        return event
+
+    async def _emit(self, events):
+        loop = asyncio.get_running_loop()
+        self._stats['events'] += len(events)
+        for sink, backlog in self._sinks:
+            backlog.extend(events)
+            try:
+                # Sinks block (files, HTTP, Zabbix), so they run off the event loop
+                await loop.run_in_executor(None, sink.emit, list(backlog))
+            except Exception as e:
+                self._stats['sink_errors'] += 1
+                print('WARNING: {} failed, {} event(s) kept for the next delivery: {}'.format(type(sink).__name__, len(backlog), e), file=sys.stderr)
+                if len(backlog) > MAX_BACKLOG:
+                    self._stats['dropped_events'] += len(backlog) - MAX_BACKLOG
+                    del backlog[:len(backlog) - MAX_BACKLOG]
+            else:
+                del backlog[:]
+
+    def stop(self):
+        """Ask run() to return after the polls in flight; safe to call from a signal handler on the loop."""
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self, duration=None, state_interval=10):
+        """Watch until stop() (or for duration seconds), then save the state; returns stats()."""
+        self._stop = asyncio.Event()
+        if self._state_path:
+            self._load_state()
+        await self._batch.open()
+        # Everything starts due now: the first round records baselines (or reports what changed while down)
+        self._timers = TimerHeap()
+        now = time.monotonic()
+        for watch in self._watches:
+            self._timers.push(now, watch)
+        window = self._batch.workers * 2
+        deadline = None if duration is None else now + duration
+        saved_at = now
+        pending = set()
+        stopper = asyncio.ensure_future(self._stop.wait())
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                for watch in self._timers.pop_due(now, window - len(pending)):
+                    pending.add(asyncio.ensure_future(self._poll(watch)))
+                if now - saved_at >= state_interval:
+                    self.save_state()
+                    saved_at = now
+                # Sleep until a poll finishes, the next deadline (if there is room to start it), or stop()
+                next_due = self._timers.next_due()
+                timeout = None if next_due is None or len(pending) >= window else max(0.0, next_due - now)
+                if deadline is not None:
+                    timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+                if not pending and timeout is None:
+                    break
+                done, _ = await asyncio.wait(pending | {stopper}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                events = []
+                for task in done:
+                    if task is stopper:
+                        continue
+                    pending.discard(task)
+                    event = self._observe(*task.result())
+                    if event is not None:
+                        events.append(event)
+                if events:
+                    await self._emit(events)
+        finally:
+            stopper.cancel()
+            for task in pending:
+                task.cancel()
+            await self._batch.close()
+            self.save_state()
+        return self.stats()
+
+    def stats(self):
+        """Return watched/poll/change/error counters and event delivery failures."""
+        return dict(self._stats)
+
+    def batch_stats(self):
+        """Return the watcher's own pool, coalescing and limiter counters (see CCPBatch.stats)."""
+        return self._batch.stats()
+
+
+def _read_lines(args):
+    if args.objects:
+        return args.objects
+    source = open(args.input) if args.input else sys.stdin
+    try:
+        return [line.strip() for line in source if line.strip()]
+    finally:
+        if args.input:
+            source.close()
+
+
+def main(argv=None):
+    # .env first: the option defaults below and ENCRYPTION_KEY come from it
+    load_env()
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(prog='ccp watch', description='Watch CyberArk CCP objects and report password rotations.')
+    parser.add_argument('objects', nargs='*', help='object names (default: read names or JSON records from --input or stdin)')
+    parser.add_argument('--input', help='file of object names or JSON records such as {"object": "db01", "safe": "Linux", "interval": 60}')
+    parser.add_argument('--interval', type=float, default=float(os.getenv('AAM_WATCH_INTERVAL', DEFAULT_INTERVAL)),
+                        help='seconds between polls of an object without its own interval (default: AAM_WATCH_INTERVAL or 300)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='spread each interval by +/- this fraction')
+    parser.add_argument('--max-concurrent', type=int, default=10, help='concurrent CCP requests')
+    parser.add_argument('--output', help='append NDJSON events to this file (default: stdout unless another sink is set)')
+    parser.add_argument('--webhook', default=os.getenv('AAM_WATCH_WEBHOOK'), help='POST each event as JSON to this URL (default: AAM_WATCH_WEBHOOK)')
+    parser.add_argument('--zabbix-server', default=os.getenv('AAM_ZABBIX_SERVER'), help='send changes as trapper items to this HOST[:PORT]')
+    parser.add_argument('--zabbix-host', default=os.getenv('AAM_ZABBIX_HOST') or socket.gethostname(), help='Zabbix host name the items belong to')
+    parser.add_argument('--state', default=os.getenv('AAM_WATCH_STATE'), help='keep digests in this file across restarts (needs ENCRYPTION_KEY)')
+    parser.add_argument('--emit-initial', action='store_true', help='also emit an event for every object on its first poll')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds (default: run until interrupted)')
+    parser.add_argument('--transport', choices=transports(), help='http1 keep-alive connections or h2 multiplexing (default: AAM_TRANSPORT, else http1)')
+    args = parser.parse_args(argv)
+
+    lines = _read_lines(args)
+    if not lines:
+        parser.error('no objects to watch')
+
+    sinks = []
+    output = None
+    if args.output:
+        output = open(args.output, 'a')
+        sinks.append(NDJSONSink(output))
+    if args.webhook:
+        sinks.append(WebhookSink(args.webhook))
+    if args.zabbix_server:
+        host, _, port = args.zabbix_server.partition(':')
+        sinks.append(ZabbixSink(host, args.zabbix_host, port=int(port or 10051)))
+    if not sinks:
+        sinks.append(NDJSONSink(sys.stdout))
+
+    watcher = SecretWatcher(sinks, interval=args.interval, max_concurrent=args.max_concurrent, jitter=args.jitter,
+                            emit_initial=args.emit_initial, state_path=args.state, transport=args.transport)
+    for line in lines:
+        watcher.add(line)
+
+    async def run():
+        import signal
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, watcher.stop)
+        except (NotImplementedError, AttributeError):
+            pass
+        return await watcher.run(duration=args.duration)
+
+    print('Watching {} object(s)'.format(len(lines)), file=sys.stderr)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not None:
+            output.close()
+        print(json.dumps(watcher.stats()), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,79 +1,501 @@
 import os
-import ssl
 import json
 import urllib.parse
 import sys
 import asyncio
-from dotenv import load_dotenv
 import time
+from ccp_account import project
+from ccp_disk_cache import DiskSecretCache
+from ccp_env import load_env
+from ccp_limiter import LIMITER_POLICIES, AdaptiveLimit, AsyncLimitedPool
+from ccp_metrics import export_from_env, outcome_for, resolve_metrics
+from ccp_ssl import get_ssl_context
+from ccp_endpoints import AsyncFailoverPool, split_endpoints
+from ccp_singleflight import AsyncSingleFlight
+from ccp_transport import alpn_protocols, resolve_transport, transports
 
-load_dotenv()
+_flight = AsyncSingleFlight()
+# Pool counters (with per-node balance detail) from the most recent get_passwords_async batch
+_last_pool_stats = None
+# Adaptive concurrency limit of the most recent batch (None when it ran at a fixed limit)
+_last_limit = None
+
+
+def _resolve_config(kwargs):
+    """Resolve connection settings from kwargs, falling back to the environment."""
+    load_env()
+    host = kwargs.get('host') or os.getenv('AAM_BASE_URI')
+    return {
+        'app_id': kwargs.get('app_id') or os.getenv('AAM_APP_ID'),
+        'safe_name': kwargs.get('safe_name') or os.getenv('AAM_SAFE'),
+        # One or more CCP nodes (comma-separated AAM_BASE_URI); the joined string also keys caches
+        'host': ','.join(split_endpoints(host or '')),
+        'cert_path': kwargs.get('cert_path') or os.getenv('AAM_DEMO_PATH'),
+        'cert_password': kwargs.get('cert_password') or os.getenv('AAM_PASSPHRASE'),
+        'timeout': kwargs.get('timeout') or float(os.getenv('AAM_TIMEOUT', 30)),
+        'connect_timeout': kwargs.get('connect_timeout') or float(os.getenv('AAM_CONNECT_TIMEOUT', 5)),
+        # Hedged mode duplicates a slow request onto the next node
+        'hedge': kwargs.get('hedge') or os.getenv('AAM_HEDGE', 'false').lower() == 'true',
+        # Node selection: ordered (failover only), ewma or p2c
+        'balance': kwargs.get('balance') or os.getenv('AAM_BALANCE', 'ordered'),
+        # http1 keep-alive streams (default) or h2, multiplexing the batch over one connection per node
+        'transport': resolve_transport(kwargs.get('transport')),
+        # Opt-in encrypted cache file so repeat runs within the TTL skip CCP entirely
+        'disk_cache': kwargs.get('disk_cache') or os.getenv('AAM_DISK_CACHE'),
+        'disk_cache_ttl': kwargs.get('disk_cache_ttl') or float(os.getenv('AAM_DISK_CACHE_TTL', 300)),
+        # Per-phase latency histograms: a ccp_metrics.PhaseMetrics, True for the shared one, else AAM_METRICS
+        'metrics': resolve_metrics(kwargs.get('metrics')),
+        # Batches adapt their concurrency to CCP's latency and throttling with aimd or gradient (default: fixed)
+        'limiter': kwargs.get('limiter') or os.getenv('AAM_LIMITER') or None,
+        'min_limit': int(kwargs.get('min_limit') or os.getenv('AAM_MIN_LIMIT', 1)),
+        'max_limit': int(kwargs.get('max_limit') or os.getenv('AAM_MAX_LIMIT', 100)),
+    }
+
+
+def _make_pool(config, context, maxsize=100):
+    return AsyncFailoverPool(config['host'], context, maxsize=maxsize, timeout=config['timeout'],
+                             connect_timeout=config['connect_timeout'], hedge=config['hedge'], balance=config['balance'],
+                             transport=config['transport'])
+
+
+def _context(config):
+    return get_ssl_context(config['cert_path'], config['cert_password'], alpn=alpn_protocols(config['transport'], asynchronous=True))
+
+
+def _build_batch(config, context, max_concurrent):
+    """Return (semaphore, pool, workers, adaptive limit or None) for a batch.
+
+    At a fixed limit the semaphore caps concurrency at max_concurrent. With a limiter the pool gates
+    requests at the adaptive limit, which starts at max_concurrent, and the semaphore only caps it at max_limit.
+    """
+    if not config['limiter']:
+        return asyncio.Semaphore(max_concurrent), _make_pool(config, context, maxsize=max_concurrent), max_concurrent, None
+    limit = AdaptiveLimit(initial=max_concurrent, min_limit=config['min_limit'], max_limit=config['max_limit'], policy=config['limiter'])
+    pool = AsyncLimitedPool(_make_pool(config, context, maxsize=config['max_limit']), limit)
+    return asyncio.Semaphore(config['max_limit']), pool, config['max_limit'], limit
+
+
+def _make_batch(config, context, max_concurrent):
+    """Return (semaphore, pool, workers) for a batch, keeping its limit for limiter_stats()."""
+    global _last_limit
+    semaphore, pool, workers, _last_limit = _build_batch(config, context, max_concurrent)
+    return semaphore, pool, workers
+
+
+_DONE = object()
+
+
+async def _run_workers(items, workers, handle):
+    """Run handle(item) for every item on a fixed set of workers fed through a bounded queue.
+
+    Only about 2 x workers items are pending at any time; the first exception cancels the rest.
+    """
+    queue = asyncio.Queue(maxsize=workers * 2)
+
+    async def produce():
+        for item in items:
+            await queue.put(item)
+        for _ in range(workers):
+            await queue.put(_DONE)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            await handle(item)
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(work()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _api_path(config, object_name):
+    query = urllib.parse.quote(f"Safe={config['safe_name']};Object={object_name}")
+    return f"/AIMWebService/api/Accounts?AppID={config['app_id']}&Query={query}"
+
+
+def _cached_response(cache, config, api_path):
+    data = cache.get([config['host'], api_path])
+    if data is None:
+        return None
+    return json.loads(data.decode())
+
+
+def _cached_result(cache, config, api_path, fields=None):
+    # The cached password, or with fields an AccountResult of those properties; None when not cached
+    response = _cached_response(cache, config, api_path)
+    if response is None or response.get('Content') is None:
+        return None
+    return project(response, fields) if fields is not None else response['Content']
 
 
 async def get_password(object_name, semaphore, **kwargs):
-    """Get password from CyberArk for specified object name with semaphore control."""
-    import http.client
-    
-    async with semaphore:
-        # Config from env or kwargs
-        app_id = kwargs.get('app_id') or os.getenv('AAM_APP_ID')
-        safe_name = kwargs.get('safe_name') or os.getenv('AAM_SAFE')
-        host = kwargs.get('host') or os.getenv('AAM_BASE_URI')
-        cert_path = kwargs.get('cert_path') or os.getenv('AAM_DEMO_PATH')
-        cert_password = kwargs.get('cert_password') or os.getenv('AAM_PASSPHRASE')
-        
-        host = host.replace('https://', '')
-        
-        # Build query and API path
-        query = urllib.parse.quote(f"Safe={safe_name};Object={object_name}")
-        api_path = f"/AIMWebService/api/Accounts?AppID={app_id}&Query={query}"
-        
-        # SSL context with password-protected cert
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        context.load_cert_chain(certfile=cert_path, password=cert_password)
-        
-        # Make API call in thread to avoid blocking
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, lambda: _make_request(host, api_path, context))
-        
-        return object_name, result
-
-
-def _make_request(host, api_path, context):
-    """Blocking HTTP request in separate thread."""
-    import http.client
-    conn = http.client.HTTPSConnection(host, context=context)
-    conn.request('GET', api_path)
-    response = conn.getresponse()
-    data = json.loads(response.read().decode())
-    conn.close()
-    return data.get('Content')
+    """Get password from CyberArk for specified object name with semaphore control.
+
+    Concurrent calls for the same host/app/safe/object share one in-flight request. With fields
+    (CCP property names, e.g. ('Content', 'UserName')) the second item is a ccp_account.AccountResult
+    holding only those properties instead of the password.
+    """
+    response = await _get_response(object_name, semaphore, kwargs)
+    fields = kwargs.get('fields')
+    if fields is not None:
+        return object_name, project(response, fields)
+    return object_name, response.get('Content')
+
+
+async def _get_response(object_name, semaphore, kwargs):
+    # Body of get_password; returns the whole decoded CCP response so callers can report ErrorCode/ErrorMsg
+    # Config from env or kwargs
+    config = _resolve_config(kwargs)
+    
+    # Build query and API path
+    api_path = _api_path(config, object_name)
+    
+    # On-disk cache: shared instance from get_passwords_async, or a write-through one when called directly
+    cache = kwargs.get('cache')
+    if cache is None and config['disk_cache']:
+        cache = DiskSecretCache(config['disk_cache'], ttl=config['disk_cache_ttl'])
+    if cache is not None:
+        response = _cached_response(cache, config, api_path)
+        if response is not None and response.get('Content') is not None:
+            return response
+    
+    async def fetch():
+        metrics = config['metrics']
+        timer = metrics.timer(config['app_id'], config['host']) if metrics is not None else None
+        async with semaphore:
+            # Shared SSL context: the password-protected key is decrypted once and reloaded if the cert changes
+            context = _context(config)
+            
+            # Native asyncio request over a pooled keep-alive connection (one-off pool when called directly)
+            pool = kwargs.get('pool')
+            owns_pool = pool is None
+            if owns_pool:
+                pool = _make_pool(config, context)
+            try:
+                response = await pool.request('GET', api_path, timer=timer)
+            except Exception:
+                if timer is not None:
+                    timer.finish('error')
+                raise
+            finally:
+                if owns_pool:
+                    await pool.close()
+            if cache is not None and response.status == 200:
+                cache.put([config['host'], api_path], response.body)
+            if timer is not None:
+                timer.skip()
+            data = json.loads(response.body.decode())
+            if timer is not None:
+                timer.mark('decode')
+                timer.finish(outcome_for(response.status))
+            return data
+    
+    # Waiters do not hold a semaphore slot while the leading call fetches
+    return await _flight.do((config['host'], api_path), fetch)
+
+
+def singleflight_stats():
+    """Return how many get_password calls were coalesced onto an in-flight request."""
+    return _flight.stats()
+
+
+def pool_stats():
+    """Return pool counters and per-node stats (requests, chosen, in_flight, ewma_ms, p95_ms) of the last batch."""
+    return _last_pool_stats
+
+
+def limiter_stats():
+    """Return the last batch's adaptive limit (limit, bounds, counters, history of (seconds, limit)); None if it was fixed."""
+    return _last_limit.stats() if _last_limit is not None else None
+
+
+class CCPBatch(object):
+    """Connection pool, concurrency limit and request coalescing owned by one long-running caller.
+
+    get_passwords_async and stream_passwords set up the same per call but report through the
+    module-level stats functions; a CCPBatch shares no state with them or with other instances.
+    Settings are the get_passwords_async keyword arguments. The pool exists between open() and
+    close(), or inside "async with batch:"; a closed batch may be opened again. fetch() never reads the disk cache,
+    since its callers want what CCP answers now.
+    """
+
+    def __init__(self, max_concurrent=10, **kwargs):
+        # Declare Init Variables
+        self.config = _resolve_config(kwargs)
+        self.limit = None
+        self.workers = max_concurrent
+        self._max_concurrent = max_concurrent
+        self._flight = AsyncSingleFlight()
+        self._semaphore = None
+        self._pool = None
+        self._pool_stats = None
+
+    def api_path(self, object_name, **overrides):
+        """Return the Accounts API path for object_name; overrides are safe_name/app_id, e.g. from record_query()."""
+        return _api_path(dict(self.config, **overrides) if overrides else self.config, object_name)
+
+    async def open(self):
+        """Create the pool, semaphore and (with a limiter) adaptive limit; a no-op while already open."""
+        if self._pool is None:
+            self._semaphore, self._pool, self.workers, self.limit = _build_batch(self.config, _context(self.config), self._max_concurrent)
+        return self
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def fetch(self, api_path):
+        """GET api_path from CCP and return (HTTP status, decoded JSON body); concurrent fetches of a path share one request."""
+        if self._pool is None:
+            raise Exception('ERROR: CCPBatch is not open; call open() or use "async with batch:" first.')
+        return await self._flight.do(api_path, lambda: self._fetch(api_path))
+
+    async def _fetch(self, api_path):
+        metrics = self.config['metrics']
+        timer = metrics.timer(self.config['app_id'], self.config['host']) if metrics is not None else None
+        async with self._semaphore:
+            try:
+                response = await self._pool.request('GET', api_path, timer=timer)
+            except Exception:
+                if timer is not None:
+                    timer.finish('error')
+                raise
+        if timer is not None:
+            timer.skip()
+        data = json.loads(response.body.decode())
+        if timer is not None:
+            timer.mark('decode')
+            timer.finish(outcome_for(response.status))
+        return response.status, data
+
+    def stats(self):
+        """Return this batch's pool counters plus 'singleflight' and 'limiter' (None at a fixed limit)."""
+        snapshot = dict(self._pool.stats() if self._pool is not None else self._pool_stats or {})
+        snapshot['singleflight'] = self._flight.stats()
+        snapshot['limiter'] = self.limit.stats() if self.limit is not None else None
+        return snapshot
+
+    async def close(self):
+        """Close the pool; its final counters stay available from stats()."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            self._pool_stats = pool.stats()
+            await pool.close()
 
 
 async def get_passwords_async(object_names, max_concurrent=10, **kwargs):
-    """Get multiple passwords asynchronously with semaphore control."""
-    semaphore = asyncio.Semaphore(max_concurrent)
+    """Get multiple passwords asynchronously with semaphore control.
+
+    With limiter='aimd' or 'gradient' (or AAM_LIMITER) max_concurrent is only the starting point: the
+    limit then follows CCP's latency and throttling within min_limit..max_limit (see limiter_stats()).
+    With fields the values are AccountResult objects holding only those CCP properties.
+    """
+    config = _resolve_config(kwargs)
+    
+    # Answer what the cache file already holds; new entries are written back in one rewrite at the end
+    cached = {}
+    cache = kwargs.get('cache')
+    if cache is None and config['disk_cache']:
+        cache = kwargs['cache'] = DiskSecretCache(config['disk_cache'], ttl=config['disk_cache_ttl'], autoflush=False)
+    if cache is not None:
+        for obj_name in object_names:
+            result = _cached_result(cache, config, _api_path(config, obj_name), kwargs.get('fields'))
+            if result is not None:
+                cached[obj_name] = result
+    missing = [obj_name for obj_name in object_names if obj_name not in cached]
+    if not missing:
+        # Everything was cached: no SSL context, no connection
+        return cached
+    
+    # One pool of keep-alive connections shared by every lookup in the batch
+    context = _context(config)
+    semaphore, pool, workers = _make_batch(config, context, max_concurrent)
+    kwargs['pool'] = pool
+    
+    async def lookup(obj_name):
+        name, password = await get_password(obj_name, semaphore, **kwargs)
+        cached[name] = password
     
-    tasks = [
-        get_password(obj_name, semaphore, **kwargs)
-        for obj_name in object_names
-    ]
-    results = await asyncio.gather(*tasks)
+    global _last_pool_stats
+    try:
+        await _run_workers(missing, min(workers, len(missing)), lookup)
+    finally:
+        _last_pool_stats = pool.stats()
+        await pool.close()
+        if cache is not None:
+            cache.flush()
     
-    return dict(results)
+    return {obj_name: cached[obj_name] for obj_name in object_names}
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
+# Per-record overrides accepted in --stream JSON input, mapped to get_password keyword arguments
+_RECORD_FIELDS = {'safe': 'safe_name', 'safe_name': 'safe_name', 'appid': 'app_id', 'app_id': 'app_id'}
+
+
+def read_record(line):
+    """Turn one stripped input line into a record dict; a bare object name becomes {'object': name}."""
+    return json.loads(line) if line.startswith('{') else {'object': line}
+
+
+def record_query(record):
+    """Return (object name, get_password overrides, caller id) for a record from read_record()."""
+    object_name = record.get('object') or record.get('object_name')
+    if not object_name:
+        raise Exception('ERROR: record has no "object" field.')
+    overrides = {_RECORD_FIELDS[name]: value for name, value in record.items() if name in _RECORD_FIELDS and value}
+    return object_name, overrides, record.get('id')
+
+
+def _parse_record(line):
+    """Turn one input line into (object name, get_password overrides, caller id)."""
+    return record_query(read_record(line))
+
+
+async def _stream_one(line_no, line, semaphore, kwargs):
+    result = {'line': line_no}
+    try:
+        object_name, overrides, record_id = _parse_record(line)
+        result['object'] = object_name
+        if record_id is not None:
+            result['id'] = record_id
+        response = await _get_response(object_name, semaphore, dict(kwargs, **overrides))
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    if response.get('Content') is None:
+        result['error'] = '{}: {}'.format(response.get('ErrorCode'), response.get('ErrorMsg'))
+    else:
+        result['password'] = response['Content']
+    return result
+
+
+async def stream_passwords(lines, out, window=1000, max_concurrent=10, **kwargs):
+    """Look up objects read line by line and write one NDJSON result per line as each completes.
+
+    lines is a text file (or any iterable of lines) holding object names, or JSON records such as
+    {"object": "db01", "safe": "Linux", "app_id": "app", "id": 7}. At most window lookups are read
+    ahead and in flight, so memory stays flat however long the input is. Results carry the input
+    line number (and id, when given) since they are written in completion order.
+    Returns (succeeded, failed).
+    """
+    loop = asyncio.get_running_loop()
+    config = _resolve_config(kwargs)
+    
+    cache = kwargs.get('cache')
+    if cache is None and config['disk_cache']:
+        cache = kwargs['cache'] = DiskSecretCache(config['disk_cache'], ttl=config['disk_cache_ttl'], autoflush=False)
+    # One pool of keep-alive connections for the whole stream
+    context = _context(config)
+    semaphore, pool, workers = _make_batch(config, context, max_concurrent)
+    kwargs['pool'] = pool
+    window = max(window, workers)
+    
+    lines = iter(lines)
+    pending = set()
+    reader = None
+    line_no = 0
+    counts = [0, 0]
+    global _last_pool_stats
+    try:
+        while True:
+            # Read the next line off the event loop (stdin may block) whenever the window has room
+            if reader is None and lines is not None and len(pending) < window:
+                reader = loop.run_in_executor(None, next, lines, None)
+            waiting = pending | ({reader} if reader is not None else set())
+            if not waiting:
+                break
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if reader in done:
+                line = reader.result()
+                reader = None
+                if line is None:
+                    lines = None
+                else:
+                    line_no += 1
+                    line = line.strip()
+                    if line:
+                        pending.add(asyncio.ensure_future(_stream_one(line_no, line, semaphore, kwargs)))
+            finished = [task for task in done if task in pending]
+            for task in finished:
+                pending.discard(task)
+                result = task.result()
+                counts[1 if 'error' in result else 0] += 1
+                out.write(json.dumps(result) + '\n')
+            if finished:
+                out.flush()
+    finally:
+        for task in pending:
+            task.cancel()
+        _last_pool_stats = pool.stats()
+        await pool.close()
+        if cache is not None:
+            cache.flush()
+    return tuple(counts)
+
+
+def _print_limit_summary():
+    stats = limiter_stats()
+    if stats is None:
+        return
+    seen = [limit for _, limit in stats['history']]
+    print('Concurrency ({policy}): {initial} -> {limit} (range {low}-{high}, bounds {min_limit}-{max_limit}); '
+          '{increases} increases, {decreases} decreases; {slow} slow, {throttled} throttled, {errors} errors'.format(
+              low=min(seen), high=max(seen), **stats), file=sys.stderr)
+
+
+def main(argv=None):
+    import argparse
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(prog='cyberark_cert_auth.py', description='Fetch CyberArk CCP passwords concurrently.')
+    parser.add_argument('objects', nargs='*', help='object names (printed as one dict once all are fetched)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read object names or JSON records line by line and write one NDJSON result per line as each completes')
+    parser.add_argument('--input', help='file to read in --stream mode (default: stdin)')
+    parser.add_argument('--window', type=int, default=1000, help='lookups read ahead and in flight in --stream mode')
+    parser.add_argument('--max-concurrent', type=int, default=10, help='concurrent CCP requests (the starting point with --limiter)')
+    parser.add_argument('--limiter', choices=LIMITER_POLICIES, help='adapt concurrency to CCP latency and throttling (default: AAM_LIMITER, else fixed)')
+    parser.add_argument('--min-limit', type=int, help='lowest adaptive limit (default: AAM_MIN_LIMIT or 1)')
+    parser.add_argument('--max-limit', type=int, help='highest adaptive limit (default: AAM_MAX_LIMIT or 100)')
+    parser.add_argument('--transport', choices=transports(), help='http1 keep-alive connections or h2 multiplexing (default: AAM_TRANSPORT, else http1)')
+    args = parser.parse_args(argv)
+    limits = {'limiter': args.limiter, 'min_limit': args.min_limit, 'max_limit': args.max_limit, 'transport': args.transport}
+    
+    if args.stream:
+        source = open(args.input) if args.input else sys.stdin
+        try:
+            _, failed = asyncio.run(stream_passwords(source, sys.stdout, window=args.window, max_concurrent=args.max_concurrent, **limits))
+        finally:
+            if args.input:
+                source.close()
+        _print_limit_summary()
+        export_from_env(resolve_metrics())
+        return 1 if failed else 0
+    
+    if not args.objects:
         print("Usage: python cyberark_cert_auth.py <object_name1> [object_name2] ...")
+        print("       python cyberark_cert_auth.py --stream [--input FILE] < object_names")
         sys.exit(1)
     
     start_time = time.time()
-    object_names = sys.argv[1:]
+    object_names = args.objects
     
     # Get all passwords asynchronously with semaphore (max 10 concurrent)
-    password_list = asyncio.run(get_passwords_async(object_names))
+    password_list = asyncio.run(get_passwords_async(object_names, max_concurrent=args.max_concurrent, **limits))
     
     print(password_list)
     print(f"Execution time: {time.time() - start_time:.2f} seconds")
-    
\ No newline at end of file
+    _print_limit_summary()
+    # AAM_METRICS_FILE / AAM_ZABBIX_SERVER receive the batch's phase timings when AAM_METRICS=true
+    export_from_env(resolve_metrics())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
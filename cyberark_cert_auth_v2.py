@@ -4,15 +4,20 @@ import json
 import http.client
 import urllib.parse
 import sys
-from dotenv import load_dotenv
-
-load_dotenv()
+from ccp_account import project
+from ccp_env import load_env
+from ccp_metrics import export_from_env, outcome_for, resolve_metrics
+from ccp_ssl import get_ssl_context, ResumingHTTPSConnection
 
 
 def get_password(object_name, **kwargs):
-    """Get password from CyberArk for specified object name."""
+    """Get password from CyberArk for specified object name.
+
+    With fields (CCP property names) returns a ccp_account.AccountResult holding only those instead.
+    """
     
     # Config from env or kwargs
+    load_env()
     app_id = kwargs.get('app_id') or os.getenv('AAM_APP_ID')
     safe_name = kwargs.get('safe_name') or os.getenv('AAM_SAFE')
     host = kwargs.get('host') or os.getenv('AAM_BASE_URI')
@@ -25,18 +30,49 @@ def get_password(object_name, **kwargs):
     query = urllib.parse.quote(f"Safe={safe_name};Object={object_name}")
     api_path = f"/AIMWebService/api/Accounts?AppID={app_id}&Query={query}"
     
-    # SSL context with password-protected cert
-    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-    context.load_cert_chain(certfile=cert_path, password=cert_password)
+    # Shared SSL context: the password-protected key is decrypted once and reloaded if the cert changes
+    context = get_ssl_context(cert_path, cert_password)
     
-    # Make API call
-    conn = http.client.HTTPSConnection(host, context=context)
+    # Per-phase latency hooks, off unless metrics is passed or AAM_METRICS=true
+    metrics = resolve_metrics(kwargs.get('metrics'))
+    if metrics is not None:
+        return _result(_timed_get_password(metrics, app_id, host, context, api_path), kwargs.get('fields'))
+    
+    # Make API call, resuming the previous TLS session to this host when possible
+    conn = ResumingHTTPSConnection(host, context=context)
     conn.request('GET', api_path)
     response = conn.getresponse()
     data = json.loads(response.read().decode())
     conn.close()
     
-    return data.get('Content')
+    return _result(data, kwargs.get('fields'))
+
+
+def _result(data, fields):
+    return data.get('Content') if fields is None else project(data, fields)
+
+
+def _timed_get_password(metrics, app_id, host, context, api_path):
+    # Same request as get_password with dns, connect, tls, server and decode marked on a phase timer
+    timer = metrics.timer(app_id, host)
+    conn = ResumingHTTPSConnection(host, context=context)
+    try:
+        conn._create_connection = timer.create_connection
+        conn.connect()
+        timer.mark('tls')
+        conn.request('GET', api_path)
+        response = conn.getresponse()
+        body = response.read()
+        timer.mark('server')
+    except Exception:
+        timer.finish('error')
+        raise
+    finally:
+        conn.close()
+    data = json.loads(body.decode())
+    timer.mark('decode')
+    timer.finish(outcome_for(response.status))
+    return data
 
 
 if __name__ == '__main__':
@@ -50,3 +86,4 @@ if __name__ == '__main__':
     for obj_name in object_names:
         password = get_password(obj_name)
         print(f"Object: {obj_name}, Password: {password}")
+    export_from_env(resolve_metrics())
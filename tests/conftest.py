@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Flat top-level modules, the CCP stand-in under benchmarks/ and the Salt scripts
+for path in (os.path.join(ROOT, 'Salt'), os.path.join(ROOT, 'benchmarks'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(autouse=True)
+def clean_env(monkeypatch):
+    # Tests pass their settings explicitly; a developer's AAM_* environment must not leak in
+    saved = dict(os.environ)
+    for name in list(os.environ):
+        if name.startswith('AAM_'):
+            monkeypatch.delenv(name)
+    yield
+    # Loading a .env (ccp_env.load_env) writes straight into os.environ; nothing may leak into the next test
+    os.environ.clear()
+    os.environ.update(saved)
+
+
+def _standin(**kwargs):
+    pytest.importorskip('cryptography')
+    from standin import StandInCCP
+    return StandInCCP(**kwargs).start()
+
+
+@pytest.fixture
+def make_standin():
+    """Start mutual-TLS CCP stand-ins (see benchmarks/standin.py); all of them trust the first one's client cert."""
+    started = []
+
+    def make(**kwargs):
+        server = _standin(**kwargs)
+        if started:
+            # Every stand-in generates its own CA; serving the first one's context lets one client cert reach all
+            server.context = started[0].context
+        started.append(server)
+        return server
+
+    yield make
+    for server in started:
+        server.stop()
+
+
+@pytest.fixture
+def standin(make_standin):
+    return make_standin()
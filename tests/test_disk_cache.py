@@ -0,0 +1,114 @@
+import json
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+fernet = pytest.importorskip('cryptography.fernet')
+# File locking and fork: POSIX only
+fcntl = pytest.importorskip('fcntl')
+
+from aam_python import CCPPasswordREST
+from ccp_disk_cache import DiskSecretCache
+
+
+@pytest.fixture
+def encryption_key(monkeypatch):
+    key = fernet.Fernet.generate_key().decode()
+    monkeypatch.setenv('ENCRYPTION_KEY', key)
+    return key
+
+
+@pytest.fixture
+def cache_path(tmp_path, encryption_key):
+    return str(tmp_path / 'ccp-cache.json')
+
+
+def _entries(path):
+    with open(path) as file:
+        return json.load(file)['entries']
+
+
+def test_client_reads_disk_cache_settings_from_the_environment(standin, cache_path, monkeypatch):
+    monkeypatch.setenv('AAM_DISK_CACHE', cache_path)
+    monkeypatch.setenv('AAM_DISK_CACHE_TTL', '1234')
+    for _ in range(2):
+        ccp = CCPPasswordREST(verifyService=False, base_uri=standin.host)
+        ccp.load_cert_from_path(standin.client_cert)
+        try:
+            assert ccp.get_password(appid='app', safe='Linux', objectName='db01')['Content'] == 'standin-secret'
+        finally:
+            ccp.close()
+    # The second client (a new CLI run) was answered from the file
+    assert standin.stats()['requests'] == 1
+    [(expires_at, _)] = _entries(cache_path).values()
+    assert 1200 < expires_at - time.time() <= 1234
+
+
+def test_writers_merge_instead_of_overwriting(cache_path):
+    first = DiskSecretCache(cache_path)
+    second = DiskSecretCache(cache_path)
+    # Both have read the (empty) file before either writes
+    assert first.get(['a']) is None and second.get(['b']) is None
+    first.put(['a'], b'one')
+    second.put(['b'], b'two')
+    fresh = DiskSecretCache(cache_path)
+    assert (fresh.get(['a']), fresh.get(['b'])) == (b'one', b'two')
+    # A removal is not undone by a writer holding an older copy
+    second.invalidate(['a'])
+    first.put(['c'], b'three')
+    assert [DiskSecretCache(cache_path).get([name]) for name in 'abc'] == [None, b'two', b'three']
+
+
+def _put_many(path, worker):
+    cache = DiskSecretCache(path)
+    for index in range(20):
+        cache.put([worker, index], '{}-{}'.format(worker, index).encode())
+
+
+def test_concurrent_processes_lose_no_entries(cache_path):
+    fork = multiprocessing.get_context('fork')
+    workers = [fork.Process(target=_put_many, args=(cache_path, worker)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+    cache = DiskSecretCache(cache_path)
+    assert all(cache.get([worker, index]) == '{}-{}'.format(worker, index).encode() for worker in range(4) for index in range(20))
+
+
+def test_writes_wait_for_the_exclusive_lock(cache_path):
+    cache = DiskSecretCache(cache_path)
+    done = threading.Event()
+    with open(cache_path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        threading.Thread(target=lambda: (cache.put(['a'], b'one'), done.set()), daemon=True).start()
+        assert not done.wait(0.3)
+    assert done.wait(5)
+    assert DiskSecretCache(cache_path).get(['a']) == b'one'
+
+
+def test_expired_entries_miss_and_are_dropped_on_the_next_write(cache_path):
+    cache = DiskSecretCache(cache_path)
+    cache.put(['old'], b'stale', ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get(['old']) is None
+    assert cache.stats()['expired'] == 1
+    cache.put(['new'], b'fresh')
+    assert len(_entries(cache_path)) == 1
+
+
+def test_undecryptable_entries_are_misses(cache_path):
+    DiskSecretCache(cache_path).put(['a'], b'one')
+    other = DiskSecretCache(cache_path, key=fernet.Fernet.generate_key())
+    assert other.get(['a']) is None
+    # Same key, tampered token
+    entries = _entries(cache_path)
+    [(name, (expires_at, token))] = entries.items()
+    with open(cache_path, 'w') as file:
+        json.dump({'version': 1, 'entries': {name: [expires_at, token[:-4] + 'AAAA']}}, file)
+    cache = DiskSecretCache(cache_path)
+    assert cache.get(['a']) is None
+    assert cache.stats()['undecryptable'] == 1
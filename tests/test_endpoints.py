@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import time
+
+from ccp_endpoints import AsyncFailoverPool, FailoverPool
+from ccp_ssl import get_ssl_context
+
+PATH = '/AIMWebService/api/Accounts?AppID=app&Query=Safe%3DS%3BObject%3Ddb01'
+
+
+def _refused_host():
+    # A port that was just free: connecting to it is refused
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return '127.0.0.1:{}'.format(port)
+
+
+def _request(hosts, context, **kwargs):
+    pool = FailoverPool(hosts, context, connect_timeout=2, read_timeout=5, **kwargs)
+    try:
+        status, _ = pool.request('GET', PATH)
+        return status, pool.stats()
+    finally:
+        pool.close()
+
+
+def _request_async(hosts, context, **kwargs):
+    async def run():
+        pool = AsyncFailoverPool(hosts, context, timeout=5, connect_timeout=2, **kwargs)
+        try:
+            response = await pool.request('GET', PATH)
+            return response.status, pool.stats()
+        finally:
+            await pool.close()
+    return asyncio.run(run())
+
+
+def test_fails_over_from_a_node_answering_5xx(make_standin):
+    broken = make_standin(error_rate=1.0)
+    healthy = make_standin()
+    context = get_ssl_context(broken.client_cert)
+    for request in (_request, _request_async):
+        status, stats = request('{},{}'.format(broken.host, healthy.host), context)
+        assert status == 200
+        assert stats['failovers'] == 1
+        assert [node['failures'] for node in stats['endpoints']] == [1, 0]
+        assert not stats['endpoints'][0]['healthy']
+
+
+def test_fails_over_from_a_node_refusing_connections(standin):
+    context = get_ssl_context(standin.client_cert)
+    for request in (_request, _request_async):
+        status, stats = request('{},{}'.format(_refused_host(), standin.host), context)
+        assert status == 200
+        assert stats['failovers'] == 1
+        assert stats['endpoints'][1]['requests'] == 1
+
+
+def test_all_nodes_failing_returns_the_last_answer(make_standin):
+    first = make_standin(error_rate=1.0)
+    second = make_standin(error_rate=1.0)
+    status, _ = _request('{},{}'.format(first.host, second.host), get_ssl_context(first.client_cert))
+    assert status == 500
+
+
+def test_hedged_request_wins_on_a_slow_primary(make_standin):
+    slow = make_standin(latency_ms=1500)
+    fast = make_standin()
+    context = get_ssl_context(slow.client_cert)
+    for request in (_request, _request_async):
+        started = time.monotonic()
+        status, stats = request('{},{}'.format(slow.host, fast.host), context, hedge=True, hedge_delay=0.05)
+        assert status == 200
+        assert time.monotonic() - started < 1.0
+        assert stats['hedged'] == 1 and stats['hedge_wins'] == 1
+
+
+def test_no_hedge_when_the_primary_answers_in_time(make_standin):
+    primary = make_standin()
+    secondary = make_standin()
+    status, stats = _request('{},{}'.format(primary.host, secondary.host), get_ssl_context(primary.client_cert),
+                             hedge=True, hedge_delay=1.0)
+    assert status == 200
+    assert stats['hedged'] == 0 and secondary.stats()['requests'] == 0
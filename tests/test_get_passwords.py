@@ -0,0 +1,26 @@
+import aam_python
+import aam_python_v2
+
+
+def test_v2_shares_the_client():
+    assert aam_python_v2.CCPPasswordREST is aam_python.CCPPasswordREST
+
+
+def test_results_follow_the_input_order(make_standin):
+    standin = make_standin(jitter_ms=20)
+    ccp = aam_python.CCPPasswordREST(verifyService=False, base_uri=standin.host)
+    ccp.load_cert_from_path(standin.client_cert)
+    try:
+        queries = [{'appid': 'app', 'safe': 'S', 'objectName': 'db{}'.format(i % 4)} for i in range(10)]
+        queries[3] = {'appid': 'app'}
+        results = ccp.get_passwords(queries, max_concurrency=4)
+        assert list(results) == list(range(10))
+        assert 'safe is a required parameter' in str(results[3]['error'])
+        assert all(results[i]['result']['Content'] == 'standin-secret' for i in range(10) if i != 3)
+        # Duplicates were fetched once
+        assert standin.stats()['requests'] == 4
+
+        labelled = ccp.get_passwords({'web': queries[0], 'bad': queries[3], 'db': queries[1]})
+        assert list(labelled) == ['web', 'bad', 'db']
+    finally:
+        ccp.close()
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from ccp_limiter import AdaptiveLimit
+from cyberark_cert_auth import CCPBatch
+
+FLOOR = 2
+CEILING = 12
+
+
+def _batch(standin, policy, **kwargs):
+    return CCPBatch(max_concurrent=8, host=standin.host, cert_path=standin.client_cert, app_id='app', safe_name='Linux',
+                    limiter=policy, min_limit=FLOOR, max_limit=CEILING, **kwargs)
+
+
+async def _fetch_all(batch, names):
+    # Distinct objects so single-flight does not collapse them
+    return await asyncio.gather(*[batch.fetch(batch.api_path(name)) for name in names], return_exceptions=True)
+
+
+def _limits(batch):
+    return [limit for _, limit in batch.limit.stats()['history']]
+
+
+@pytest.mark.parametrize('policy', ['aimd', 'gradient'])
+def test_limit_backs_off_on_throttling_and_climbs_back(make_standin, policy):
+    standin = make_standin(latency_ms=20, capacity=3)
+
+    async def run():
+        async with _batch(standin, policy) as batch:
+            await _fetch_all(batch, ['busy{}'.format(i) for i in range(150)])
+            throttled = batch.limit.stats()
+            # CCP has recovered
+            standin.capacity = None
+            await _fetch_all(batch, ['calm{}'.format(i) for i in range(600)])
+            return throttled, batch.limit.stats(), _limits(batch)
+
+    throttled, recovered, limits = asyncio.run(run())
+    assert standin.stats()['throttled'] > 0
+    assert throttled['throttled'] > 0 and throttled['decreases'] > 0
+    assert throttled['limit'] < throttled['initial']
+    assert recovered['increases'] > throttled['increases']
+    assert recovered['limit'] > throttled['limit']
+    assert all(FLOOR <= limit <= CEILING for limit in limits)
+
+
+def test_limit_backs_off_on_timeouts_and_stops_at_the_floor(make_standin):
+    standin = make_standin(latency_ms=400)
+
+    async def run():
+        async with _batch(standin, 'aimd', timeout=0.1) as batch:
+            results = await _fetch_all(batch, ['slow{}'.format(i) for i in range(40)])
+            return results, batch.limit.stats(), _limits(batch)
+
+    results, stats, limits = asyncio.run(run())
+    assert all(isinstance(result, Exception) for result in results)
+    assert stats['errors'] > 0 and stats['limit'] == FLOOR
+    assert min(limits) == FLOOR
+
+
+def test_limit_stops_at_the_ceiling(make_standin):
+    # Steady latency well above scheduling noise, so no answer counts as slow
+    standin = make_standin(latency_ms=20)
+
+    async def run():
+        async with _batch(standin, 'aimd') as batch:
+            await _fetch_all(batch, ['db{}'.format(i) for i in range(600)])
+            return batch.limit.stats(), _limits(batch)
+
+    stats, limits = asyncio.run(run())
+    assert stats['limit'] == CEILING and max(limits) == CEILING
+    assert standin.stats()['peak_in_flight'] <= CEILING
+
+
+def test_bounds_are_validated():
+    with pytest.raises(Exception, match='1 <= min_limit'):
+        AdaptiveLimit(min_limit=5, max_limit=2)
+    assert AdaptiveLimit(initial=50, min_limit=1, max_limit=8).limit == 8
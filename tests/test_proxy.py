@@ -0,0 +1,148 @@
+import http.client
+import json
+import os
+import socket
+import ssl
+import stat
+import threading
+import urllib.parse
+
+import pytest
+
+from aam_python import CCPPasswordREST
+import ccp_proxy
+
+TARGET = '/AIMWebService/api/Accounts?AppID=zabbix&Query=' + urllib.parse.quote('Safe=Linux;Object=db01')
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def _get(conn, target):
+    conn.request('GET', target)
+    response = conn.getresponse()
+    return response.status, response.getheader('Content-Type'), json.loads(response.read())
+
+
+@pytest.fixture
+def client(standin):
+    # Configured as ccp_proxy.main does by default
+    ccp = CCPPasswordREST(verifyService=False, base_uri=standin.host, cache_ttl=300)
+    ccp.load_cert_from_path(standin.client_cert)
+    yield ccp
+    ccp.close()
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def unix_proxy(client, tmp_path):
+    path = str(tmp_path / 'ccp-proxy.sock')
+    server = _serve(ccp_proxy.make_server(client, unix_socket=path))
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_accounts_response_matches_upstream(standin, unix_proxy):
+    upstream_status, upstream_body, upstream_type = standin.respond(TARGET)
+    status, content_type, body = _get(_UnixConnection(unix_proxy), TARGET)
+    assert (status, content_type, body) == (upstream_status, upstream_type, json.loads(upstream_body))
+
+
+def test_repeat_lookups_are_answered_from_the_cache(standin, unix_proxy):
+    conn = _UnixConnection(unix_proxy)
+    standin.reset_stats()
+    answers = [_get(conn, TARGET) for _ in range(5)]
+    assert all(answer == answers[0] for answer in answers)
+    assert standin.stats()['requests'] == 1
+
+
+def test_upstream_errors_keep_their_status_and_json(standin, unix_proxy):
+    standin.error_rate = 1.0
+    status, _, body = _get(_UnixConnection(unix_proxy), TARGET)
+    assert status == 500
+    assert body['ErrorCode'] == 'APPAP282E'
+
+
+@pytest.fixture
+def https_proxy(standin, client):
+    context = ccp_proxy.server_ssl_context(standin.certs['server.pem'], standin.certs['server.key'], standin.certs['ca.pem'])
+    server = _serve(ccp_proxy.make_server(client, listen='127.0.0.1:0', ssl_context=context))
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def _caller(cert=None):
+    caller = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    caller.check_hostname = False
+    caller.verify_mode = ssl.CERT_NONE
+    if cert:
+        caller.load_cert_chain(cert)
+    return caller
+
+
+def test_https_listener(standin, https_proxy):
+    conn = http.client.HTTPSConnection('127.0.0.1', https_proxy, context=_caller(standin.client_cert))
+    status, _, body = _get(conn, TARGET)
+    assert status == 200 and body['Content'] == 'standin-secret'
+
+
+def test_https_listener_refuses_callers_without_a_client_cert(standin, https_proxy):
+    standin.reset_stats()
+    conn = http.client.HTTPSConnection('127.0.0.1', https_proxy, context=_caller(), timeout=5)
+    with pytest.raises((ssl.SSLError, ConnectionError, http.client.RemoteDisconnected)):
+        _get(conn, TARGET)
+    assert standin.stats()['requests'] == 0
+
+
+def test_tcp_listener_needs_client_ca_or_an_explicit_opt_out(standin, capsys):
+    argv = ['--upstream', standin.host, '--cert', standin.client_cert, '--tls-cert', standin.certs['server.pem'],
+            '--tls-key', standin.certs['server.key'], '--listen', '127.0.0.1:0']
+    with pytest.raises(SystemExit):
+        ccp_proxy.main(argv)
+    assert '--client-ca is required' in capsys.readouterr().err
+
+
+def test_lookup_needs_certificates():
+    with pytest.raises(Exception, match='Certificates have not been loaded'):
+        CCPPasswordREST(verifyService=False, base_uri='https://127.0.0.1:1').lookup({'AppID': 'zabbix'})
+
+
+def test_unix_socket_is_owner_only_by_default(unix_proxy):
+    assert stat.S_IMODE(os.stat(unix_proxy).st_mode) == 0o600
+
+
+def test_unix_socket_mode_and_group(client, tmp_path):
+    path = str(tmp_path / 'group.sock')
+    server = ccp_proxy.make_server(client, unix_socket=path, socket_mode=0o660, socket_group=os.getgid())
+    try:
+        info = os.stat(path)
+        assert stat.S_IMODE(info.st_mode) == 0o660 and info.st_gid == os.getgid()
+    finally:
+        server.server_close()
+
+
+def test_unix_socket_replaces_a_stale_socket_only(client, tmp_path):
+    path = str(tmp_path / 'ccp-proxy.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    ccp_proxy.make_server(client, unix_socket=path).server_close()
+
+    regular = tmp_path / 'not-a-socket'
+    regular.write_text('keep me')
+    with pytest.raises(Exception, match='not a socket'):
+        ccp_proxy.make_server(client, unix_socket=str(regular))
+    assert regular.read_text() == 'keep me'
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+fernet = pytest.importorskip('cryptography.fernet')
+if not hasattr(os, 'fork'):
+    pytest.skip('needs fork', allow_module_level=True)
+
+from aam_python import CCPPasswordREST
+import ccp_shared_cache
+from ccp_shared_cache import SharedSecretCache
+import ccp_fork
+
+KEY = ['appid', 'Linux', 'db01']
+OLD = b'old-' + b'a' * 900
+NEW = b'new-' + b'b' * 900
+FORK = multiprocessing.get_context('fork')
+
+
+@pytest.fixture
+def encryption_key(monkeypatch):
+    key = fernet.Fernet.generate_key().decode()
+    monkeypatch.setenv('ENCRYPTION_KEY', key)
+    return key
+
+
+@pytest.fixture
+def cache_path(tmp_path, encryption_key):
+    return str(tmp_path / 'ccp-shared.cache')
+
+
+def _run_children(target, count, *args):
+    # Each child reports (index, result or exception text) on the queue
+    results = FORK.Queue()
+    children = [FORK.Process(target=_report, args=(results, index, target) + args) for index in range(count)]
+    for child in children:
+        child.start()
+    answers = dict(results.get(timeout=30) for _ in children)
+    for child in children:
+        child.join(timeout=10)
+        assert child.exitcode == 0
+    return [answers[index] for index in range(count)]
+
+
+def _report(results, index, target, *args):
+    try:
+        results.put((index, target(*args)))
+    except Exception as e:
+        results.put((index, 'ERROR: {!r}'.format(e)))
+
+
+def _rewrite(path, stop):
+    cache = SharedSecretCache(path, slots=8)
+    writes = 0
+    while not stop.is_set():
+        cache.put(KEY, OLD if writes % 2 else NEW)
+        writes += 1
+    return writes
+
+
+def test_a_concurrent_writer_never_hands_out_a_torn_body(cache_path):
+    reader = SharedSecretCache(cache_path, slots=8)
+    reader.put(KEY, OLD)
+    stop = FORK.Event()
+    seen = []
+    threading.Thread(target=lambda: seen.extend(_run_children(_rewrite, 1, cache_path, stop)), daemon=True).start()
+    deadline = time.time() + 1.0
+    bodies = set()
+    while time.time() < deadline:
+        bodies.add(reader.get(KEY))
+    stop.set()
+    for _ in range(100):
+        if seen:
+            break
+        time.sleep(0.05)
+    assert isinstance(seen[0], int) and seen[0] > 0
+    # Whatever the interleaving: a whole old body, a whole new one, or a miss
+    assert bodies <= {OLD, NEW, None}
+    assert reader.stats()['hits'] > 0
+
+
+def test_a_slot_mid_write_or_damaged_is_a_miss(cache_path):
+    cache = SharedSecretCache(cache_path, slots=1)
+    cache.put(KEY, OLD)
+    offset = ccp_shared_cache._HEADER_SIZE
+    seq = struct.unpack_from('<Q', cache._mm, offset)[0]
+    # A writer that died between its two sequence updates leaves the slot odd
+    struct.pack_into('<Q', cache._mm, offset, seq + 1)
+    assert cache.get(KEY) is None and cache.stats()['torn'] == 1
+    # Bytes changed without the sequence noticing are caught by Fernet's MAC
+    struct.pack_into('<Q', cache._mm, offset, seq)
+    cache._mm[offset + ccp_shared_cache._SLOT.size + 10] ^= 0xff
+    assert cache.get(KEY) is None and cache.stats()['undecryptable'] == 1
+
+
+def _lookup(host, cert, path, start):
+    ccp = CCPPasswordREST(verifyService=False, base_uri=host, shared_cache=path)
+    ccp.load_cert_from_path(cert)
+    start.wait(timeout=10)
+    try:
+        return ccp.get_password(appid='app', safe='Linux', objectName='db01')['Content'], ccp.shared_cache_stats()['lease_waits']
+    finally:
+        ccp.close()
+
+
+def test_concurrent_misses_in_several_processes_fetch_once(make_standin, cache_path):
+    # Slow enough that every process misses before the first fetch completes
+    standin = make_standin(latency_ms=300)
+    start = FORK.Event()
+    threading.Timer(0.5, start.set).start()
+    answers = _run_children(_lookup, 4, standin.host, standin.client_cert, cache_path, start)
+    assert [content for content, _ in answers] == ['standin-secret'] * 4
+    assert standin.stats()['requests'] == 1
+    # The three that lost the race waited on the winner's lease rather than going upstream
+    assert sum(waits for _, waits in answers) == 3
+
+
+def _after_fork_state(ccp):
+    stats = ccp.pool_stats()
+    content = ccp.get_password(appid='app', safe='Linux', objectName='db02')['Content']
+    return {'fork_dropped': stats['fork_dropped'], 'in_use': ccp._pool._endpoints[0].pool._in_use, 'content': content,
+            'created': ccp.pool_stats()['created'], 'fork': ccp_fork.fork_stats()}
+
+
+def test_a_forked_child_gets_a_fresh_pool_and_locks(standin, cache_path):
+    ccp = CCPPasswordREST(verifyService=False, base_uri=standin.host, pool_size=2, cache_ttl=60, shared_cache=cache_path)
+    ccp.load_cert_from_path(standin.client_cert)
+    try:
+        ccp.get_password(appid='app', safe='Linux', objectName='db01')
+        assert ccp.pool_stats()['created'] == 1
+        # Locks a parent thread holds at fork time must not be inherited held
+        held = [ccp._pool._lock, ccp._pool._endpoints[0].pool._cond, ccp._flight._lock, ccp._cache._lock]
+        for lock in held:
+            lock.acquire()
+        try:
+            [state] = _run_children(_after_fork_state, 1, ccp)
+        finally:
+            for lock in held:
+                lock.release()
+    finally:
+        ccp.close()
+    assert state['content'] == 'standin-secret'
+    # The parent's keep-alive socket was dropped and the child dialled its own
+    assert state['fork_dropped'] == 1 and state['created'] == 2 and state['in_use'] == 0
+    assert state['fork']['forks'] >= 1 and state['fork']['failed'] == 0
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from ccp_singleflight import AsyncSingleFlight
+
+
+def test_cancelling_the_leader_does_not_fail_the_waiters():
+    async def run():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'secret'
+
+        leader = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.005)
+        waiter = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert await waiter == 'secret'
+        assert leader.cancelled() and len(calls) == 1
+        return flight.stats()
+
+    assert asyncio.run(run()) == {'calls': 2, 'executed': 1, 'coalesced': 1, 'in_flight': 0}
+
+
+def test_waiters_share_the_exception():
+    async def run():
+        flight = AsyncSingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('CCP down')
+
+        return await asyncio.gather(flight.do('key', fail), flight.do('key', fail), return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(run())] == ['CCP down', 'CCP down']
+
+
+def test_fetch_is_cancelled_when_nobody_waits():
+    async def run():
+        flight = AsyncSingleFlight()
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        caller = asyncio.ensure_future(flight.do('key', slow))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        return cancelled, flight.stats()['in_flight']
+
+    assert asyncio.run(run()) == ([True], 0)
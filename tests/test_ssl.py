@@ -0,0 +1,41 @@
+import os
+import ssl
+
+import pytest
+
+serialization = pytest.importorskip('cryptography.hazmat.primitives.serialization')
+
+import ccp_ssl
+from standin import generate_certs
+
+
+@pytest.fixture
+def encrypted_key(tmp_path):
+    certs = generate_certs(str(tmp_path))
+    key = serialization.load_pem_private_key(open(certs['client.pem'], 'rb').read(), None)
+    key_path = str(tmp_path / 'client.key')
+    with open(key_path, 'wb') as file:
+        file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.BestAvailableEncryption(b'right')))
+    return certs['client.pem'], key_path
+
+
+def test_context_is_shared_per_password(encrypted_key):
+    cert_path, key_path = encrypted_key
+    first = ccp_ssl.get_ssl_context(cert_path, 'right', key_path)
+    assert ccp_ssl.get_ssl_context(cert_path, 'right', key_path) is first
+
+
+def test_wrong_password_is_not_masked_by_the_cache(encrypted_key):
+    cert_path, key_path = encrypted_key
+    ccp_ssl.get_ssl_context(cert_path, 'right', key_path)
+    with pytest.raises(ssl.SSLError):
+        ccp_ssl.get_ssl_context(cert_path, 'wrong', key_path)
+
+
+def test_changed_files_are_reloaded(encrypted_key):
+    cert_path, key_path = encrypted_key
+    first = ccp_ssl.get_ssl_context(cert_path, 'right', key_path)
+    stat = os.stat(cert_path)
+    os.utime(cert_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert ccp_ssl.get_ssl_context(cert_path, 'right', key_path) is not first
@@ -0,0 +1,74 @@
+import asyncio
+import importlib.util
+
+import pytest
+
+import ccp_transport
+import cyberark_cert_auth
+from aam_python import CCPPasswordREST
+
+
+@pytest.fixture
+def without_h2(monkeypatch):
+    """Make the h2 package look uninstalled to ccp_transport."""
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name, *args: None if name == 'h2' else find_spec(name, *args))
+    monkeypatch.setattr(ccp_transport, '_AVAILABLE', {})
+
+
+def _client(standin, transport):
+    ccp = CCPPasswordREST(verifyService=False, base_uri=standin.host, transport=transport)
+    ccp.load_cert_from_path(standin.client_cert)
+    return ccp
+
+
+def _get_async(standin, transport):
+    return asyncio.run(cyberark_cert_auth.get_passwords_async(['db01'], host=standin.host, cert_path=standin.client_cert,
+                                                              app_id='app', safe_name='S', transport=transport))
+
+
+def test_h2_falls_back_to_http1_without_the_h2_package(without_h2, standin, capsys):
+    assert ccp_transport.resolve_transport('h2') == 'http1'
+    assert ccp_transport.alpn_protocols('h2') is None
+    assert 'needs the h2 package' in capsys.readouterr().err
+
+    ccp = _client(standin, 'h2')
+    try:
+        assert ccp.get_password(appid='app', safe='S', objectName='db01')['Content'] == 'standin-secret'
+        assert ccp.pool_stats()['transport'] == 'http1'
+    finally:
+        ccp.close()
+    assert _get_async(standin, 'h2') == {'db01': 'standin-secret'}
+    assert cyberark_cert_auth.pool_stats()['transport'] == 'http1'
+
+
+def test_aam_transport_selects_the_default(monkeypatch):
+    assert ccp_transport.resolve_transport() == 'http1'
+    monkeypatch.setenv('AAM_TRANSPORT', 'nope')
+    with pytest.raises(Exception, match='Unknown transport'):
+        ccp_transport.resolve_transport()
+
+
+def test_h2_multiplexes_over_one_connection(make_standin):
+    pytest.importorskip('h2')
+    standin = make_standin(http2=True)
+    ccp = _client(standin, 'h2')
+    try:
+        results = ccp.get_passwords([{'appid': 'app', 'safe': 'S', 'objectName': 'db{}'.format(i)} for i in range(20)])
+        assert all(outcome['result']['Content'] == 'standin-secret' for outcome in results.values())
+        assert ccp.pool_stats()['transport'] == 'h2'
+    finally:
+        ccp.close()
+    assert _get_async(standin, 'h2') == {'db01': 'standin-secret'}
+    # One connection for the thread client, one for the asyncio batch
+    assert standin.stats()['h2_connections'] == 2
+
+
+def test_http1_client_against_an_h2_capable_server(make_standin):
+    standin = make_standin(http2=True) if importlib.util.find_spec('h2') else make_standin()
+    ccp = _client(standin, 'http1')
+    try:
+        assert ccp.get_password(appid='app', safe='S', objectName='db01')['Content'] == 'standin-secret'
+    finally:
+        ccp.close()
+    assert standin.stats()['h2_connections'] == 0
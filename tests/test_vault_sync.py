@@ -0,0 +1,122 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('pymongo')
+fernet = pytest.importorskip('cryptography.fernet')
+
+import vault_sync
+
+
+class FakeCCP(object):
+    """get_passwords over an in-memory vault: {object name: password}; unknown objects fail."""
+
+    def __init__(self, vault):
+        self.vault = vault
+
+    def get_passwords(self, queries, max_concurrency=None):
+        results = {}
+        for index, query in enumerate(queries):
+            name = query['objectName']
+            if name not in self.vault:
+                results[index] = {'result': None, 'error': Exception('APPAP004E not found')}
+                continue
+            response = {'Content': self.vault[name], 'Safe': query['safe'], 'Name': name, 'UserName': 'svc-' + name}
+            results[index] = {'result': response, 'error': None}
+        return results
+
+
+class CountingCollection(object):
+    """Wraps a mongomock collection and records the operations of every bulk_write."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.bulk_writes = []
+
+    def find(self, *args, **kwargs):
+        return self.collection.find(*args, **kwargs)
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_writes.append(list(requests))
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+
+@pytest.fixture
+def keys():
+    return [fernet.Fernet.generate_key()]
+
+
+@pytest.fixture
+def collection():
+    return CountingCollection(mongomock.MongoClient()['vault']['credentials'])
+
+
+def _manifest(names):
+    return vault_sync.parse_manifest(names, appid='app', safe='Linux')
+
+
+def test_first_sync_upserts_every_account_encrypted(collection, keys):
+    vault = {'db{}'.format(i): 'pw{}'.format(i) for i in range(5)}
+    stats = vault_sync.sync(FakeCCP(vault), collection, _manifest(list(vault)), keys, batch_size=2)
+    assert stats['inserted'] == 5 and stats['changed'] == 5 and stats['failed'] == 0
+    # batch_size=2: three batches, each one bulk_write with one upsert per account
+    assert [len(ops) for ops in collection.bulk_writes] == [2, 2, 1]
+    document = collection.find({'_id': 'Linux/db3'}).next()
+    assert 'pw3' not in document['password']
+    assert fernet.Fernet(keys[0]).decrypt(document['password'].encode()) == b'pw3'
+    assert document['UserName'] == 'svc-db3'
+
+
+def test_rerun_without_changes_writes_nothing(collection, keys):
+    vault = {'db{}'.format(i): 'pw{}'.format(i) for i in range(5)}
+    vault_sync.sync(FakeCCP(vault), collection, _manifest(list(vault)), keys)
+    collection.bulk_writes.clear()
+    stats = vault_sync.sync(FakeCCP(vault), collection, _manifest(list(vault)), keys)
+    assert stats['unchanged'] == 5 and stats['changed'] == 0
+    assert collection.bulk_writes == []
+
+
+def test_only_rotated_accounts_are_written(collection, keys):
+    vault = {'db{}'.format(i): 'pw{}'.format(i) for i in range(5)}
+    vault_sync.sync(FakeCCP(vault), collection, _manifest(list(vault)), keys)
+    collection.bulk_writes.clear()
+    before = {doc['_id']: doc['updated_at'] for doc in collection.find({})}
+    vault['db1'] = 'rotated'
+    stats = vault_sync.sync(FakeCCP(vault), collection, _manifest(list(vault)), keys)
+    assert stats['changed'] == 1 and stats['updated'] == 1 and stats['unchanged'] == 4
+    assert [len(ops) for ops in collection.bulk_writes] == [1]
+    after = {doc['_id']: doc for doc in collection.find({})}
+    assert [name for name in after if after[name]['updated_at'] != before[name]] == ['Linux/db1']
+    assert fernet.Fernet(keys[0]).decrypt(after['Linux/db1']['password'].encode()) == b'rotated'
+
+
+def test_failed_lookups_and_dry_run(collection, keys):
+    stats = vault_sync.sync(FakeCCP({'db0': 'pw'}), collection, _manifest(['db0', 'missing']), keys, dry_run=True)
+    assert stats['failed'] == 1 and stats['changed'] == 1
+    assert collection.bulk_writes == []
+
+
+def test_digest_key_is_not_the_encryption_key(keys):
+    response = {'Content': 'pw', 'Safe': 'Linux', 'Name': 'db0'}
+    assert vault_sync.digest_key(keys[0]) != keys[0]
+    assert vault_sync.content_digest(vault_sync.digest_key(keys[0]), response) != vault_sync.content_digest(keys[0], response)
+
+
+def test_manifest_records_are_validated_with_line_numbers():
+    lines = ['db0', '# comment', '{"object": "db1", "id": "custom"}', '{"username": "svc"}']
+    assert [doc_id for doc_id, _ in _manifest(lines)] == [None, 'custom', None]
+    with pytest.raises(Exception, match='line 2 has no object or username'):
+        list(_manifest(['db0', '{"address": "10.0.0.1"}']))
+    with pytest.raises(Exception, match='line 1 has no safe'):
+        list(vault_sync.parse_manifest(['db0'], appid='app'))
+    with pytest.raises(Exception, match='line 1 is not valid JSON'):
+        list(_manifest(['{oops']))
+
+
+def test_rejected_writes_are_counted_and_the_rest_still_land(collection, keys, capsys):
+    # Two manifest ids for one vault object collide on a unique index: the second upsert is rejected
+    collection.collection.create_index('Name', unique=True)
+    lines = ['{"object": "db0", "id": "first"}', '{"object": "db0", "id": "second"}', 'db1']
+    stats = vault_sync.sync(FakeCCP({'db0': 'pw0', 'db1': 'pw1'}), collection, _manifest(lines), keys)
+    assert stats['changed'] == 3 and stats['inserted'] == 2 and stats['failed'] == 1
+    assert sorted(doc['_id'] for doc in collection.find({})) == ['Linux/db1', 'first']
+    assert 'Failed second:' in capsys.readouterr().err
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import urllib.parse
+
+import pytest
+
+import ccp_env
+import ccp_watch
+from ccp_watch import SecretWatcher, TimerHeap
+
+
+class ListSink(object):
+    def __init__(self):
+        self.events = []
+
+    def emit(self, events):
+        self.events.extend(events)
+
+
+@pytest.fixture
+def vault(standin):
+    """The stand-in answers from this dict: object name -> [Content, PasswordChangeInProcess]."""
+    accounts = {}
+    respond = standin.respond
+
+    def rotating(target):
+        status, body, content_type = respond(target)
+        path, _, query = target.partition('?')
+        if path != '/AIMWebService/api/Accounts' or status != 200:
+            return status, body, content_type
+        name = dict(urllib.parse.parse_qsl(query))['Query'].split('Object=')[1]
+        content, in_change = accounts.setdefault(name, ['initial-secret', False])
+        return 200, json.dumps({'Content': content, 'PasswordChangeInProcess': str(in_change)}).encode(), content_type
+
+    standin.respond = rotating
+    return accounts
+
+
+def _watcher(standin, sink, names, **kwargs):
+    watcher = SecretWatcher([sink], interval=60, jitter=0, host=standin.host, cert_path=standin.client_cert,
+                            app_id='app', safe_name='Linux', **kwargs)
+    for name in names:
+        watcher.add(name)
+    return watcher
+
+
+def _poll_once(watcher):
+    # interval=60: each run() polls every object exactly once
+    return asyncio.run(watcher.run(duration=0.5))
+
+
+def test_timer_heap_pops_earliest_first():
+    timers = TimerHeap()
+    for due, item in [(5, 'e'), (1, 'a'), (3, 'c'), (1, 'b'), (9, 'late')]:
+        timers.push(due, item)
+    assert timers.next_due() == 1
+    assert timers.pop_due(4, limit=2) == ['a', 'b']
+    assert timers.pop_due(4, limit=10) == ['c']
+    assert timers.pop_due(4, limit=10) == []
+    assert len(timers) == 2 and timers.next_due() == 5
+
+
+def test_events_only_on_changes(standin, vault):
+    sink = ListSink()
+    watcher = _watcher(standin, sink, ['db1', 'db2', '{"object": "db3", "safe": "Other", "id": 7}'])
+    _poll_once(watcher)
+    assert sink.events == [] and watcher.stats()['baselined'] == 3
+
+    vault['db1'][0] = 'rotated'
+    vault['db3'][1] = True
+    _poll_once(watcher)
+    changes = sorted((event['object'], event['changed'], event['PasswordChangeInProcess']) for event in sink.events)
+    assert changes == [('db1', ['Content'], False), ('db3', ['PasswordChangeInProcess'], True)]
+    assert [event.get('id') for event in sink.events if event['object'] == 'db3'] == [7]
+    assert all('rotated' not in json.dumps(event) for event in sink.events)
+
+    del sink.events[:]
+    _poll_once(watcher)
+    assert sink.events == []
+    assert watcher.stats()['changes'] == 2
+
+
+def test_emit_initial_and_errors(standin, vault):
+    sink = ListSink()
+    watcher = _watcher(standin, sink, ['db1'], emit_initial=True)
+    _poll_once(watcher)
+    assert [event['changed'] for event in sink.events] == [['initial']]
+    standin.error_rate = 1.0
+    _poll_once(watcher)
+    assert watcher.stats()['errors'] == 1 and len(sink.events) == 1
+
+
+def test_state_round_trip(standin, vault, tmp_path):
+    state = str(tmp_path / 'watch.json')
+    key = 'k' * 32
+    _poll_once(_watcher(standin, ListSink(), ['db1', 'db2'], state_path=state, key=key))
+    saved = json.load(open(state))
+    assert len(saved['watches']) == 2 and 'initial-secret' not in json.dumps(saved)
+
+    # Rotated while no watcher was running: the restarted one reports it on its first poll
+    vault['db2'][0] = 'rotated-while-down'
+    sink = ListSink()
+    restarted = _watcher(standin, sink, ['db1', 'db2'], state_path=state, key=key)
+    _poll_once(restarted)
+    assert [(event['object'], event['changed']) for event in sink.events] == [('db2', ['Content'])]
+    assert restarted.stats()['baselined'] == 0
+
+
+def test_state_needs_a_stable_key(standin, monkeypatch, tmp_path):
+    monkeypatch.delenv('ENCRYPTION_KEY', raising=False)
+    monkeypatch.setattr(ccp_env, '_loaded', True)
+    with pytest.raises(Exception, match='ENCRYPTION_KEY is required'):
+        _watcher(standin, ListSink(), ['db1'], state_path=str(tmp_path / 'watch.json'))
+
+
+def test_main_reads_dotenv(standin, vault, monkeypatch, tmp_path):
+    dotenv = pytest.importorskip('dotenv')
+    load_dotenv = dotenv.load_dotenv
+    monkeypatch.setattr(dotenv, 'load_dotenv', lambda: load_dotenv(str(tmp_path / '.env')))
+    monkeypatch.delenv('ENCRYPTION_KEY', raising=False)
+    monkeypatch.setattr(ccp_env, '_loaded', False)
+    (tmp_path / '.env').write_text('\n'.join([
+        'ENCRYPTION_KEY=' + 'k' * 32, 'AAM_BASE_URI=' + standin.host, 'AAM_DEMO_PATH=' + standin.client_cert,
+        'AAM_APP_ID=app', 'AAM_SAFE=Linux', 'AAM_WATCH_STATE=' + str(tmp_path / 'watch.json')]) + '\n')
+    output = tmp_path / 'events.ndjson'
+    assert ccp_watch.main(['db1', '--duration', '0.5', '--emit-initial', '--output', str(output)]) == 0
+    assert json.loads(output.read_text())['object'] == 'db1'
+    assert (tmp_path / 'watch.json').exists()